@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2015, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Catalog unit tests.
+
+This module tests creating, synchronizing and removing device catalogs
+for the ZPLTest1 ZenPack's components.
+
+"""
+
+import Globals
+from Acquisition import aq_base
+from Products.ZCatalog.ZCatalog import manage_addZCatalog
+from Products.ZenUtils.Utils import unused
+
+unused(Globals)
+
+import os
+import site
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+site.addsitedir(os.path.join(os.path.dirname(__file__), '..'))
+
+from ZenPacks.zenoss.ZPLTest1 import zenpacklib
+
+# Required before zenpacklib.TestCase can be used.
+zenpacklib.enableTesting()
+
+
+DEVICE_CLASS = '/Network/ZPLTest1'
+CATALOG = 'VnsCDevSearch'
+
+
+class TestCatalogs(zenpacklib.TestCase):
+
+    """Test suite for creating and synchronizing catalogs."""
+
+    zenpack_module_name = 'ZenPacks.zenoss.ZPLTest1'
+    zenpack_path = os.path.join(os.path.dirname(__file__),
+                                "data/zenpacks/ZenPacks.zenoss.ZPLTest1")
+    disableLogging = False
+
+    def afterSetUp(self):
+        try:
+            super(TestCatalogs, self).afterSetUp()
+        except ImportError, e:
+            self.assertFalse(
+                e.message == 'No module named ZPLTest1',
+                "ZPLTest1 zenpack is not installed.  You must install it before running this test:\n   zenpack --link --install=%s" % self.zenpack_path
+            )
+
+    def create_cdev(self):
+        """Return VnsCDev component of a new APIC in DEVICE_CLASS."""
+        from ZenPacks.zenoss.ZPLTest1.FvTenant import FvTenant
+        from ZenPacks.zenoss.ZPLTest1.VnsLDevVip import VnsLDevVip
+        from ZenPacks.zenoss.ZPLTest1.VnsCDev import VnsCDev
+
+        device_class = self.dmd.Devices.createOrganizer(DEVICE_CLASS)
+        device_class.setZenProperty(
+            'zPythonClass', 'ZenPacks.zenoss.ZPLTest1.APIC')
+
+        device = device_class.createInstance('apic1')
+        device.fvTenants._setObject('tenant1', FvTenant('tenant1'))
+        tenant = device.fvTenants._getOb('tenant1')
+        tenant.vnsLDevVips._setObject('ldev1', VnsLDevVip('ldev1'))
+        ldev = tenant.vnsLDevVips._getOb('ldev1')
+
+        cdev = VnsCDev('cdev1')
+        cdev.cmgmt_host = '10.0.0.1'
+        ldev.vnsCDevs._setObject('cdev1', cdev)
+
+        return ldev.vnsCDevs._getOb('cdev1')
+
+    def zenpack(self):
+        """Return ZPLTest1 ZenPack instance in context."""
+        from ZenPacks.zenoss.ZPLTest1 import ZenPack
+
+        zenpack = ZenPack(self.zenpack_module_name)
+        return zenpack.__of__(self.dmd.ZenPackManager.packs)
+
+    def assert_indexed(self, cdev):
+        """Assert that cdev is in its device's catalog."""
+        catalog = getattr(cdev.device(), CATALOG, None)
+        self.assertIsNotNone(catalog, "{} wasn't created".format(CATALOG))
+
+        results = catalog(cmgmt_host='10.0.0.1')
+        self.assertEquals(
+            [x.getPath() for x in results],
+            ['/'.join(cdev.getPrimaryPath())])
+
+    def test_add(self):
+        """Assert that adding a component creates its catalog."""
+        cdev = self.create_cdev()
+        self.assert_indexed(cdev)
+
+    def test_index_missing(self):
+        """Assert that indexing creates a missing catalog."""
+        cdev = self.create_cdev()
+        cdev.device()._delObject(CATALOG)
+
+        cdev.index_object()
+        self.assert_indexed(cdev)
+
+    def test_sync_creates(self):
+        """Assert that _sync_catalogs creates catalogs up front."""
+        cdev = self.create_cdev()
+        cdev.device()._delObject(CATALOG)
+
+        self.zenpack()._sync_catalogs()
+        self.assert_indexed(cdev)
+
+    def test_iter_catalogs(self):
+        """Assert that device catalogs of devices with components are found."""
+        from ZenPacks.zenoss.ZPLTest1.VnsCDev import VnsCDev
+
+        device = self.create_cdev().device()
+        global_catalogs = []
+        device_catalogs = []
+        for klass, name, container, scope in self.zenpack()._iter_catalogs():
+            if aq_base(container) is aq_base(self.dmd.Devices):
+                global_catalogs.append((klass.__name__, name, scope))
+            elif aq_base(container) is aq_base(device):
+                device_catalogs.append((name, scope))
+
+        self.assertIn(('VnsCDev', 'VnsCDev', 'global'), global_catalogs)
+
+        for name in VnsCDev._catalogs:
+            self.assertIn((name, 'device'), device_catalogs)
+
+        # Each device catalog is only synced once.
+        self.assertEquals(len(device_catalogs), len(set(device_catalogs)))
+
+        # FabricPod has no catalog of its own, and there's no leftover
+        # FabricPodSearch catalog to remove.
+        self.assertNotIn(('FabricPod', 'device'), device_catalogs)
+
+    def test_sync_changed(self):
+        """Assert that a missing index is planned, added and reindexed."""
+        from ZenPacks.zenoss.ZPLTest1.VnsCDev import VnsCDev
+
+        cdev = self.create_cdev()
+        device = cdev.device()
+        device._getOb(CATALOG)._catalog.delIndex('cmgmt_host')
+
+        zenpack = self.zenpack()
+        change, _ = zenpack._plan_catalog(VnsCDev, 'VnsCDev', device, 'device')
+        self.assertTrue(change.startswith('update {}'.format(CATALOG)), change)
+        self.assertIn('cmgmt_host', change)
+
+        zenpack._sync_catalog(VnsCDev, 'VnsCDev', device, 'device')
+        self.assert_indexed(cdev)
+
+        change, _ = zenpack._plan_catalog(VnsCDev, 'VnsCDev', device, 'device')
+        self.assertIsNone(change)
+
+    def test_sync_missing(self):
+        """Assert that a missing catalog is planned and created."""
+        from ZenPacks.zenoss.ZPLTest1.VnsCDev import VnsCDev
+
+        cdev = self.create_cdev()
+        device = cdev.device()
+        device._delObject(CATALOG)
+
+        zenpack = self.zenpack()
+        change, _ = zenpack._plan_catalog(VnsCDev, 'VnsCDev', device, 'device')
+        self.assertTrue(change.startswith('create {}'.format(CATALOG)), change)
+
+        zenpack._sync_catalog(VnsCDev, 'VnsCDev', device, 'device')
+        self.assert_indexed(cdev)
+
+    def test_sync_obsolete(self):
+        """Assert that catalogs of classes without catalogs are removed."""
+        from ZenPacks.zenoss.ZPLTest1.FabricPod import FabricPod
+
+        device = self.create_cdev().device()
+        device.fabricPods._setObject('pod1', FabricPod('pod1'))
+
+        # Left over from a version where FabricPod had its own catalog.
+        manage_addZCatalog(device, 'FabricPodSearch', 'FabricPodSearch')
+
+        zenpack = self.zenpack()
+        device_catalogs = [
+            (klass, name, scope)
+            for klass, name, container, scope in zenpack._iter_catalogs()
+            if aq_base(container) is aq_base(device)]
+
+        self.assertIn((FabricPod, 'FabricPod', 'device'), device_catalogs)
+
+        change, _ = zenpack._plan_catalog(FabricPod, 'FabricPod', device, 'device')
+        self.assertTrue(change.startswith('remove FabricPodSearch'), change)
+
+        zenpack._sync_catalogs()
+        self.assertFalse(hasattr(aq_base(device), 'FabricPodSearch'))
+
+        # Catalogs that are still defined are kept.
+        self.assertTrue(hasattr(aq_base(device), CATALOG))
+
+
+def test_suite():
+    """Return test suite for this module."""
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestCatalogs))
+    return suite
+
+
+if __name__ == "__main__":
+    from zope.testrunner.runner import Runner
+    runner = Runner(found_suites=[test_suite()])
+    runner.run()
@@ -83,6 +83,19 @@ class TestCommands(BaseTestCase):
     def test_smoke_dump_templates(self):
         self._smoke_command("dump_templates", self.zenpack_name)
 
+    def test_smoke_dump_templates_workers(self):
+        self._smoke_command("dump_templates", "--workers=2", self.zenpack_name)
+
+    def test_smoke_dump_templates_options_first(self):
+        output = self._smoke_command(
+            "--workers=2", "dump_templates", self.zenpack_name)
+
+        self.assertNotIn("Usage:", output)
+
+    def test_smoke_dump_templates_all(self):
+        output = self._smoke_command("--all", "dump_templates")
+        self.assertNotIn("Usage:", output)
+
     def test_smoke_class_diagram(self):
         self._smoke_command("class_diagram yuml", self.yaml_path)
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2015, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Device class unit tests.
+
+This module tests creating device classes and setting their zProperties
+when the ZPLTest1 ZenPack is installed.
+
+"""
+
+import Globals
+from Products.ZenUtils.Utils import unused
+
+unused(Globals)
+
+import os
+import site
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+site.addsitedir(os.path.join(os.path.dirname(__file__), '..'))
+
+from ZenPacks.zenoss.ZPLTest1 import zenpacklib
+from ZenPacks.zenoss.ZPLTest1 import CFG
+
+# Required before zenpacklib.TestCase can be used.
+zenpacklib.enableTesting()
+
+
+DEVICE_CLASS = '/Network/ZPLTest1'
+
+
+class TestDeviceClasses(zenpacklib.TestCase):
+
+    """Test suite for applying device classes."""
+
+    zenpack_module_name = 'ZenPacks.zenoss.ZPLTest1'
+    zenpack_path = os.path.join(os.path.dirname(__file__),
+                                "data/zenpacks/ZenPacks.zenoss.ZPLTest1")
+    disableLogging = False
+
+    def afterSetUp(self):
+        try:
+            super(TestDeviceClasses, self).afterSetUp()
+        except ImportError, e:
+            self.assertFalse(
+                e.message == 'No module named ZPLTest1',
+                "ZPLTest1 zenpack is not installed.  You must install it before running this test:\n   zenpack --link --install=%s" % self.zenpack_path
+            )
+
+    def zenpack(self, zProperties):
+        """Return ZPLTest1 ZenPack setting zProperties on DEVICE_CLASS."""
+        from ZenPacks.zenoss.ZPLTest1 import ZenPack
+
+        zenpack = ZenPack(self.zenpack_module_name)
+        zenpack.device_classes = {
+            DEVICE_CLASS: zenpacklib.DeviceClassSpec(
+                CFG, DEVICE_CLASS, zProperties=zProperties),
+            }
+
+        return zenpack.__of__(self.dmd.ZenPackManager.packs)
+
+    def apply_device_classes(self, zProperties):
+        """Apply zProperties and return names of those that were set."""
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('zen.zenpacklib')
+        logger.addHandler(handler)
+        try:
+            self.zenpack(zProperties)._apply_device_classes()
+        finally:
+            logger.removeHandler(handler)
+
+        return sorted(
+            x.split()[2] for x in messages if x.startswith('Setting zProperty'))
+
+    def test_apply(self):
+        """Assert that only missing or changed zProperties are set."""
+        zProperties = {
+            'zPythonClass': 'ZenPacks.zenoss.ZPLTest1.APIC',
+            'zDeviceTemplates': ['APIC'],
+            }
+
+        self.assertEquals(
+            self.apply_device_classes(zProperties),
+            ['zDeviceTemplates', 'zPythonClass'])
+
+        organizer = self.dmd.Devices.getOrganizer(DEVICE_CLASS)
+        self.assertEquals(
+            organizer.getZ('zPythonClass'), 'ZenPacks.zenoss.ZPLTest1.APIC')
+
+        # Unchanged zProperties aren't written again.
+        self.assertEquals(self.apply_device_classes(zProperties), [])
+
+        zProperties['zDeviceTemplates'] = ['APIC', 'Health']
+        self.assertEquals(
+            self.apply_device_classes(zProperties), ['zDeviceTemplates'])
+
+        self.assertEquals(
+            list(organizer.getZ('zDeviceTemplates')), ['APIC', 'Health'])
+
+    def test_zproperty_is_set(self):
+        """Assert that only local zProperties with equal values are set."""
+        organizer = self.dmd.Devices.createOrganizer(DEVICE_CLASS)
+
+        # Acquired values don't count.
+        self.assertFalse(zenpacklib.zproperty_is_set(
+            organizer, 'zPythonClass', organizer.getZ('zPythonClass')))
+
+        organizer.setZenProperty('zPythonClass', 'ZenPacks.zenoss.ZPLTest1.APIC')
+        self.assertTrue(zenpacklib.zproperty_is_set(
+            organizer, 'zPythonClass', 'ZenPacks.zenoss.ZPLTest1.APIC'))
+        self.assertFalse(zenpacklib.zproperty_is_set(
+            organizer, 'zPythonClass', ''))
+
+        # Lists and tuples with the same items are equal.
+        organizer.setZenProperty('zDeviceTemplates', ['APIC'])
+        self.assertTrue(zenpacklib.zproperty_is_set(
+            organizer, 'zDeviceTemplates', ('APIC',)))
+        self.assertFalse(zenpacklib.zproperty_is_set(
+            organizer, 'zDeviceTemplates', ['APIC', 'Health']))
+
+
+def test_suite():
+    """Return test suite for this module."""
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestDeviceClasses))
+    return suite
+
+
+if __name__ == "__main__":
+    from zope.testrunner.runner import Runner
+    runner = Runner(found_suites=[test_suite()])
+    runner.run()
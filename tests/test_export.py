@@ -13,6 +13,7 @@ import logging
 import os
 import site
 import unittest
+from cStringIO import StringIO
 import Globals
 from Products.ZenUtils.Utils import unused
 
@@ -39,6 +40,37 @@ def load_cfg_dict(filename, zenpack_name):
     return CFG
 
 
+def shared_templates_cfg(**shared_kwargs):
+    """Return config dict with a template shared by two device classes."""
+    cfg = {
+        'name': 'SharedTemplates',
+        'device_classes': {
+            '/Server/Shared': {
+                'templates': {
+                    'Base': {
+                        'datasources': {
+                            'status': {
+                                'type': 'COMMAND',
+                                'commandTemplate': 'echo OK',
+                                'datapoints': {'value': 'GAUGE'},
+                                },
+                            },
+                        },
+                    },
+                },
+            '/Server/Shared/Linux': {
+                'shared_templates': ['/Server/Shared/Base'],
+                'templates': {
+                    'Linux': {'description': 'Linux monitoring.'},
+                    },
+                },
+            },
+        }
+
+    cfg['device_classes']['/Server/Shared/Linux'].update(shared_kwargs)
+    return cfg
+
+
 def dummy_zenpack_path(zenpack_name):
     return "/tmp"
 
@@ -138,10 +170,117 @@ class TestYAML(unittest.TestCase):
             "Compare original params from %s with result of export to and reimport from YAML (ZenPackSpec)" % filename)
 
 
+class TestSharedTemplates(unittest.TestCase):
+    disableLogging = False
+    maxDiff = None
+
+    def test_bound(self):
+        cfg = shared_templates_cfg()
+        for spec in (
+                zenpacklib.ZenPackSpecParams(**shared_templates_cfg()),
+                zenpacklib.ZenPackSpec(**cfg)):
+            base = spec.device_classes['/Server/Shared'].templates['Base']
+            linux = spec.device_classes['/Server/Shared/Linux']
+
+            self.assertEqual(sorted(linux.templates), ['Base', 'Linux'])
+            self.assertIs(linux.templates['Base'], base)
+
+    def test_yaml_roundtrip(self):
+        specparams = zenpacklib.ZenPackSpecParams(**shared_templates_cfg())
+        exported_yaml = yaml.dump(specparams, Dumper=zenpacklib.Dumper)
+        LOG.debug(exported_yaml)
+
+        # The shared template is only written where it's defined.
+        self.assertEqual(exported_yaml.count('commandTemplate'), 1)
+        self.assertIn('/Server/Shared/Base', exported_yaml)
+
+        reloaded_spec = yaml.load(exported_yaml, Loader=zenpacklib.Loader)
+        original_spec = zenpacklib.ZenPackSpec(**shared_templates_cfg())
+
+        self.assertEqual(original_spec, reloaded_spec)
+
+        linux = reloaded_spec.device_classes['/Server/Shared/Linux']
+        self.assertEqual(linux.shared_templates, ['/Server/Shared/Base'])
+        self.assertIs(
+            linux.templates['Base'],
+            reloaded_spec.device_classes['/Server/Shared'].templates['Base'])
+
+    def test_undefined(self):
+        cfg = shared_templates_cfg(shared_templates=['/Server/Shared/Missing'])
+        self.assertRaises(ValueError, zenpacklib.ZenPackSpecParams, **cfg)
+
+        cfg = shared_templates_cfg(shared_templates=['/Server/Missing/Base'])
+        self.assertRaises(ValueError, zenpacklib.ZenPackSpec, **cfg)
+
+    def test_defined_and_shared(self):
+        cfg = shared_templates_cfg()
+        cfg['device_classes']['/Server/Shared/Linux']['templates']['Base'] = {}
+        self.assertRaises(ValueError, zenpacklib.ZenPackSpec, **cfg)
+
+
+def aliased_templates_cfg():
+    """Return config dict with templates that each share a list."""
+    def template(name):
+        shared = ['1.3.6.1.2.1.1.3.0', name]
+        return {
+            'datasources': {
+                x: {
+                    'type': 'COMMAND',
+                    'commandTemplate': 'echo OK',
+                    'extra_params': {'oids': shared},
+                    'datapoints': {'value': 'GAUGE'},
+                    }
+                for x in ('first', 'second')},
+            }
+
+    return {
+        'name': 'AliasedTemplates',
+        'device_classes': {
+            '/Server/Aliased': {
+                'templates': {
+                    'Device': template('Device'),
+                    'Interface': template('Interface'),
+                    },
+                },
+            },
+        }
+
+
+class TestStreamYAML(unittest.TestCase):
+    disableLogging = False
+    maxDiff = None
+
+    def assert_same_output(self, specparams):
+        expected = yaml.dump(specparams, Dumper=zenpacklib.Dumper)
+
+        stream = StringIO()
+        zenpacklib.stream_yaml(specparams, stream)
+
+        self.assertEqual(stream.getvalue(), expected)
+        return expected
+
+    def test_same_output_hp_proliant1(self):
+        cfg = load_cfg_dict('hp_proliant1.py', 'HPProliant')
+        self.assert_same_output(zenpacklib.ZenPackSpecParams(**cfg))
+
+    def test_aliases(self):
+        output = self.assert_same_output(
+            zenpacklib.ZenPackSpecParams(**aliased_templates_cfg()))
+
+        LOG.debug(output)
+
+        # Each template's shared list is an anchor and an alias.
+        for anchor in ('id001', 'id002'):
+            self.assertEqual(output.count('&{}'.format(anchor)), 1)
+            self.assertEqual(output.count('*{}'.format(anchor)), 1)
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestYAML))
+    suite.addTest(makeSuite(TestSharedTemplates))
+    suite.addTest(makeSuite(TestStreamYAML))
     return suite
 
 
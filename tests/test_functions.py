@@ -16,12 +16,24 @@ This module tests "public" zenpacklib functions.
 """
 
 # stdlib Imports
+import collections
+import logging
 import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import site
 
 # Zenoss Imports
 import Globals
+import transaction
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+from Products.ZCatalog.ZCatalog import ZCatalog
+from Products.ZenUtils.Search import makeFieldIndex
 from Products.ZenUtils.Utils import unused
 
 unused(Globals)
@@ -78,11 +90,907 @@ class TestFunctions(unittest.TestCase):
         self.assertEquals(classes, expected_classes)
 
 
+class TestContentHash(unittest.TestCase):
+
+    """Spec content hash test suite."""
+
+    def threshold(self, **kwargs):
+        params = {
+            'dsnames': ['health_cur'],
+            'eventClass': '/Status',
+            'severity': 4,
+            'extra_params': collections.OrderedDict((
+                ('minval', '75'),
+                ('maxval', '100'),
+                )),
+            }
+
+        params.update(kwargs)
+        return zenpacklib.RRDThresholdSpecParams(None, 'low', **params)
+
+    def test_equal(self):
+        """Test that equal specs have equal hashes."""
+        a = self.threshold()
+        b = self.threshold(
+            extra_params=collections.OrderedDict((
+                ('maxval', '100'),
+                ('minval', '75'),
+                )))
+
+        self.assertEquals(a.content_hash, b.content_hash)
+        self.assertEquals(a, b)
+
+    def test_not_equal(self):
+        """Test that specs with different parameters differ."""
+        a = self.threshold()
+        for kwargs in (
+                {'severity': 5},
+                {'dsnames': ['health_max']},
+                {'extra_params': {'minval': '75'}}):
+            b = self.threshold(**kwargs)
+            self.assertNotEquals(a.content_hash, b.content_hash, kwargs)
+            self.assertNotEquals(a, b, kwargs)
+
+    def test_type(self):
+        """Test that specs of different types differ."""
+        threshold = self.threshold()
+        datapoint = zenpacklib.RRDDatapointSpecParams(None, 'low')
+
+        self.assertNotEquals(threshold.content_hash, datapoint.content_hash)
+        self.assertNotEquals(threshold, datapoint)
+
+    def test_changed(self):
+        """Test that specs changed after being compared are compared again."""
+        a = self.threshold()
+        b = self.threshold()
+        self.assertEquals(a, b)
+
+        b.severity = 5
+        self.assertNotEquals(a, b)
+
+        b.severity = 4
+        self.assertEquals(a, b)
+
+    def test_changed_nested(self):
+        """Test that changes to contained specs are compared."""
+        def template():
+            return zenpacklib.RRDTemplateSpecParams(
+                None, 'Health', thresholds={
+                    'low': {'dsnames': ['health_cur'], 'severity': 4}})
+
+        a = template()
+        b = template()
+        self.assertEquals(a, b)
+
+        b.thresholds['low'].severity = 5
+        self.assertNotEquals(a, b)
+
+    def test_changed_in_place(self):
+        """Test that in-place changes are compared once invalidated."""
+        a = self.threshold()
+        b = self.threshold()
+        self.assertEquals(a, b)
+
+        b.dsnames.append('health_max')
+        zenpacklib.Spec.invalidate_content_hashes()
+        self.assertNotEquals(a, b)
+
+
+class CatalogItem(object):
+
+    """Minimal object that can be indexed in a ZCatalog."""
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class TestCatalogQueryCache(unittest.TestCase):
+
+    """catalog_search query cache test suite."""
+
+    def setUp(self):
+        self.catalog = ZCatalog('testCatalog')
+        self.catalog._catalog.addIndex('name', makeFieldIndex('name'))
+        self.catalog.catalog_object(CatalogItem('a', 'alpha'), 'a')
+        self.catalog.catalog_object(CatalogItem('b', 'beta'), 'b')
+        zenpacklib.enable_catalog_query_cache()
+
+    def tearDown(self):
+        zenpacklib.enable_catalog_query_cache(False)
+
+    def test_hit(self):
+        """Test that a repeated query is answered from the cache."""
+        first = zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+        second = zenpacklib.search_catalog(self.catalog, name='alpha')
+
+        self.assertIs(first, second)
+        self.assertEquals([x.getPath() for x in first], ['a'])
+
+        stats = zenpacklib.catalog_query_cache_stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 1)
+
+    def test_invalidate(self):
+        """Test that invalidating a catalog discards its cached results."""
+        first = zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+        zenpacklib.CATALOG_QUERY_CACHE.invalidate(self.catalog)
+        second = zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+
+        self.assertIsNot(first, second)
+
+        stats = zenpacklib.catalog_query_cache_stats()
+        self.assertEquals(stats['hits'], 0)
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['invalidations'], 1)
+
+    def test_disabled(self):
+        """Test that nothing is cached while the cache is disabled."""
+        zenpacklib.enable_catalog_query_cache(False)
+        first = zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+        second = zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+
+        self.assertIsNot(first, second)
+        self.assertEquals(zenpacklib.catalog_query_cache_stats()['misses'], 0)
+
+    def test_direct_write(self):
+        """Test that catalog writes outside index_object are seen."""
+        first = zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+        self.assertEquals(len(first), 1)
+
+        self.catalog.uncatalog_object('a')
+        zenpacklib.invalidate_catalog_query_cache(self.catalog)
+        self.assertEquals(
+            len(zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})), 0)
+
+    def test_reindex(self):
+        """Test that reindexing a catalog discards its cached results."""
+        first = zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+        self.assertEquals(len(first), 1)
+
+        # The items can't be resolved, so reindexing uncatalogs them.
+        zenpacklib.CatalogBase._reindex_catalog(self.catalog, ['name'])
+        self.assertEquals(
+            len(zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})), 0)
+
+    def test_threads(self):
+        """Test that statistics are counted from every thread."""
+        def search():
+            for i in range(100):
+                zenpacklib.search_catalog(self.catalog, {'name': 'alpha'})
+
+        threads = [threading.Thread(target=search) for i in range(4)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        stats = zenpacklib.catalog_query_cache_stats()
+        self.assertEquals(stats['hits'] + stats['misses'], 400)
+        self.assertEquals(stats['misses'], 4)
+
+
+class TestCatalogIndexes(unittest.TestCase):
+
+    """Catalog index type test suite."""
+
+    spec = {
+        'indexes': {
+            'name': {'type': 'field'},
+            'tags': {'type': 'keyword'},
+            'enabled': {'type': 'boolean'},
+            'path': {'type': 'path'},
+            'modified': {'type': 'date'},
+            'name_tags': {'type': 'composite', 'fields': ['name', 'tags']},
+            },
+        }
+
+    def setUp(self):
+        self.catalog = ZCatalog('testCatalog')
+
+    def test_index_factories(self):
+        """Test that each index type creates the expected index."""
+        expected_meta_types = {
+            'field': 'FieldIndex',
+            'keyword': 'KeywordIndex',
+            'path': 'PathIndex',
+            'date': 'DateIndex',
+            'composite': 'FieldIndex',
+            }
+
+        for index_type, meta_type in expected_meta_types.items():
+            factory = zenpacklib.CatalogBase._get_index_factory(index_type)
+            index = factory('test', {'fields': ['a', 'b']})
+            self.assertEquals(index.meta_type, meta_type)
+
+        # BooleanIndex falls back to FieldIndex before Zope 2.13.
+        factory = zenpacklib.CatalogBase._get_index_factory('boolean')
+        self.assertIn(factory('test', {}).meta_type, ('BooleanIndex', 'FieldIndex'))
+
+        self.assertIsNone(zenpacklib.CatalogBase._get_index_factory('bogus'))
+
+    def test_composite_fields(self):
+        """Test that composite indexes record their fields."""
+        factory = zenpacklib.CatalogBase._get_index_factory('composite')
+        index = factory('name_tags', {'fields': ['name', 'tags']})
+
+        self.assertEquals(
+            zenpacklib.get_composite_fields(index), ('name', 'tags'))
+
+        self.assertIsNone(
+            zenpacklib.get_composite_fields(
+                zenpacklib.CatalogBase._get_index_factory('field')('name', {})))
+
+    def test_diff_new_catalog(self):
+        """Test that every index and column is added to an empty catalog."""
+        wanted, removed_indexes, removed_columns, changed, new_columns = \
+            zenpacklib.CatalogBase._diff_indexes(self.catalog, self.spec)
+
+        self.assertEquals(set(wanted), set(self.spec['indexes']))
+        self.assertEquals(removed_indexes, [])
+        self.assertEquals(removed_columns, [])
+        self.assertEquals(set(changed), set(self.spec['indexes']))
+        self.assertEquals(set(new_columns), set(self.spec['indexes']))
+
+    def test_diff_synced_catalog(self):
+        """Test that a catalog matching its spec needs no changes."""
+        zenpacklib.CatalogBase._sync_indexes(self.catalog, self.spec)
+        diff = zenpacklib.CatalogBase._diff_indexes(self.catalog, self.spec)
+
+        self.assertEquals(diff[1:], ([], [], [], []))
+
+    def test_diff_changed_catalog(self):
+        """Test that changed and removed indexes are detected."""
+        zenpacklib.CatalogBase._sync_indexes(self.catalog, self.spec)
+
+        spec = {
+            'indexes': {
+                'name': {'type': 'keyword'},
+                'tags': {'type': 'keyword'},
+                'enabled': {'type': 'boolean'},
+                'path': {'type': 'path'},
+                'name_tags': {'type': 'composite', 'fields': ['tags', 'name']},
+                },
+            }
+
+        wanted, removed_indexes, removed_columns, changed, new_columns = \
+            zenpacklib.CatalogBase._diff_indexes(self.catalog, spec)
+
+        self.assertEquals(removed_indexes, ['modified'])
+        self.assertEquals(removed_columns, ['modified'])
+        self.assertEquals(sorted(changed), ['name', 'name_tags'])
+        self.assertEquals(new_columns, [])
+
+    def test_diff_invalid_spec(self):
+        """Test that invalid specs are rejected."""
+        for indexes in (
+                {'name': {}},
+                {'name': {'type': 'bogus'}},
+                {'name': {'type': 'composite'}}):
+            self.assertIsNone(
+                zenpacklib.CatalogBase._diff_indexes(
+                    self.catalog, {'indexes': indexes}))
+
+
+class StatsCatalog(object):
+
+    """Minimal object standing in for a catalog whose calls are recorded."""
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TestCatalogStats(unittest.TestCase):
+
+    """CatalogStats test suite."""
+
+    def setUp(self):
+        self.stats = zenpacklib.CatalogStats()
+        self.stats.recording = True
+        self.stats.slow_threshold = None
+        self.catalog = StatsCatalog('testCatalog')
+
+    def test_record(self):
+        """Test that counts, times and result sizes are recorded."""
+        self.stats.record(self.catalog, 'search', 0.002, results=3)
+        self.stats.record(self.catalog, 'search', 0.004, results=5)
+        self.stats.record(self.catalog, 'index', 0.001)
+
+        stats = self.stats.stats()
+        self.assertEquals(sorted(stats), ['testCatalog'])
+        self.assertEquals(sorted(stats['testCatalog']), ['index', 'search'])
+
+        search = stats['testCatalog']['search']
+        self.assertEquals(search['count'], 2)
+        self.assertAlmostEquals(search['time'], 6.0)
+        self.assertAlmostEquals(search['max_time'], 4.0)
+        self.assertEquals(search['results'], 8)
+
+        index = stats['testCatalog']['index']
+        self.assertEquals(index['count'], 1)
+        self.assertEquals(index['results'], 0)
+
+        # stats() is a copy.
+        search['count'] = 100
+        self.assertEquals(self.stats.stats()['testCatalog']['search']['count'], 2)
+
+    def test_not_recording(self):
+        """Test that nothing is recorded while recording is disabled."""
+        self.stats.recording = False
+        self.stats.record(self.catalog, 'search', 0.002, results=3)
+        self.assertEquals(self.stats.stats(), {})
+
+    def test_histogram(self):
+        """Test that calls are counted in the right latency buckets."""
+        buckets = zenpacklib.CatalogStats.buckets
+
+        # Each bucket's upper bound, between two buckets, and slower
+        # than the last bucket.
+        for ms in buckets + (3, buckets[-1] + 1):
+            self.stats.record(self.catalog, 'search', ms / 1000.0)
+
+        histogram = self.stats.stats()['testCatalog']['search']['histogram']
+        self.assertEquals(len(histogram), len(buckets) + 1)
+
+        expected = [1] * len(buckets) + [1]
+        expected[buckets.index(5)] += 1
+        self.assertEquals(histogram, expected)
+
+    def test_merge(self):
+        """Test that stats from several processes are combined."""
+        first = zenpacklib.CatalogStats()
+        first.recording = True
+        first.record(self.catalog, 'search', 0.002, results=3)
+
+        second = zenpacklib.CatalogStats()
+        second.recording = True
+        second.record(self.catalog, 'search', 0.2, results=1)
+        second.record(StatsCatalog('otherCatalog'), 'index', 0.001)
+
+        merged = zenpacklib.merge_catalog_stats(
+            [first.stats(), second.stats()])
+
+        self.assertEquals(sorted(merged), ['otherCatalog', 'testCatalog'])
+
+        search = merged['testCatalog']['search']
+        self.assertEquals(search['count'], 2)
+        self.assertAlmostEquals(search['time'], 202.0)
+        self.assertAlmostEquals(search['max_time'], 200.0)
+        self.assertEquals(search['results'], 4)
+        self.assertEquals(sum(search['histogram']), 2)
+
+        self.assertEquals(merged['otherCatalog']['index']['count'], 1)
+
+        # The merged stats don't share data with their sources.
+        self.assertEquals(first.stats()['testCatalog']['search']['count'], 1)
+
+    def test_save(self):
+        """Test that stats are saved as JSON for the catalog_stats command."""
+        import json
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.stats.record(self.catalog, 'search', 0.002, results=3)
+            self.stats.save(directory)
+
+            filenames = os.listdir(directory)
+            self.assertEquals(len(filenames), 1)
+
+            with open(os.path.join(directory, filenames[0]), 'r') as f:
+                data = json.load(f)
+
+            self.assertEquals(data['buckets'], list(self.stats.buckets))
+            self.assertEquals(data['catalogs'], self.stats.stats())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_slow_query(self):
+        """Test that slow calls are logged with their query and caller."""
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('zen.zenpacklib')
+        logger.addHandler(handler)
+
+        self.stats.recording = False
+        self.stats.slow_threshold = 100
+        self.assertTrue(self.stats.enabled)
+
+        try:
+            self.stats.record(
+                self.catalog, 'search', 0.05, query={'name': 'fast'},
+                caller=sys._getframe(0))
+
+            self.stats.record(
+                self.catalog, 'search', 0.15, query={'name': 'slow'},
+                caller=sys._getframe(0))
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEquals(len(messages), 1)
+        self.assertIn('testCatalog', messages[0])
+        self.assertIn("'slow'", messages[0])
+        self.assertIn('test_slow_query', messages[0])
+
+        # Slow calls are logged without being recorded.
+        self.assertEquals(self.stats.stats(), {})
+
+    def test_reset(self):
+        """Test that enable_catalog_stats records and reset discards."""
+        zenpacklib.reset_catalog_stats()
+        zenpacklib.enable_catalog_stats()
+        try:
+            zenpacklib.CATALOG_STATS.record(self.catalog, 'search', 0.001)
+            self.assertIn('testCatalog', zenpacklib.catalog_stats())
+
+            zenpacklib.reset_catalog_stats()
+            self.assertEquals(zenpacklib.catalog_stats(), {})
+        finally:
+            zenpacklib.enable_catalog_stats(False)
+            zenpacklib.reset_catalog_stats()
+
+
+class CommitRecorder(object):
+
+    """Data manager that records when its transaction commits or aborts."""
+
+    def __init__(self):
+        self.commits = 0
+        self.aborts = 0
+
+    def abort(self, txn):
+        self.aborts += 1
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        self.commits += 1
+
+    def tpc_abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'CommitRecorder'
+
+
+class TestProcessInChunks(unittest.TestCase):
+
+    """process_in_chunks test suite."""
+
+    def setUp(self):
+        transaction.abort()
+        self.recorder = CommitRecorder()
+        transaction.get().join(self.recorder)
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_savepoints(self):
+        """Test that chunks are processed without committing."""
+        processed = []
+        zenpacklib.process_in_chunks(
+            range(10), processed.append, 'Testing', chunk_size=3)
+
+        self.assertEquals(processed, range(10))
+        self.assertEquals(self.recorder.commits, 0)
+        self.assertEquals(self.recorder.aborts, 0)
+
+        transaction.abort()
+        self.assertEquals(self.recorder.aborts, 1)
+
+    def test_savepoints_conflict(self):
+        """Test that conflicts aren't retried without committing."""
+        def process(item):
+            raise ConflictError()
+
+        self.assertRaises(
+            ConflictError,
+            zenpacklib.process_in_chunks,
+            range(10), process, 'Testing', chunk_size=3)
+
+        self.assertEquals(self.recorder.commits, 0)
+        self.assertEquals(self.recorder.aborts, 0)
+
+    def test_commit(self):
+        """Test that chunks are committed and conflicts retried."""
+        conflicts = set([4])
+        processed = []
+
+        def process(item):
+            if item in conflicts:
+                conflicts.discard(item)
+                raise ConflictError()
+
+            processed.append(item)
+
+        zenpacklib.process_in_chunks(
+            range(10), process, 'Testing', chunk_size=3, commit=True)
+
+        # The chunk with the conflict is processed again.
+        self.assertEquals(processed, [0, 1, 2, 3, 3, 4, 5, 6, 7, 8, 9])
+
+        # Pending changes are committed with the first chunk.
+        self.assertEquals(self.recorder.commits, 1)
+
+
+def diff_cfg():
+    """Return config dict for diff_zenpack_specs tests."""
+    return {
+        'name': 'ZenPacks.test.Diff',
+        'zProperties': {
+            'zDiffPort': {'type': 'int', 'default': 443},
+            },
+        'class_relationships': zenpacklib.relationships_from_yuml(
+            "[DiffDevice]++-[DiffComponent]"),
+        'classes': {
+            'DiffDevice': {
+                'base': ['zenpacklib.Device'],
+                },
+            'DiffComponent': {
+                'base': ['zenpacklib.Component'],
+                'label': 'Component',
+                'properties': {
+                    'port': {'type': 'int'},
+                    'host': {'label': 'Host', 'index_type': 'field'},
+                    },
+                'relationships': {
+                    'diffDevice': {'label': 'Device'},
+                    },
+                },
+            },
+        'device_classes': {
+            '/Server/Diff': {
+                'zProperties': {'zDiffPort': 443},
+                'templates': {
+                    'DiffDevice': {'description': 'Device monitoring.'},
+                    'DiffComponent': {'description': 'Component monitoring.'},
+                    },
+                },
+            },
+        }
+
+
+class TestDiffZenPackSpecs(unittest.TestCase):
+
+    """diff_zenpack_specs test suite."""
+
+    def diff(self, new_cfg):
+        """Return changes from diff_cfg() to new_cfg, without empty ones."""
+        changes = zenpacklib.diff_zenpack_specs(
+            zenpacklib.ZenPackSpecParams(**diff_cfg()),
+            zenpacklib.ZenPackSpecParams(**new_cfg))
+
+        return {
+            category: {kind: names for kind, names in change.items() if names}
+            for category, change in changes.items() if any(change.values())}
+
+    def test_unchanged(self):
+        """Test that identical specs have no changes."""
+        self.assertEquals(self.diff(diff_cfg()), {})
+
+    def test_classes(self):
+        """Test added, removed and changed classes."""
+        cfg = diff_cfg()
+        cfg['classes']['DiffFan'] = {'base': ['zenpacklib.Component']}
+        del cfg['classes']['DiffDevice']
+        cfg['classes']['DiffComponent']['label'] = 'Diff Component'
+
+        self.assertEquals(self.diff(cfg), {
+            'classes': {
+                'added': ['DiffFan'],
+                'removed': ['DiffDevice'],
+                'changed': ['DiffComponent'],
+                },
+            })
+
+    def test_properties(self):
+        """Test added, removed and changed properties and indexes."""
+        cfg = diff_cfg()
+        properties = cfg['classes']['DiffComponent']['properties']
+        properties['vlan'] = {'type': 'int', 'index_type': 'field'}
+        del properties['port']
+        properties['host']['label'] = 'Hostname'
+
+        changes = self.diff(cfg)
+        self.assertEquals(changes['properties'], {
+            'added': ['DiffComponent.vlan'],
+            'removed': ['DiffComponent.port'],
+            'changed': ['DiffComponent.host'],
+            })
+
+        # The host index didn't change, only its property's label.
+        self.assertEquals(changes['catalog_indexes'], {
+            'added': ['DiffComponent.vlan'],
+            })
+
+        self.assertEquals(changes['classes'], {'changed': ['DiffComponent']})
+
+    def test_relationships(self):
+        """Test added and changed class relationships."""
+        cfg = diff_cfg()
+        cfg['class_relationships'] = zenpacklib.relationships_from_yuml((
+            "[DiffDevice]1-.-*[DiffComponent]",
+            "[DiffDevice]++-[DiffFan]",
+            ))
+
+        cfg['classes']['DiffComponent']['relationships']['diffDevice']['label'] = 'Host'
+
+        changes = self.diff(cfg)
+        self.assertEquals(changes['class_relationships'], {
+            'added': ['DiffDevice(diffFans) - (diffDevice)DiffFan'],
+            'changed': ['DiffDevice(diffComponents) - (diffDevice)DiffComponent'],
+            })
+
+        self.assertEquals(changes['relationships'], {
+            'changed': ['DiffComponent.diffDevice'],
+            })
+
+    def test_relationships_removed(self):
+        """Test removed class relationships."""
+        cfg = diff_cfg()
+        cfg['class_relationships'] = []
+        del cfg['classes']['DiffComponent']['relationships']
+
+        changes = self.diff(cfg)
+        self.assertEquals(changes['class_relationships'], {
+            'removed': ['DiffDevice(diffComponents) - (diffDevice)DiffComponent'],
+            })
+
+        self.assertEquals(changes['relationships'], {
+            'removed': ['DiffComponent.diffDevice'],
+            })
+
+    def test_templates(self):
+        """Test added, removed and changed templates and device classes."""
+        cfg = diff_cfg()
+        device_class = cfg['device_classes']['/Server/Diff']
+        device_class['zProperties']['zDiffPort'] = 8443
+        device_class['templates']['DiffFan'] = {'description': 'Fan monitoring.'}
+        del device_class['templates']['DiffDevice']
+        device_class['templates']['DiffComponent']['description'] = 'Changed.'
+
+        self.assertEquals(self.diff(cfg), {
+            'device_classes': {
+                'changed': ['/Server/Diff'],
+                },
+            'templates': {
+                'added': ['/Server/Diff/DiffFan'],
+                'removed': ['/Server/Diff/DiffDevice'],
+                'changed': ['/Server/Diff/DiffComponent'],
+                },
+            })
+
+
+class MapsThreshold(object):
+
+    """Minimal threshold that can be graphed on some graphs."""
+
+    def __init__(self, id, dsnames, graph_ids=None):
+        self.id = id
+        self.dsnames = dsnames
+        self.graph_ids = graph_ids
+        self.can_graph_calls = 0
+
+    def canGraph(self, graph):
+        self.can_graph_calls += 1
+        return self.graph_ids is None or graph.id in self.graph_ids
+
+
+class MapsGraph(object):
+
+    """Minimal graph recording the thresholds added to it."""
+
+    def __init__(self, id):
+        self.id = id
+        self.added = []
+
+    def manage_addThresholdGraphPoints(self, threshold_ids):
+        self.added.extend(threshold_ids)
+
+
+class TestTemplateGraphMaps(unittest.TestCase):
+
+    """TemplateGraphMaps test suite."""
+
+    def setUp(self):
+        self.thresholds = [
+            MapsThreshold('low', ['ds_avg']),
+            MapsThreshold('high', ['ds_avg', 'ds_max']),
+            MapsThreshold('other', ['ds_min'], graph_ids=['Minimum']),
+            MapsThreshold('unused', None),
+            ]
+
+        self.maps = zenpacklib.TemplateGraphMaps(self.thresholds)
+
+    def test_threshold_dpnames(self):
+        """Test that datapoint names of thresholds are combined."""
+        self.assertEquals(
+            self.maps.threshold_dpnames(['low', 'high']),
+            set(['ds_avg', 'ds_max']))
+
+        self.assertEquals(
+            self.maps.threshold_dpnames(['unused', 'missing']), set())
+
+    def test_threshold_ids(self):
+        """Test that only thresholds graphable on the graph are found."""
+        health = MapsGraph('Health')
+        minimum = MapsGraph('Minimum')
+
+        self.assertEquals(
+            self.maps.threshold_ids(['ds_avg', 'ds_min'], health),
+            set(['low', 'high']))
+
+        self.assertEquals(
+            self.maps.threshold_ids(['ds_avg', 'ds_min'], minimum),
+            set(['low', 'high', 'other']))
+
+    def test_graphable_cached(self):
+        """Test that canGraph is only called once per threshold and graph."""
+        health = MapsGraph('Health')
+        for dpname in ('ds_avg', 'ds_max', 'ds_min'):
+            self.maps.threshold_ids([dpname], health)
+
+        self.assertEquals(
+            [x.can_graph_calls for x in self.thresholds], [1, 1, 1, 1])
+
+        self.maps.threshold_ids(['ds_avg'], MapsGraph('Minimum'))
+        self.assertEquals(
+            [x.can_graph_calls for x in self.thresholds], [2, 2, 2, 2])
+
+    def test_add_threshold_graphpoints(self):
+        """Test that each threshold is graphed once in thresholds order."""
+        graph = MapsGraph('Health')
+        graphed = set(['low'])
+
+        self.maps.add_threshold_graphpoints(graph, 'ds_avg', graphed)
+        self.maps.add_threshold_graphpoints(graph, 'ds_max', graphed)
+        self.maps.add_threshold_graphpoints(graph, 'ds_min', graphed)
+
+        self.assertEquals(graph.added, ['high'])
+        self.assertEquals(graphed, set(['low', 'high']))
+
+        graph = MapsGraph('Minimum')
+        graphed = set()
+        for dpname in ('ds_min', 'ds_max', 'ds_avg'):
+            self.maps.add_threshold_graphpoints(graph, dpname, graphed)
+
+        self.assertEquals(graph.added, ['other', 'high', 'low'])
+
+
+class ProfiledObject(Persistent):
+
+    """Minimal persistent object whose creation is profiled."""
+
+    def __init__(self, path, data=''):
+        self.path = path
+        self.data = data
+
+    def getPrimaryPath(self):
+        return tuple(self.path.split('/'))
+
+
+class TestTemplateProfile(unittest.TestCase):
+
+    """TemplateProfile test suite."""
+
+    def setUp(self):
+        self.environ = os.environ.pop('ZPL_TEMPLATE_PROFILE', None)
+        self.profile = zenpacklib.TemplateProfile()
+
+    def tearDown(self):
+        if self.environ is not None:
+            os.environ['ZPL_TEMPLATE_PROFILE'] = self.environ
+
+    def record(self, kind, path, elapsed, data=''):
+        """Record creation of a new object that took elapsed seconds."""
+        self.profile.record(
+            kind, ProfiledObject(path, data), time.time() - elapsed)
+
+    def test_disabled(self):
+        """Test that nothing is recorded unless enabled."""
+        start = self.profile.start()
+        self.assertIsNone(start)
+
+        self.profile.record('template', ProfiledObject('/t'), start)
+        self.assertEquals(self.profile.entries, [])
+        self.assertEquals(self.profile.totals, {})
+
+    def test_environ(self):
+        """Test that ZPL_TEMPLATE_PROFILE enables recording."""
+        os.environ['ZPL_TEMPLATE_PROFILE'] = 'yes'
+        try:
+            profile = zenpacklib.TemplateProfile()
+            self.assertTrue(profile.enabled)
+            self.assertEquals(profile.limit, profile.default_limit)
+
+            os.environ['ZPL_TEMPLATE_PROFILE'] = '5'
+            profile = zenpacklib.TemplateProfile()
+            self.assertTrue(profile.enabled)
+            self.assertEquals(profile.limit, 5)
+        finally:
+            del os.environ['ZPL_TEMPLATE_PROFILE']
+
+    def test_record(self):
+        """Test that time, objects and sizes are recorded and totalled."""
+        self.profile.enable()
+        self.assertIsNotNone(self.profile.start())
+
+        self.record('template', '/small', 1.0)
+        self.record('template', '/large', 2.0, data='x' * 1000)
+        self.record('graph', '/small/graph', 0.5)
+
+        small, large = self.profile.entries[:2]
+        self.assertEquals(small['path'], '/small')
+        self.assertEquals(small['objects'], 1)
+        self.assertTrue(small['time'] >= 1.0)
+        self.assertTrue(large['size'] > small['size'] + 1000)
+
+        totals = self.profile.totals['template']
+        self.assertEquals(totals['count'], 2)
+        self.assertEquals(totals['objects'], 2)
+        self.assertEquals(totals['size'], small['size'] + large['size'])
+        self.assertTrue(totals['time'] >= 3.0)
+        self.assertEquals(self.profile.totals['graph']['count'], 1)
+
+        self.profile.reset()
+        self.assertEquals(self.profile.entries, [])
+        self.assertEquals(self.profile.totals, {})
+
+    def test_report(self):
+        """Test that reports list the largest entries first, then totals."""
+        self.profile.enable(limit=2)
+        self.record('template', '/fast', 1.0, data='x' * 1000)
+        self.record('template', '/slow', 3.0)
+        self.record('datasource', '/slow/ds', 2.0)
+
+        lines = self.profile.report().splitlines()
+        self.assertEquals(len(lines), 5)
+        self.assertTrue(lines[0].split()[0] == 'seconds', lines[0])
+        self.assertTrue(lines[1].endswith('template   /slow'), lines[1])
+        self.assertTrue(lines[2].endswith('datasource /slow/ds'), lines[2])
+        self.assertTrue(lines[3].startswith('total 2 templates: '), lines[3])
+        self.assertTrue(lines[4].startswith('total 1 datasources: '), lines[4])
+
+        lines = self.profile.report(limit=1, key='size').splitlines()
+        self.assertTrue(lines[1].endswith('/fast'), lines[1])
+        self.assertTrue(lines[2].startswith('total '), lines[2])
+
+    def test_max_entries(self):
+        """Test that only the slowest entries are kept, but all totalled."""
+        self.profile.enable()
+        self.profile.max_entries = 4
+
+        for i in range(5):
+            self.record('graph', '/graph{}'.format(i), float(i))
+
+        self.assertEquals(
+            sorted(x['path'] for x in self.profile.entries),
+            ['/graph3', '/graph4'])
+
+        self.assertEquals(self.profile.totals['graph']['count'], 5)
+
+
 def test_suite():
     """Return test suite for this module."""
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestFunctions))
+    suite.addTest(makeSuite(TestContentHash))
+    suite.addTest(makeSuite(TestCatalogQueryCache))
+    suite.addTest(makeSuite(TestCatalogIndexes))
+    suite.addTest(makeSuite(TestCatalogStats))
+    suite.addTest(makeSuite(TestProcessInChunks))
+    suite.addTest(makeSuite(TestDiffZenPackSpecs))
+    suite.addTest(makeSuite(TestTemplateGraphMaps))
+    suite.addTest(makeSuite(TestTemplateProfile))
     return suite
 
 
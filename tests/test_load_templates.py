@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2015, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""load-templates unit tests.
+
+This module tests command line usage of tools/load-templates.
+
+"""
+
+import logging
+import subprocess
+import os
+import re
+import Globals
+from Products.ZenUtils.Utils import unused
+unused(Globals)
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger('zen.zenpacklib.tests')
+
+from Products.ZenTestCase.BaseTestCase import BaseTestCase
+
+
+TEMPLATE_YAML = """
+/Server/ZPLLoadTemplates/LoadTemplatesTest:
+  description: load-templates test template.
+  thresholds:
+    status high:
+      dsnames: [status_value]
+      maxval: '{maxval}'
+  datasources:
+    status:
+      type: COMMAND
+      commandTemplate: echo OK
+      datapoints:
+        value: GAUGE_MIN_0
+  graphs:
+    Status:
+      units: value
+      graphpoints:
+        Value:
+          dpName: status_value
+          includeThresholds: true
+"""
+
+
+class TestLoadTemplates(BaseTestCase):
+
+    load_templates_path = os.path.join(os.path.dirname(__file__),
+                                       "../tools/load-templates")
+
+    disableLogging = False
+
+    def _load_templates(self, maxval, force=False):
+        """Run load-templates on TEMPLATE_YAML and return its counts."""
+        env = dict(os.environ)
+        env.pop('FORCE', None)
+        if force:
+            env['FORCE'] = '1'
+
+        cmd = (self.load_templates_path,)
+        LOG.info("Running %s", " ".join(cmd))
+        p = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env)
+
+        out, _ = p.communicate(TEMPLATE_YAML.format(maxval=maxval))
+        p.wait()
+        LOG.debug("Output: %s", out)
+
+        self.assertIs(p.returncode, 0,
+                      'Error running %s: %s' % (cmd[0], out))
+
+        self.assertNotIn("Traceback", out)
+
+        match = re.search(
+            r'(\d+) added, (\d+) replaced, (\d+) unchanged', out)
+
+        self.assertIsNotNone(match, 'No summary in output: %s' % out)
+
+        return dict(zip(
+            ('added', 'replaced', 'unchanged'),
+            (int(x) for x in match.groups())))
+
+    def test_unchanged(self):
+        # The template may be left over from a previous run.
+        self._load_templates(maxval=90, force=True)
+
+        counts = self._load_templates(maxval=90)
+        self.assertEqual(
+            counts, {'added': 0, 'replaced': 0, 'unchanged': 1})
+
+    def test_replaced(self):
+        self._load_templates(maxval=90, force=True)
+
+        counts = self._load_templates(maxval=95)
+        self.assertEqual(
+            counts, {'added': 0, 'replaced': 1, 'unchanged': 0})
+
+        counts = self._load_templates(maxval=95)
+        self.assertEqual(
+            counts, {'added': 0, 'replaced': 0, 'unchanged': 1})
+
+    def test_force(self):
+        self._load_templates(maxval=90, force=True)
+
+        counts = self._load_templates(maxval=90, force=True)
+        self.assertEqual(
+            counts, {'added': 0, 'replaced': 1, 'unchanged': 0})
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestLoadTemplates))
+    return suite
+
+
+if __name__ == "__main__":
+    from zope.testrunner.runner import Runner
+    runner = Runner(found_suites=[test_suite()])
+    runner.run()
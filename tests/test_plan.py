@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2015, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Install plan unit tests.
+
+This module tests planning the installation of the ZPLTest1 ZenPack,
+and estimating the impact of changes to its spec.
+
+"""
+
+import Globals
+from Acquisition import aq_base
+from Products.ZenUtils.Utils import unused
+
+unused(Globals)
+
+import os
+import site
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+site.addsitedir(os.path.join(os.path.dirname(__file__), '..'))
+
+from ZenPacks.zenoss.ZPLTest1 import zenpacklib
+from ZenPacks.zenoss.ZPLTest1 import CFG
+
+# Required before zenpacklib.TestCase can be used.
+zenpacklib.enableTesting()
+
+
+DEVICE_CLASS = '/Network/ZPLTest1'
+
+
+class TestPlan(zenpacklib.TestCase):
+
+    """Test suite for install plans and spec change impact."""
+
+    zenpack_module_name = 'ZenPacks.zenoss.ZPLTest1'
+    zenpack_path = os.path.join(os.path.dirname(__file__),
+                                "data/zenpacks/ZenPacks.zenoss.ZPLTest1")
+    disableLogging = False
+
+    def afterSetUp(self):
+        try:
+            super(TestPlan, self).afterSetUp()
+        except ImportError, e:
+            self.assertFalse(
+                e.message == 'No module named ZPLTest1',
+                "ZPLTest1 zenpack is not installed.  You must install it before running this test:\n   zenpack --link --install=%s" % self.zenpack_path
+            )
+
+    def create_device(self):
+        """Return new APIC in DEVICE_CLASS with a VnsCDev component."""
+        from ZenPacks.zenoss.ZPLTest1.FvTenant import FvTenant
+        from ZenPacks.zenoss.ZPLTest1.VnsLDevVip import VnsLDevVip
+        from ZenPacks.zenoss.ZPLTest1.VnsCDev import VnsCDev
+
+        device_class = self.dmd.Devices.createOrganizer(DEVICE_CLASS)
+        device_class.setZenProperty(
+            'zPythonClass', 'ZenPacks.zenoss.ZPLTest1.APIC')
+
+        device = device_class.createInstance('apic1')
+        device.fvTenants._setObject('tenant1', FvTenant('tenant1'))
+        tenant = device.fvTenants._getOb('tenant1')
+        tenant.vnsLDevVips._setObject('ldev1', VnsLDevVip('ldev1'))
+        ldev = tenant.vnsLDevVips._getOb('ldev1')
+        ldev.vnsCDevs._setObject('cdev1', VnsCDev('cdev1'))
+
+        return device
+
+    def zenpack(self):
+        """Return ZPLTest1 ZenPack instance in context."""
+        from ZenPacks.zenoss.ZPLTest1 import ZenPack
+
+        zenpack = ZenPack(self.zenpack_module_name)
+        return zenpack.__of__(self.dmd.ZenPackManager.packs)
+
+    def test_install_plan(self):
+        """Assert that install_plan lists relations, catalogs and templates."""
+        device = self.create_device()
+        device._delObject('VnsCDevSearch')
+
+        zenpack = self.zenpack()
+
+        # Plan relations as if APIC were a class the ZenPack adds
+        # relations to.
+        zenpack.NEW_COMPONENT_TYPES = ['ZenPacks.zenoss.ZPLTest1.FvTenant.FvTenant']
+        zenpack.NEW_RELATIONS = {'ZenPacks.zenoss.ZPLTest1.APIC': ['fvTenants']}
+
+        plan = zenpack.install_plan()
+        steps = dict((x['description'], x['changes']) for x in plan)
+
+        self.assertEquals(
+            [x['description'] for x in plan],
+            ['Device classes', 'Relations', 'Catalogs', 'Monitoring templates'])
+
+        self.assertEquals(
+            steps['Relations'],
+            ['build fvTenants relations on up to 1 objects on 1 devices '
+             'in 1 device classes'])
+
+        self.assertIn(
+            'create VnsCDevSearch on {}'.format('/'.join(device.getPrimaryPath())),
+            ' '.join(steps['Catalogs']))
+
+        self.assertIn(
+            'add template {}/APIC'.format(DEVICE_CLASS),
+            steps['Monitoring templates'])
+
+        # Planning doesn't change anything.
+        self.assertFalse(hasattr(aq_base(device), 'VnsCDevSearch'))
+
+        self.assertIn('Catalogs', zenpacklib.format_plan(plan))
+
+    def impact(self, **names):
+        """Return spec_diff_impact of changes with names added to them.
+
+        names are keyed by category_kind, such as properties_changed.
+
+        """
+        changes = zenpacklib.diff_zenpack_specs(CFG.specparams, CFG.specparams)
+        for key, category_names in names.items():
+            category, kind = key.rsplit('_', 1)
+            changes[category][kind].extend(category_names)
+
+        return zenpacklib.spec_diff_impact(
+            self.dmd, self.zenpack_module_name, changes)
+
+    def test_impact(self):
+        """Assert that spec changes are classified by what they affect."""
+        self.create_device()
+
+        self.assertEquals(self.impact(), (0, 0))
+
+        # Changes to a class affect its components and their devices.
+        self.assertEquals(self.impact(classes_changed=['VnsCDev']), (1, 1))
+        self.assertEquals(
+            self.impact(properties_changed=['VnsCDev.cmgmt_host']), (1, 1))
+        self.assertEquals(
+            self.impact(catalog_indexes_added=['VnsCDev.cmgmt_host']), (1, 1))
+        self.assertEquals(
+            self.impact(relationships_removed=['FvTenant.vnsLDevVips']), (1, 1))
+
+        # Components of other classes aren't counted twice.
+        self.assertEquals(
+            self.impact(classes_changed=['VnsCDev', 'FvTenant']), (2, 1))
+
+        # Classes without components affect nothing.
+        self.assertEquals(self.impact(classes_added=['FabricPod']), (0, 0))
+
+        # Device class and template changes affect devices in the class.
+        self.assertEquals(
+            self.impact(device_classes_changed=[DEVICE_CLASS]), (0, 1))
+        self.assertEquals(
+            self.impact(templates_changed=[DEVICE_CLASS + '/APIC']), (0, 1))
+
+        # Missing device classes affect nothing.
+        self.assertEquals(
+            self.impact(templates_added=['/Network/Missing/APIC']), (0, 0))
+
+
+def test_suite():
+    """Return test suite for this module."""
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestPlan))
+    return suite
+
+
+if __name__ == "__main__":
+    from zope.testrunner.runner import Runner
+    runner = Runner(found_suites=[test_suite()])
+    runner.run()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2015, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Relation unit tests.
+
+This module tests how the ZPLTest1 ZenPack finds relations to build on
+existing objects when it's installed.
+
+"""
+
+import Globals
+from Products.ZenUtils.Utils import unused
+
+unused(Globals)
+
+import os
+import site
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+site.addsitedir(os.path.join(os.path.dirname(__file__), '..'))
+
+from ZenPacks.zenoss.ZPLTest1 import zenpacklib
+
+# Required before zenpacklib.TestCase can be used.
+zenpacklib.enableTesting()
+
+
+APIC = 'ZenPacks.zenoss.ZPLTest1.APIC'
+
+
+class TestRelations(zenpacklib.TestCase):
+
+    """Test suite for finding relations to build."""
+
+    zenpack_module_name = 'ZenPacks.zenoss.ZPLTest1'
+    zenpack_path = os.path.join(os.path.dirname(__file__),
+                                "data/zenpacks/ZenPacks.zenoss.ZPLTest1")
+    disableLogging = False
+
+    def afterSetUp(self):
+        try:
+            super(TestRelations, self).afterSetUp()
+        except ImportError, e:
+            self.assertFalse(
+                e.message == 'No module named ZPLTest1',
+                "ZPLTest1 zenpack is not installed.  You must install it before running this test:\n   zenpack --link --install=%s" % self.zenpack_path
+            )
+
+    def zenpack(self, relations):
+        """Return ZPLTest1 ZenPack adding relations to existing classes.
+
+        APIC's relations stand in for relations the ZenPack adds to
+        classes it doesn't define.
+
+        """
+        from ZenPacks.zenoss.ZPLTest1 import ZenPack
+
+        zenpack = ZenPack(self.zenpack_module_name)
+        zenpack.NEW_RELATIONS = relations
+        return zenpack.__of__(self.dmd.ZenPackManager.packs)
+
+    def save_fingerprint(self, zenpack):
+        """Save zenpack's relations fingerprint as install does."""
+        fingerprints = zenpack._get_relations_fingerprints()
+        fingerprints[zenpack.id] = zenpack._relations_fingerprint()
+
+    def test_fingerprint(self):
+        """Assert that fingerprints describe each relation's schema."""
+        fingerprint = self.zenpack(
+            {APIC: ['fvTenants', 'missing']})._relations_fingerprint()
+
+        self.assertEquals(sorted(fingerprint), [APIC])
+        self.assertEquals(sorted(fingerprint[APIC]), ['fvTenants'])
+        self.assertIn('ToManyCont', fingerprint[APIC]['fvTenants'])
+        self.assertIn('FvTenant', fingerprint[APIC]['fvTenants'])
+
+    def test_changed_relations_first_install(self):
+        """Assert that all relations are built without a fingerprint."""
+        relations = {APIC: ['fvTenants']}
+        zenpack = self.zenpack(relations)
+        zenpack._get_relations_fingerprints().pop(zenpack.id, None)
+
+        self.assertEquals(zenpack._changed_relations(), relations)
+
+    def test_changed_relations_unchanged(self):
+        """Assert that nothing is built when the fingerprint matches."""
+        zenpack = self.zenpack({APIC: ['fvTenants', 'fabricPods']})
+        self.save_fingerprint(zenpack)
+
+        self.assertEquals(zenpack._changed_relations(), {})
+
+    def test_changed_relations_added(self):
+        """Assert that only added relations are built."""
+        self.save_fingerprint(self.zenpack({APIC: ['fvTenants']}))
+
+        zenpack = self.zenpack({APIC: ['fvTenants', 'fabricPods']})
+        self.assertEquals(zenpack._changed_relations(), {APIC: ['fabricPods']})
+
+    def test_changed_relations_removed(self):
+        """Assert that removed relations are built so they're dropped."""
+        self.save_fingerprint(self.zenpack({APIC: ['fvTenants', 'fabricPods']}))
+
+        zenpack = self.zenpack({APIC: ['fvTenants']})
+        self.assertEquals(zenpack._changed_relations(), {APIC: ['fabricPods']})
+
+    def test_changed_relations_schema(self):
+        """Assert that relations whose schema changed are built."""
+        zenpack = self.zenpack({APIC: ['fvTenants', 'fabricPods']})
+        self.save_fingerprint(zenpack)
+
+        fingerprints = zenpack._get_relations_fingerprints()
+        fingerprint = fingerprints[zenpack.id]
+        fingerprint[APIC]['fvTenants'] = 'ToMany(ToOne, {!r}, {!r})'.format(
+            'ZenPacks.zenoss.ZPLTest1.FvTenant', 'apic')
+        fingerprints[zenpack.id] = fingerprint
+
+        self.assertEquals(zenpack._changed_relations(), {APIC: ['fvTenants']})
+
+
+def test_suite():
+    """Return test suite for this module."""
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestRelations))
+    return suite
+
+
+if __name__ == "__main__":
+    from zope.testrunner.runner import Runner
+    runner = Runner(found_suites=[test_suite()])
+    runner.run()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2015, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Component removal unit tests.
+
+This module tests finding and deleting the components a ZenPack adds to
+existing devices when the ZPLTest1 ZenPack is removed.
+
+"""
+
+import Globals
+from Acquisition import aq_base
+from Products.ZenUtils.Utils import unused
+
+unused(Globals)
+
+import os
+import site
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+site.addsitedir(os.path.join(os.path.dirname(__file__), '..'))
+
+from ZenPacks.zenoss.ZPLTest1 import zenpacklib
+
+# Required before zenpacklib.TestCase can be used.
+zenpacklib.enableTesting()
+
+
+DEVICE_CLASS = '/Network/ZPLTest1'
+FVTENANT = 'ZenPacks.zenoss.ZPLTest1.FvTenant.FvTenant'
+VNSCDEV = 'ZenPacks.zenoss.ZPLTest1.VnsCDev.VnsCDev'
+
+
+def path(obj):
+    """Return obj's path as found in catalogs."""
+    return '/'.join(obj.getPrimaryPath())
+
+
+class TestRemove(zenpacklib.TestCase):
+
+    """Test suite for removing components of new component types."""
+
+    zenpack_module_name = 'ZenPacks.zenoss.ZPLTest1'
+    zenpack_path = os.path.join(os.path.dirname(__file__),
+                                "data/zenpacks/ZenPacks.zenoss.ZPLTest1")
+    disableLogging = False
+
+    def afterSetUp(self):
+        try:
+            super(TestRemove, self).afterSetUp()
+        except ImportError, e:
+            self.assertFalse(
+                e.message == 'No module named ZPLTest1',
+                "ZPLTest1 zenpack is not installed.  You must install it before running this test:\n   zenpack --link --install=%s" % self.zenpack_path
+            )
+
+    def create_device(self):
+        """Return new APIC in DEVICE_CLASS with nested components."""
+        from ZenPacks.zenoss.ZPLTest1.FvTenant import FvTenant
+        from ZenPacks.zenoss.ZPLTest1.VnsLDevVip import VnsLDevVip
+        from ZenPacks.zenoss.ZPLTest1.VnsCDev import VnsCDev
+
+        device_class = self.dmd.Devices.createOrganizer(DEVICE_CLASS)
+        device_class.setZenProperty(
+            'zPythonClass', 'ZenPacks.zenoss.ZPLTest1.APIC')
+
+        device = device_class.createInstance('apic1')
+        device.fvTenants._setObject('tenant1', FvTenant('tenant1'))
+        tenant = device.fvTenants._getOb('tenant1')
+        tenant.vnsLDevVips._setObject('ldev1', VnsLDevVip('ldev1'))
+        ldev = tenant.vnsLDevVips._getOb('ldev1')
+        ldev.vnsCDevs._setObject('cdev1', VnsCDev('cdev1'))
+
+        return device
+
+    def zenpack(self, component_types):
+        """Return ZPLTest1 ZenPack adding component_types to devices.
+
+        FvTenant and VnsCDev stand in for component types the ZenPack
+        adds to devices it doesn't define.
+
+        """
+        from ZenPacks.zenoss.ZPLTest1 import ZenPack
+
+        zenpack = ZenPack(self.zenpack_module_name)
+        zenpack.NEW_COMPONENT_TYPES = component_types
+        return zenpack.__of__(self.dmd.ZenPackManager.packs)
+
+    def test_component_paths(self):
+        """Assert that components inside other components are left out."""
+        device = self.create_device()
+        tenant = device.fvTenants._getOb('tenant1')
+        cdev = tenant.vnsLDevVips._getOb('ldev1').vnsCDevs._getOb('cdev1')
+
+        all_paths, paths = self.zenpack([FVTENANT, VNSCDEV])._component_paths()
+
+        self.assertEquals(all_paths, set([path(tenant), path(cdev)]))
+        self.assertEquals(paths, [path(tenant)])
+
+    def test_component_paths_siblings(self):
+        """Assert that components aren't mistaken for their siblings' children."""
+        from ZenPacks.zenoss.ZPLTest1.FvTenant import FvTenant
+
+        device = self.create_device()
+        device.fvTenants._setObject('tenant1a', FvTenant('tenant1a'))
+
+        all_paths, paths = self.zenpack([FVTENANT])._component_paths()
+
+        self.assertEquals(
+            paths,
+            [path(device.fvTenants._getOb(x)) for x in ('tenant1', 'tenant1a')])
+
+    def catalog_paths(self, device, catalog_name):
+        """Return sorted paths indexed in device's catalog_name catalog."""
+        catalog = getattr(aq_base(device), catalog_name, None)
+        self.assertIsNotNone(catalog, "{} was deleted".format(catalog_name))
+        return sorted(catalog._catalog.uids.keys())
+
+    def test_remove_components(self):
+        """Assert that catalogs are deleted only when they'd be emptied."""
+        from ZenPacks.zenoss.ZPLTest1.FabricPod import FabricPod
+
+        device = self.create_device()
+        device.fabricPods._setObject('pod1', FabricPod('pod1'))
+        pod = device.fabricPods._getOb('pod1')
+
+        for catalog_name in ('VnsCDevSearch', 'VnsLDevVipSearch'):
+            self.assertTrue(self.catalog_paths(device, catalog_name))
+
+        self.zenpack([FVTENANT])._remove_components()
+
+        self.assertFalse(device.fvTenants.objectIds())
+
+        # Only components inside removed tenants were indexed in these.
+        for catalog_name in ('VnsCDevSearch', 'VnsLDevVipSearch'):
+            self.assertFalse(hasattr(aq_base(device), catalog_name))
+
+        # The pod is still indexed, so only removed components are
+        # unindexed.
+        self.assertEquals(
+            self.catalog_paths(device, 'ManagedObjectSearch'), [path(pod)])
+
+    def test_remove_components_kept(self):
+        """Assert that catalogs with remaining components are kept."""
+        from ZenPacks.zenoss.ZPLTest1.VnsCDev import VnsCDev
+
+        device = self.create_device()
+        ldev = device.fvTenants._getOb('tenant1').vnsLDevVips._getOb('ldev1')
+        ldev.vnsCDevs._setObject('cdev2', VnsCDev('cdev2'))
+
+        self.zenpack([VNSCDEV])._remove_components()
+
+        self.assertFalse(ldev.vnsCDevs.objectIds())
+        self.assertFalse(hasattr(aq_base(device), 'VnsCDevSearch'))
+
+        # Tenants and their VnsLDevVips aren't removed.
+        self.assertEquals(
+            self.catalog_paths(device, 'VnsLDevVipSearch'), [path(ldev)])
+        self.assertEquals(
+            self.catalog_paths(device, 'ManagedObjectSearch'),
+            [path(device.fvTenants._getOb('tenant1')), path(ldev)])
+
+
+def test_suite():
+    """Return test suite for this module."""
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestRemove))
+    return suite
+
+
+if __name__ == "__main__":
+    from zope.testrunner.runner import Runner
+    runner = Runner(found_suites=[test_suite()])
+    runner.run()
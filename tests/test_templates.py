@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2015, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""Monitoring template unit tests.
+
+This module tests creating and updating monitoring templates from the
+ZPLTest1 ZenPack's templates.
+
+"""
+
+import Globals
+from Acquisition import aq_base
+from Products.ZenUtils.Utils import unused
+
+unused(Globals)
+
+import os
+import site
+import logging
+import transaction
+logging.basicConfig(level=logging.INFO)
+
+
+site.addsitedir(os.path.join(os.path.dirname(__file__), '..'))
+
+from ZenPacks.zenoss.ZPLTest1 import zenpacklib
+from ZenPacks.zenoss.ZPLTest1 import CFG
+
+# Required before zenpacklib.TestCase can be used.
+zenpacklib.enableTesting()
+
+
+DEVICE_CLASS = '/Network/ZPLTest1'
+
+
+class TestTemplates(zenpacklib.TestCase):
+
+    """Test suite for creating and updating monitoring templates."""
+
+    zenpack_module_name = 'ZenPacks.zenoss.ZPLTest1'
+    zenpack_path = os.path.join(os.path.dirname(__file__),
+                                "data/zenpacks/ZenPacks.zenoss.ZPLTest1")
+    disableLogging = False
+
+    def afterSetUp(self):
+        try:
+            super(TestTemplates, self).afterSetUp()
+        except ImportError, e:
+            self.assertFalse(
+                e.message == 'No module named ZPLTest1',
+                "ZPLTest1 zenpack is not installed.  You must install it before running this test:\n   zenpack --link --install=%s" % self.zenpack_path
+            )
+
+        self.dcspec = CFG.device_classes[DEVICE_CLASS]
+
+    def create_template(self, name='FabricNode'):
+        """Return template created from the named template spec."""
+        return self.dcspec.templates[name].create(self.dmd)
+
+    def template_specparams(self, name='FabricNode'):
+        """Return RRDTemplateSpecParams for the named template."""
+        return CFG.specparams.device_classes[DEVICE_CLASS].templates[name]
+
+    def test_create(self):
+        """Assert that a new template is created from its spec."""
+        template = self.create_template()
+        spec = self.dcspec.templates['FabricNode']
+
+        self.assertEquals(template.description, spec.description)
+        self.assertEquals(template.targetPythonClass, spec.targetPythonClass)
+        self.assertEquals(
+            set(template.thresholds.objectIds()), set(spec.thresholds))
+        self.assertEquals(
+            set(template.datasources.objectIds()), set(spec.datasources))
+        self.assertEquals(
+            [x.id for x in template.getGraphDefs()], list(spec.graphs))
+
+    def test_update_in_place(self):
+        """Assert that an existing template is updated in place."""
+        template = self.create_template()
+        datasource = template.datasources._getOb('fabricNodeHealth')
+        datapoint = datasource.datapoints._getOb('healthAvg')
+
+        template.description = 'modified'
+        datapoint.rrdmax = 50
+
+        updated = self.create_template()
+
+        self.assertIs(aq_base(updated), aq_base(template))
+        self.assertIs(
+            aq_base(updated.datasources._getOb('fabricNodeHealth')),
+            aq_base(datasource))
+
+        self.assertEquals(
+            updated.description,
+            self.dcspec.templates['FabricNode'].description)
+
+        self.assertEquals(
+            updated.datasources.fabricNodeHealth.datapoints.healthAvg.rrdmax,
+            100)
+
+    def test_reset_unspecified(self):
+        """Assert that properties not in the spec are reset and logged."""
+        template = self.create_template()
+        threshold = template.thresholds._getOb('node overall health below 75')
+        threshold.maxval = '90'
+        default = aq_base(threshold).__class__.maxval
+
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('zen.zenpacklib')
+        logger.addHandler(handler)
+        try:
+            updated = self.create_template()
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEquals(
+            updated.thresholds._getOb('node overall health below 75').maxval,
+            default)
+
+        self.assertTrue(
+            any('resetting maxval to its default' in x for x in messages),
+            "reset of maxval wasn't logged")
+
+    def test_remove_unspecified(self):
+        """Assert that objects not in the spec are removed on update."""
+        template = self.create_template()
+        template.manage_addRRDDataSource('extra', 'BasicDataSource.COMMAND')
+        template.manage_addGraphDefinition('Extra')
+        template.manage_addRRDThreshold('extra', 'MinMaxThreshold')
+        template.datasources.fabricNodeHealth.manage_addRRDDataPoint('extra')
+
+        updated = self.create_template()
+
+        self.assertNotIn('extra', updated.datasources.objectIds())
+        self.assertNotIn('Extra', updated.graphDefs.objectIds())
+        self.assertNotIn('extra', updated.thresholds.objectIds())
+        self.assertNotIn(
+            'extra',
+            updated.datasources.fabricNodeHealth.datapoints.objectIds())
+
+    def test_template_matches(self):
+        """Assert that an unmodified template matches its spec."""
+        for name in self.dcspec.templates:
+            template = self.create_template(name)
+            spec = self.template_specparams(name)
+
+            self.assertTrue(
+                zenpacklib.template_matches(template, spec),
+                "{!r} template doesn't match its spec".format(name))
+
+            self.assertEquals(
+                zenpacklib.RRDTemplateSpecParams.fromObject(template), spec)
+
+    def test_template_modified(self):
+        """Assert that modified templates don't match their spec."""
+        spec = self.template_specparams()
+
+        def modify_description(template):
+            template.description = 'modified'
+
+        def modify_datapoint(template):
+            template.datasources.fabricNodeHealth.datapoints.healthAvg.rrdmax = 50
+
+        def modify_graphpoint(template):
+            graph = template.graphDefs._getOb('Node Overall Health')
+            graph.graphPoints._getOb('Average').lineWidth = 3
+
+        def modify_threshold(template):
+            template.thresholds.objectValues()[0].severity = 5
+
+        def add_datasource(template):
+            template.manage_addRRDDataSource('extra', 'BasicDataSource.COMMAND')
+
+        def remove_graph(template):
+            template.graphDefs._delObject('Node Overall Health')
+
+        for modify in (
+                modify_description,
+                modify_datapoint,
+                modify_graphpoint,
+                modify_threshold,
+                add_datasource,
+                remove_graph):
+            template = self.create_template()
+            modify(template)
+
+            self.assertFalse(
+                zenpacklib.template_matches(template, spec),
+                "template matches its spec after {}".format(modify.__name__))
+
+            self.assertNotEquals(
+                zenpacklib.RRDTemplateSpecParams.fromObject(template), spec)
+
+    def test_datapoint_shorthand(self):
+        """Assert that shorthand detection agrees with the XML comparison."""
+        datasource = self.create_template().datasources.fabricNodeHealth
+
+        cases = (
+            ({}, {'rrdtype': 'GAUGE'}, True),
+            ({'rrdtype': 'DERIVE'}, {'rrdtype': 'DERIVE'}, True),
+            ({'rrdtype': 'DERIVE'}, {'rrdtype': 'GAUGE'}, False),
+            ({'rrdtype': 'DERIVE', 'rrdmax': 100},
+             {'rrdtype': 'DERIVE', 'rrdmax': 100}, True),
+            ({'rrdtype': 'DERIVE', 'rrdmax': 100}, {'rrdtype': 'DERIVE'}, False),
+            ({'rrdmin': 0, 'rrdmax': 100},
+             {'rrdtype': 'GAUGE', 'rrdmin': 0, 'rrdmax': 100}, True),
+            ({'description': 'modified'}, {'rrdtype': 'GAUGE'}, False),
+            ({'createCmd': ''}, {'rrdtype': 'GAUGE'}, True),
+            )
+
+        for i, (props, shorthand_props, expected) in enumerate(cases):
+            dp_id = 'shorthand{}'.format(i)
+            datasource.manage_addRRDDataPoint(dp_id)
+            datapoint = datasource.datapoints._getOb(dp_id)
+            for propname, value in props.items():
+                setattr(datapoint, propname, value)
+
+            datapoint = aq_base(datapoint)
+            self.assertEquals(
+                zenpacklib.datapoint_matches_shorthand(datapoint, shorthand_props),
+                expected,
+                "{!r} vs {!r}".format(props, shorthand_props))
+
+            self.assertEquals(
+                zenpacklib.datapoint_xml_matches_shorthand(datapoint, shorthand_props),
+                expected,
+                "{!r} vs {!r} (XML)".format(props, shorthand_props))
+
+    def test_create_templates(self):
+        """Assert that all of a device class' templates are created."""
+        self.dcspec.create_templates(self.dmd)
+
+        device_class = self.dmd.Devices.getOrganizer(DEVICE_CLASS)
+        self.assertEquals(
+            set(device_class.rrdTemplates.objectIds()),
+            set(self.dcspec.templates))
+
+        for name in self.dcspec.templates:
+            self.assertTrue(
+                zenpacklib.template_matches(
+                    device_class.rrdTemplates._getOb(name),
+                    self.template_specparams(name)),
+                "{!r} template doesn't match its spec".format(name))
+
+    def test_create_templates_copy(self):
+        """Assert that a template created for one device class is copied."""
+        created = {}
+        self.dcspec.create_templates(self.dmd, created=created)
+
+        other_path = '{}/Other'.format(DEVICE_CLASS)
+        other_dcspec = zenpacklib.DeviceClassSpec(CFG, other_path)
+        other_dcspec.templates['FabricNode'] = self.dcspec.templates['FabricNode']
+        other_dcspec.create_templates(self.dmd, created=created)
+
+        source = self.dmd.Devices.getOrganizer(DEVICE_CLASS).rrdTemplates.FabricNode
+        copy = self.dmd.Devices.getOrganizer(other_path).rrdTemplates.FabricNode
+
+        self.assertIsNot(aq_base(copy), aq_base(source))
+        self.assertEquals(
+            copy.getPrimaryPath()[:-1],
+            self.dmd.Devices.getOrganizer(other_path).rrdTemplates.getPrimaryPath())
+
+        self.assertTrue(
+            zenpacklib.template_matches(copy, self.template_specparams()),
+            "copied template doesn't match its spec")
+
+    def create_node(self):
+        """Return FabricNode component of a new APIC in DEVICE_CLASS."""
+        from ZenPacks.zenoss.ZPLTest1.FabricPod import FabricPod
+        from ZenPacks.zenoss.ZPLTest1.FabricNode import FabricNode
+
+        device_class = self.dmd.Devices.createOrganizer(DEVICE_CLASS)
+        device_class.setZenProperty(
+            'zPythonClass', 'ZenPacks.zenoss.ZPLTest1.APIC')
+
+        device = device_class.createInstance('apic1')
+        device.fabricPods._setObject('pod1', FabricPod('pod1'))
+        pod = device.fabricPods._getOb('pod1')
+        pod.fabricNodes._setObject('node1', FabricNode('node1'))
+
+        return pod.fabricNodes._getOb('node1')
+
+    def test_template_bindings(self):
+        """Assert that template bindings match getRRDTemplates."""
+        self.dcspec.create_templates(self.dmd)
+        node = self.create_node()
+        transaction.savepoint()
+
+        bindings = zenpacklib.get_template_bindings(node)
+
+        self.assertEquals(
+            [x['id'] for x in bindings],
+            [x.id for x in node.getRRDTemplates()])
+
+        fabric_node = [x for x in bindings if x['id'] == 'FabricNode'][0]
+        self.assertEquals(
+            [x['id'] for x in fabric_node['datasources']],
+            ['fabricNodeHealth'])
+
+        self.assertEquals(
+            sorted(x['id'] for x in fabric_node['datasources'][0]['datapoints']),
+            ['healthAvg', 'healthMax', 'healthMin'])
+
+    def test_template_bindings_cached(self):
+        """Assert that bindings are shared until a template changes."""
+        self.dcspec.create_templates(self.dmd)
+        node = self.create_node()
+        transaction.savepoint()
+
+        zenpacklib.invalidate_template_bindings()
+        bindings = zenpacklib.get_template_bindings(node)
+        hits = zenpacklib.template_bindings_stats()['hits']
+
+        self.assertIs(zenpacklib.get_template_bindings(node), bindings)
+        self.assertEquals(
+            zenpacklib.template_bindings_stats()['hits'], hits + 1)
+
+        # Changing a bound datasource rebuilds the table.
+        template = node.device().deviceClass().rrdTemplates.FabricNode
+        template.datasources.fabricNodeHealth.cycletime = 60
+
+        rebuilt = zenpacklib.get_template_bindings(node)
+        self.assertIsNot(rebuilt, bindings)
+
+        fabric_node = [x for x in rebuilt if x['id'] == 'FabricNode'][0]
+        self.assertEquals(fabric_node['datasources'][0]['cycletime'], 60)
+
+    def test_template_bindings_invalidated(self):
+        """Assert that creating templates invalidates bindings."""
+        self.dcspec.create_templates(self.dmd)
+        node = self.create_node()
+        transaction.savepoint()
+
+        bindings = zenpacklib.get_template_bindings(node)
+        invalidations = zenpacklib.template_bindings_stats()['invalidations']
+
+        self.create_template()
+
+        self.assertTrue(
+            zenpacklib.template_bindings_stats()['invalidations'] > invalidations)
+
+        self.assertIsNot(zenpacklib.get_template_bindings(node), bindings)
+
+    def test_template_bindings_local(self):
+        """Assert that components with local templates aren't cached."""
+        self.dcspec.create_templates(self.dmd)
+        node = self.create_node()
+        node.makeLocalRRDTemplate('FabricNode')
+        transaction.savepoint()
+
+        bindings = zenpacklib.get_template_bindings(node)
+        node_path = '/'.join(node.getPrimaryPath())
+
+        self.assertEquals(
+            [x['template'] for x in bindings if x['id'] == 'FabricNode'],
+            ['{}/FabricNode'.format(node_path)])
+
+        self.assertIsNot(zenpacklib.get_template_bindings(node), bindings)
+
+    def test_template_bindings_parent_local(self):
+        """Assert that a parent component's local templates are bound."""
+        self.dcspec.create_templates(self.dmd)
+        node = self.create_node()
+        pod = node.fabricPod()
+        pod.makeLocalRRDTemplate('FabricNode')
+        transaction.savepoint()
+
+        bindings = zenpacklib.get_template_bindings(node)
+        pod_path = '/'.join(pod.getPrimaryPath())
+
+        self.assertEquals(
+            [x['template'] for x in bindings if x['id'] == 'FabricNode'],
+            ['{}/FabricNode'.format(pod_path)])
+
+    def test_template_bindings_savepoint(self):
+        """Assert that changes saved in a savepoint rebuild the table."""
+        self.dcspec.create_templates(self.dmd)
+        node = self.create_node()
+        transaction.savepoint()
+
+        bindings = zenpacklib.get_template_bindings(node)
+
+        template = node.device().deviceClass().rrdTemplates.FabricNode
+        template.datasources.fabricNodeHealth.cycletime = 60
+        transaction.savepoint()
+
+        rebuilt = zenpacklib.get_template_bindings(node)
+        self.assertIsNot(rebuilt, bindings)
+
+        fabric_node = [x for x in rebuilt if x['id'] == 'FabricNode'][0]
+        self.assertEquals(fabric_node['datasources'][0]['cycletime'], 60)
+
+    def graphs_dcspec(self):
+        """Return DeviceClassSpec with a template whose graphs graph thresholds."""
+        return zenpacklib.DeviceClassSpec(
+            CFG, '{}/Graphs'.format(DEVICE_CLASS), templates={
+                'Graphs': {
+                    'thresholds': {
+                        'low': {'dsnames': ['health_avg'], 'minval': '75'},
+                        'high': {
+                            'dsnames': ['health_avg', 'health_max'],
+                            'maxval': '95',
+                            },
+                        'other': {'dsnames': ['health_min'], 'minval': '5'},
+                        },
+                    'datasources': {
+                        'health': {
+                            'type': 'COMMAND',
+                            'commandTemplate': 'echo OK',
+                            'datapoints': {
+                                'avg': 'GAUGE',
+                                'max': 'GAUGE',
+                                'min': 'GAUGE',
+                                },
+                            },
+                        },
+                    'graphs': {
+                        'Health': {
+                            'graphpoints': {
+                                'Average': {
+                                    'dpName': 'health_avg',
+                                    'includeThresholds': True,
+                                    },
+                                'Maximum': {
+                                    'dpName': 'health_max',
+                                    'includeThresholds': True,
+                                    },
+                                'Minimum': {'dpName': 'health_min'},
+                                },
+                            },
+                        'Minimum': {
+                            'graphpoints': {
+                                'Minimum': {
+                                    'dpName': 'health_min',
+                                    'includeThresholds': True,
+                                    },
+                                },
+                            },
+                        },
+                    },
+                })
+
+    def graphed_thresholds(self, graph):
+        """Return set of ids of thresholds graphed on graph."""
+        from Products.ZenModel.ThresholdGraphPoint import ThresholdGraphPoint
+
+        return set(
+            x.threshId for x in graph.graphPoints()
+            if isinstance(x, ThresholdGraphPoint))
+
+    def test_graph_thresholds(self):
+        """Assert that graphs graph the thresholds Zenoss would add."""
+        spec = self.graphs_dcspec().templates['Graphs']
+        template = spec.create(self.dmd)
+
+        self.assertEquals(
+            self.graphed_thresholds(template.graphDefs._getOb('Health')),
+            set(['low', 'high']))
+
+        self.assertEquals(
+            self.graphed_thresholds(template.graphDefs._getOb('Minimum')),
+            set(['other']))
+
+        for graph_id, graph_spec in spec.graphs.items():
+            check = template.manage_addGraphDefinition('check')
+            for graphpoint_spec in graph_spec.graphpoints.values():
+                if graphpoint_spec.includeThresholds:
+                    check.addThresholdsForDataPoint(graphpoint_spec.dpName)
+
+            self.assertEquals(
+                self.graphed_thresholds(template.graphDefs._getOb(graph_id)),
+                self.graphed_thresholds(check),
+                "{!r} graph's thresholds differ".format(graph_id))
+
+            template.graphDefs._delObject('check')
+
+    def test_graph_thresholds_update(self):
+        """Assert that graphs missing thresholds are recreated."""
+        spec = self.graphs_dcspec().templates['Graphs']
+        template = spec.create(self.dmd)
+        graph = template.graphDefs._getOb('Health')
+
+        # Unchanged graphs are kept.
+        spec.create(self.dmd)
+        self.assertIs(aq_base(template.graphDefs._getOb('Health')), aq_base(graph))
+
+        graphpoint_ids = [
+            x.id for x in graph.graphPoints()
+            if getattr(aq_base(x), 'threshId', None) == 'high']
+
+        graph.graphPoints._delObject(graphpoint_ids[0])
+
+        spec.create(self.dmd)
+        self.assertEquals(
+            self.graphed_thresholds(template.graphDefs._getOb('Health')),
+            set(['low', 'high']))
+
+    def test_graph_export(self):
+        """Assert that exported graphs include thresholds as created."""
+        spec = self.graphs_dcspec().templates['Graphs']
+        template = spec.create(self.dmd)
+        graph_maps = zenpacklib.TemplateGraphMaps(template.thresholds())
+
+        for graph in template.getGraphDefs():
+            params = zenpacklib.GraphDefinitionSpecParams.fromObject(graph)
+
+            self.assertEquals(
+                dict((k, v.includeThresholds) for k, v in params.graphpoints.items()),
+                dict((k, v.includeThresholds)
+                     for k, v in spec.graphs[graph.id].graphpoints.items()))
+
+            # Maps shared by all of a template's graphs give the same result.
+            self.assertEquals(
+                zenpacklib.GraphDefinitionSpecParams.fromObject(
+                    graph, graph_maps=graph_maps),
+                params)
+
+    def test_template_profile(self):
+        """Assert that created templates, datasources and graphs are profiled."""
+        profile = zenpacklib.TEMPLATE_PROFILE
+        enabled = profile.enabled
+        profile.reset()
+        profile.enable()
+        try:
+            self.dcspec.create_templates(self.dmd)
+            entries = list(profile.entries)
+            report = profile.report(limit=len(entries))
+        finally:
+            profile.enabled = enabled
+            profile.reset()
+
+        device_class = self.dmd.Devices.getOrganizer(DEVICE_CLASS)
+        template_path = '/'.join(
+            device_class.rrdTemplates.FabricNode.getPrimaryPath())
+
+        paths = dict((x['path'], x) for x in entries)
+        self.assertEquals(paths[template_path]['kind'], 'template')
+        self.assertEquals(
+            paths[template_path + '/datasources/fabricNodeHealth']['kind'],
+            'datasource')
+        self.assertEquals(
+            paths[template_path + '/graphDefs/Node Overall Health']['kind'],
+            'graph')
+
+        # Templates include the objects they contain.
+        self.assertTrue(
+            paths[template_path]['objects'] >
+            paths[template_path + '/datasources/fabricNodeHealth']['objects'])
+
+        self.assertIn(template_path, report)
+        self.assertIn(
+            'total {} templates'.format(len(self.dcspec.templates)), report)
+
+
+def test_suite():
+    """Return test suite for this module."""
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestTemplates))
+    return suite
+
+
+if __name__ == "__main__":
+    from zope.testrunner.runner import Runner
+    runner = Runner(found_suites=[test_suite()])
+    runner.run()
@@ -37,7 +37,13 @@ LOG = logging.getLogger('zen.zenpacklib')
 # hasn't been configured.
 LOG.addHandler(logging.NullHandler())
 
+import atexit
+import bisect
 import collections
+import copy
+import cPickle
+import cStringIO
+import hashlib
 import imp
 import importlib
 import inspect
@@ -47,6 +53,9 @@ import os
 import re
 import sys
 import math
+import threading
+import time
+import weakref
 
 if __name__ == '__main__':
     import Globals
@@ -59,7 +68,9 @@ from zope.event import notify
 from zope.interface import classImplements, implements
 from zope.interface.interface import InterfaceClass
 import zope.proxy
-from Acquisition import aq_base
+from Acquisition import aq_base, aq_chain
+from persistent import Persistent
+import transaction
 
 from Products.AdvancedQuery import Eq, Or
 from Products.AdvancedQuery.AdvancedQuery import _BaseQuery as BaseQuery
@@ -147,6 +158,17 @@ __all__ = (
     'relname_from_classname',
     'relationships_from_yuml',
     'catalog_search',
+    'enable_catalog_query_cache',
+    'invalidate_catalog_query_cache',
+    'catalog_query_cache_stats',
+    'enable_catalog_stats',
+    'catalog_stats',
+    'reset_catalog_stats',
+    'diff_zenpack_specs',
+    'spec_diff_impact',
+    'get_template_bindings',
+    'invalidate_template_bindings',
+    'template_bindings_stats',
     )
 
 # Must defer definition of TestCase. Otherwise it imports
@@ -189,41 +211,728 @@ class ZenPack(ZenPackBase):
     # NEW_COMPONENT_TYPES AND NEW_RELATIONS will be monkeypatched in
     # via zenpacklib when this class is instantiated.
 
-    def _buildDeviceRelations(self):
-        for d in self.dmd.Devices.getSubDevicesGen():
-            d.buildRelations()
+    def _buildDeviceRelations(self, relations=None, paths=None, workers=None, commit=False):
+        """Build relations on objects whose classes gained or lost relations.
 
-    def install(self, app):
-        # create device classes and set zProperties on them
-        for dcname, dcspec in self.device_classes.iteritems():
-            if dcspec.create:
+        Only objects of the classes in relations (defaulting to
+        NEW_RELATIONS) are considered, and those whose relations already
+        match their class' schema are skipped. Work is done in chunks
+        in the current transaction, or committed after each chunk if
+        commit is True. See process_in_chunks.
+
+        If paths is given, only the objects at those paths are
+        considered. Otherwise they're found through the global catalog,
+        and the work is split by device class between workers worker
+        processes if workers is greater than 1. workers defaults to the
+        ZPL_RELATIONS_WORKERS environment variable. Workers import the
+        ZenPack's current classes, so removal must use one.
+
+        """
+        if relations is None:
+            relations = self.NEW_RELATIONS
+
+        if paths is None:
+            paths, relnames = self._relation_paths(relations)
+            if workers is None:
+                workers = int(os.environ.get('ZPL_RELATIONS_WORKERS', 1))
+
+            if workers > 1 and paths and relnames:
+                self._buildDeviceRelationsInWorkers(relations, paths, workers)
+                return
+        else:
+            relnames = set()
+            for module_relnames in relations.itervalues():
+                relnames.update(module_relnames)
+
+        if not relnames:
+            return
+
+        def build_relations(path):
+            obj = self.dmd.unrestrictedTraverse(path, None)
+            if obj is None:
+                return
+
+            if relations_need_building(obj, relnames):
+                obj.buildRelations()
+
+        process_in_chunks(
+            paths, build_relations,
+            description='Building {} relations'.format(self.id),
+            commit=commit)
+
+    def _relation_paths(self, relations):
+        """Return (paths, relnames) of objects with relations to build.
+
+        paths is the sorted list of paths to objects of the classes in
+        relations, and relnames is the set of all relation names in
+        relations. Classes that can't be imported are skipped.
+
+        """
+        from Products.Zuul.interfaces import ICatalogTool
+
+        types = []
+        relnames = set()
+        for module_id, module_relnames in relations.iteritems():
+            try:
+                klass = importClass(module_id)
+            except ImportError:
+                LOG.warning("Unable to import %s to build its relations", module_id)
+                continue
+
+            types.append('.'.join((klass.__module__, klass.__name__)))
+            relnames.update(module_relnames)
+
+        if not types:
+            return [], relnames
+
+        paths = sorted(set(
+            x.getPath() for x in ICatalogTool(self.dmd.Devices).search(types=types)))
+
+        return paths, relnames
+
+    def _buildDeviceRelationsInWorkers(self, relations, paths, workers):
+        """Build relations for paths in parallel worker processes.
+
+        Device classes are distributed between workers so each has a
+        similar number of objects. Each worker is a separate
+        build_relations command with its own ZODB connection that
+        commits its own chunks. Workers are given their paths on stdin
+        so they don't have to search for them again. This returns once
+        all workers are done.
+
+        Unlike building relations in-process, this commits the current
+        transaction first, because workers can only see committed
+        changes, and the workers' changes are committed by them.
+
+        """
+        import subprocess
+
+        by_device_class = collections.defaultdict(list)
+        for path in paths:
+            by_device_class[get_device_class_path(path)].append(path)
+
+        partitions = [[] for i in xrange(min(workers, len(by_device_class)))]
+        sizes = [0] * len(partitions)
+        for device_class_paths in sorted(
+                by_device_class.values(), key=len, reverse=True):
+            i = sizes.index(min(sizes))
+            partitions[i].extend(device_class_paths)
+            sizes[i] += len(device_class_paths)
+
+        # Workers can only see what's been committed.
+        transaction.commit()
+
+        LOG.info(
+            "Building %s relations on %s objects in %s workers",
+            self.id, len(paths), len(partitions))
+
+        script = '{}.py'.format(os.path.splitext(os.path.abspath(__file__))[0])
+        processes = []
+        for partition in partitions:
+            process = subprocess.Popen(
+                [sys.executable, script, 'build_relations',
+                 self.id, json.dumps(relations)],
+                stdin=subprocess.PIPE)
+
+            process.stdin.write(''.join('{}\n'.format(x) for x in partition))
+            process.stdin.close()
+            processes.append(process)
+
+        failures = [x for x in processes if x.wait() != 0]
+
+        # Pick up changes committed by the workers.
+        self.dmd._p_jar.sync()
+
+        if failures:
+            raise RuntimeError(
+                "{} of {} workers failed to build {} relations".format(
+                    len(failures), len(processes), self.id))
+
+    def _relations_fingerprint(self):
+        """Return {module_id: {relname: schema}} for NEW_RELATIONS.
+
+        The schema is a string describing the relationship type and
+        remote side as added to the class by class_relationships.
+
+        """
+        fingerprint = {}
+        for module_id, relnames in self.NEW_RELATIONS.iteritems():
+            try:
+                schemas = dict(importClass(module_id)._relations)
+            except ImportError:
+                continue
+
+            fingerprint[module_id] = {
+                x: '{}({}, {!r}, {!r})'.format(
+                    schemas[x].__class__.__name__,
+                    schemas[x].remoteType.__name__,
+                    schemas[x].remoteClass,
+                    schemas[x].remoteName)
+                for x in relnames if x in schemas}
+
+        return fingerprint
+
+    def _get_relations_fingerprints(self, create=True):
+        """Return persistent mapping of installed relations fingerprints.
+
+        The mapping is kept on ZenPackManager rather than this object
+        because upgrading a ZenPack replaces its ZenPack object. If it
+        doesn't exist yet it's created, or an empty dict is returned if
+        create is False.
+
+        """
+        from persistent.mapping import PersistentMapping
+
+        manager = self.dmd.ZenPackManager
+        fingerprints = getattr(aq_base(manager), 'zpl_relations_fingerprints', None)
+        if fingerprints is None:
+            if not create:
+                return {}
+
+            fingerprints = manager.zpl_relations_fingerprints = PersistentMapping()
+
+        return fingerprints
+
+    def _changed_relations(self):
+        """Return {module_id: relnames} changed since last install.
+
+        Relations whose schema changed, or that were added or removed
+        since the fingerprint was saved by the last install are
+        returned. All of NEW_RELATIONS is returned if there's no saved
+        fingerprint.
+
+        """
+        previous = self._get_relations_fingerprints(create=False).get(self.id)
+        if previous is None:
+            return self.NEW_RELATIONS
+
+        current = self._relations_fingerprint()
+        changed = {}
+        for module_id in set(previous).union(current):
+            old = previous.get(module_id, {})
+            new = current.get(module_id, {})
+            relnames = [
+                x for x in set(old).union(new) if old.get(x) != new.get(x)]
+
+            if relnames:
+                changed[module_id] = relnames
+
+        return changed
+
+    def _iter_devices_with_types(self, types):
+        """Generate devices containing components of any of types.
+
+        Devices are found through the global catalog's component paths
+        so devices without matching components are never loaded.
+
+        """
+        from Products.Zuul.interfaces import ICatalogTool
+
+        seen = set()
+        for brain in ICatalogTool(self.dmd.Devices).search(types=types):
+            device_path = get_device_path(brain.getPath())
+            if not device_path or device_path in seen:
+                continue
+
+            seen.add(device_path)
+            device = self.dmd.unrestrictedTraverse(device_path, None)
+            if device is not None:
+                yield device
+
+    def _component_paths(self):
+        """Return (all_paths, paths) of components of NEW_COMPONENT_TYPES.
+
+        all_paths is the set of paths to all such components. paths is
+        the sorted list of those not contained in another of them, which
+        are the only ones that need to be deleted.
+
+        """
+        from Products.Zuul.interfaces import ICatalogTool
+
+        all_paths = set(
+            x.getPath() for x in ICatalogTool(self.dmd).search(
+                types=self.NEW_COMPONENT_TYPES))
+
+        paths = []
+        for path in sorted(all_paths):
+            parts = path.split('/')
+            ancestors = ('/'.join(parts[:i]) for i in xrange(1, len(parts)))
+            if not any(x in all_paths for x in ancestors):
+                paths.append(path)
+
+        return all_paths, paths
+
+    def _remove_components(self):
+        """Delete all components of NEW_COMPONENT_TYPES.
+
+        Components are deleted device by device and relationship by
+        relationship, in chunks within the current transaction.
+        Components contained in other components being deleted aren't
+        deleted separately. Device catalogs that would be emptied,
+        because only components being deleted or components inside them
+        are indexed in them, are deleted in one step rather than
+        unindexing each component from them. Components then skip
+        unindexing from them because they no longer exist.
+
+        """
+        all_paths, paths = self._component_paths()
+
+        catalog_names = set()
+        for class_module_id in self.CATALOG_CLASSES:
+            try:
+                klass = importClass(class_module_id)
+            except ImportError:
+                continue
+
+            catalog_names.update(
+                klass.get_catalog_name(x, 'device') for x in klass._catalogs)
+
+        # Paths of devices whose catalogs have been checked.
+        checked = set()
+
+        # (device path, catalog name) of catalogs that other objects are
+        # still indexed in.
+        kept = set()
+
+        def is_removed(uid):
+            parts = uid.split('/')
+            return any(
+                '/'.join(parts[:i]) in all_paths
+                for i in xrange(len(parts), 1, -1))
+
+        def delete_component(path):
+            device_path = get_device_path(path)
+            if device_path and device_path not in checked:
+                checked.add(device_path)
+                device = self.dmd.unrestrictedTraverse(device_path, None)
+                if device is not None:
+                    for catalog_name in catalog_names:
+                        if (device_path, catalog_name) in kept:
+                            continue
+
+                        catalog = getattr(aq_base(device), catalog_name, None)
+                        if catalog is None:
+                            continue
+
+                        uids = catalog._catalog.uids
+                        if len(uids) and all(is_removed(x) for x in uids.keys()):
+                            CATALOG_QUERY_CACHE.invalidate(catalog)
+                            device._delObject(catalog_name)
+                        else:
+                            kept.add((device_path, catalog_name))
+
+            relationship_path, _, component_id = path.rpartition('/')
+            relationship = self.dmd.unrestrictedTraverse(relationship_path, None)
+            if relationship is not None and relationship._getOb(component_id, None) is not None:
+                relationship._delObject(component_id)
+
+        process_in_chunks(
+            paths, delete_component,
+            description='Removing {} components'.format(self.id))
+
+    def _sync_catalogs(self):
+        """Create and synchronize catalogs for this ZenPack's classes.
+
+        Global catalogs are created up front, and device catalogs are
+        created on each device that contains components of this
+        ZenPack's classes, so indexing never has to create a catalog.
+
+        Existing catalogs are made to match the current catalog specs.
+        Obsolete indexes and columns are dropped, new or changed indexes
+        are added and only those indexes are reindexed. Catalogs for
+        which there's no longer a spec are removed.
+
+        """
+        for klass, name, container, scope in self._iter_catalogs():
+            self._sync_catalog(klass, name, container, scope)
+
+    def _iter_catalogs(self):
+        """Generate (klass, name, container, scope) of catalogs to sync.
+
+        Global catalogs come first, followed by the device catalogs of
+        each device that contains components of this ZenPack's classes.
+        A class' own device catalog is included even if the class no
+        longer defines it, so that it's removed.
+
+        """
+        classes = []
+        for class_module_id in self.CATALOG_CLASSES:
+            try:
+                classes.append(importClass(class_module_id))
+            except ImportError:
+                LOG.warning("Unable to import %s to sync its catalogs", class_module_id)
+
+        for klass in classes:
+            yield klass, klass.__name__, self.dmd.Devices, 'global'
+
+        seen = set()
+        for klass in classes:
+            types = ['.'.join((klass.__module__, klass.__name__))]
+            names = set(klass._catalogs)
+            names.add(klass.__name__)
+            for device in self._iter_devices_with_types(types):
+                for name in sorted(names):
+                    catalog_name = klass.get_catalog_name(name, 'device')
+                    key = (device.id, catalog_name)
+                    if key in seen:
+                        continue
+
+                    if name not in klass._catalogs and \
+                            not hasattr(aq_base(device), catalog_name):
+                        continue
+
+                    seen.add(key)
+                    yield klass, name, device, 'device'
+
+    def _sync_catalog(self, klass, name, container, scope):
+        """Create, synchronize or remove klass' named catalog in container."""
+        catalog_name = klass.get_catalog_name(name, scope)
+        spec = klass._get_scoped_catalog_spec(name, scope)
+        wanted = spec is not None
+
+        if not hasattr(aq_base(container), catalog_name):
+            if wanted:
+                klass._add_catalog(container, name, scope)
+
+            return
+
+        if wanted:
+            klass._sync_indexes(container._getOb(catalog_name), spec)
+        elif name == klass.__name__:
+            LOG.info(
+                "Removing %s catalog from %s (no longer defined)",
+                catalog_name, container.id)
+
+            CATALOG_QUERY_CACHE.invalidate(container._getOb(catalog_name))
+            container._delObject(catalog_name)
+
+    def _plan_catalog(self, klass, name, container, scope):
+        """Return (change, loads) for what _sync_catalog would do.
+
+        change describes the change, or is None if there's nothing to
+        change. loads is roughly how many objects would be loaded.
+
+        """
+        from Products.Zuul.interfaces import ICatalogTool
+
+        catalog_name = klass.get_catalog_name(name, scope)
+        spec = klass._get_scoped_catalog_spec(name, scope)
+        wanted = spec is not None
+        location = '/'.join(container.getPrimaryPath())
+
+        if not hasattr(aq_base(container), catalog_name):
+            if not wanted:
+                return None, 0
+
+            if scope == 'global':
+                classname = '.'.join((klass.__module__, klass.__name__))
+            else:
+                classname = 'Products.ZenModel.DeviceComponent.DeviceComponent'
+
+            count = ICatalogTool(container).search(
+                types=(spec.get('class', classname),)).total
+
+            return (
+                'create {} on {} and index {} objects'.format(
+                    catalog_name, location, count),
+                count)
+
+        if not wanted:
+            if name == klass.__name__:
+                return 'remove {} from {}'.format(catalog_name, location), 0
+
+            return None, 0
+
+        zcatalog = container._getOb(catalog_name)
+        diff = klass._diff_indexes(zcatalog, spec)
+        if diff is None:
+            return None, 1
+
+        wanted, removed_indexes, removed_columns, changed, new_columns = diff
+        if not any((removed_indexes, removed_columns, changed, new_columns)):
+            return None, 1
+
+        details = []
+        if removed_indexes:
+            details.append('remove indexes {}'.format(', '.join(removed_indexes)))
+        if removed_columns:
+            details.append('remove columns {}'.format(', '.join(removed_columns)))
+        if changed:
+            details.append('add or replace indexes {}'.format(', '.join(changed)))
+        if new_columns:
+            details.append('add columns {}'.format(', '.join(new_columns)))
+
+        count = len(zcatalog._catalog) if changed or new_columns else 0
+        details.append('reindex {} objects'.format(count))
+
+        return (
+            'update {} on {}: {}'.format(
+                catalog_name, location, '; '.join(details)),
+            count + 1)
+
+    def install_plan(self):
+        """Return plan of the changes install would make.
+
+        Nothing is changed. The plan is a list of steps in the order
+        install would run them. Each step is an OrderedDict with a
+        description, a list of changes and a rough count of the objects
+        that would be loaded. Objects loaded by objects.xml aren't
+        included.
+
+        """
+        plan = []
+
+        # Device classes.
+        changes = []
+        loads = 0
+        for dcspec in sorted(self.device_classes.values(), key=lambda x: x.path):
+            try:
+                organizer = self.dmd.Devices.getOrganizer(dcspec.path)
+                loads += 1
+            except KeyError:
+                organizer = None
+                if dcspec.create:
+                    changes.append('create device class {}'.format(dcspec.path))
+
+            for zprop, value in sorted(dcspec.zProperties.iteritems()):
+                if organizer is None or not zproperty_is_set(organizer, zprop, value):
+                    changes.append('set {} on {}'.format(zprop, dcspec.path))
+
+        plan.append(plan_step('Device classes', changes, loads))
+
+        # Relations.
+        changes = []
+        loads = 0
+        if self.NEW_COMPONENT_TYPES:
+            relations = self._changed_relations()
+            if relations:
+                paths, relnames = self._relation_paths(relations)
+                loads = len(paths)
+                changes.append(
+                    'build {} relations on up to {} objects on {} devices '
+                    'in {} device classes'.format(
+                        ', '.join(sorted(relnames)),
+                        len(paths),
+                        len(set(get_device_path(x) or x for x in paths)),
+                        len(set(get_device_class_path(x) for x in paths))))
+
+        plan.append(plan_step('Relations', changes, loads))
+
+        # Catalogs.
+        changes = []
+        loads = 0
+        devices = set()
+        for klass, name, container, scope in self._iter_catalogs():
+            if scope == 'device' and container.id not in devices:
+                devices.add(container.id)
+                loads += 1
+
+            change, count = self._plan_catalog(klass, name, container, scope)
+            loads += count
+            if change:
+                changes.append(change)
+
+        plan.append(plan_step('Catalogs', changes, loads))
+
+        # Monitoring templates.
+        changes = []
+        loads = 0
+        replace = os.environ.get('ZPL_TEMPLATE_SYNC') == 'replace'
+        for dcname, dcspec in sorted(self.device_classes.iteritems()):
+            try:
+                rrdTemplates = self.dmd.Devices.getOrganizer(dcspec.path).rrdTemplates
+            except KeyError:
+                rrdTemplates = None
+
+            for mtname in sorted(dcspec.templates):
+                template_path = '{}/{}'.format(dcspec.path, mtname)
+                template = None
+                if rrdTemplates is not None:
+                    template = rrdTemplates._getOb(mtname, None)
+
+                if template is None:
+                    changes.append('add template {}'.format(template_path))
+                    continue
+
+                expected = self._v_specparams.device_classes[dcname].templates[mtname]
+                loads += count_template_objects(expected)
+
+                if replace:
+                    changes.append('replace template {}'.format(template_path))
+                elif not template_matches(template, expected):
+                    changes.append('update template {}'.format(template_path))
+
+        plan.append(plan_step('Monitoring templates', changes, loads))
+
+        return plan
+
+    def remove_plan(self, leaveObjects=False):
+        """Return plan of the changes remove would make.
+
+        Nothing is changed. The plan has the same form as install_plan's.
+        Objects removed by the ZenPack's objects.xml packables aren't
+        included.
+
+        """
+        plan = []
+        if self._v_specparams is None:
+            return plan
+
+        if leaveObjects:
+            changes = []
+            loads = 0
+            for dcname, dcspec in sorted(self._v_specparams.device_classes.iteritems()):
                 try:
-                    self.dmd.Devices.getOrganizer(dcspec.path)
+                    deviceclass = self.dmd.Devices.getOrganizer(dcname)
                 except KeyError:
+                    continue
+
+                for mtname in sorted(dcspec.templates):
+                    template = deviceclass.rrdTemplates._getOb(mtname, None)
+                    if template is None:
+                        continue
+
+                    loads += count_template_objects(dcspec.templates[mtname])
+
+                    if not template_matches(template, dcspec.templates[mtname]):
+                        changes.append(
+                            'rename modified template {0}/{1} to {1}-upgrade-<time>'.format(
+                                dcname, mtname))
+
+            plan.append(plan_step('Modified monitoring templates', changes, loads))
+            return plan
+
+        changes = [
+            'remove catalog {}'.format(x) for x in self.GLOBAL_CATALOGS
+            if getattr(aq_base(self.dmd.Devices), x, None) is not None]
+
+        plan.append(plan_step('Catalogs', changes, 0))
+
+        changes = []
+        loads = 0
+        if self.NEW_COMPONENT_TYPES:
+            all_paths, paths = self._component_paths()
+            device_paths = set(filter(None, (get_device_path(x) for x in paths)))
+            loads = len(paths) + len(device_paths)
+            if paths:
+                changes.append(
+                    'delete {} components ({} including contained components) '
+                    'on {} devices'.format(len(paths), len(all_paths), len(device_paths)))
+
+            plan.append(plan_step('Components', changes, loads))
+
+            paths, relnames = self._relation_paths(self.NEW_RELATIONS)
+            paths = [x for x in paths if x not in all_paths]
+            changes = []
+            if paths:
+                changes.append(
+                    'remove {} relations from up to {} objects'.format(
+                        ', '.join(sorted(relnames)), len(paths)))
+
+            plan.append(plan_step('Relations', changes, len(paths)))
+
+        changes = []
+        loads = 0
+        for dcname, dcspec in sorted(self.device_classes.iteritems()):
+            if not dcspec.remove:
+                continue
+
+            try:
+                organizer = self.dmd.Devices.getOrganizer(dcspec.path)
+            except KeyError:
+                continue
+
+            loads += 1
+            changes.append(
+                'delete device class {} and its {} devices'.format(
+                    dcspec.path, organizer.countDevices()))
+
+        plan.append(plan_step('Device classes', changes, loads))
+
+        return plan
+
+    def _apply_device_classes(self):
+        """Create device classes and set their zProperties.
+
+        All missing device classes are created first, parents before
+        children. zProperties are then only set where the device class
+        doesn't already have the same local value, so reinstalling
+        doesn't modify unchanged device classes.
+
+        """
+        organizers = {}
+        dcspecs = sorted(self.device_classes.values(), key=lambda x: x.path)
+        for dcspec in dcspecs:
+            try:
+                organizers[dcspec.path] = self.dmd.Devices.getOrganizer(dcspec.path)
+            except KeyError:
+                if dcspec.create:
                     LOG.info('Creating DeviceClass %s' % dcspec.path)
-                    app.dmd.Devices.createOrganizer(dcspec.path)
+                    organizers[dcspec.path] = self.dmd.Devices.createOrganizer(dcspec.path)
+
+        for dcspec in dcspecs:
+            if not dcspec.zProperties:
+                continue
+
+            dcObject = organizers.get(dcspec.path)
+            if dcObject is None:
+                # Raises KeyError for a missing device class that isn't
+                # to be created.
+                dcObject = self.dmd.Devices.getOrganizer(dcspec.path)
 
-            dcObject = self.dmd.Devices.getOrganizer(dcspec.path)
             for zprop, value in dcspec.zProperties.iteritems():
+                if zproperty_is_set(dcObject, zprop, value):
+                    LOG.debug('zProperty %s on %s is unchanged' % (zprop, dcspec.path))
+                    continue
+
                 LOG.info('Setting zProperty %s on %s' % (zprop, dcspec.path))
                 dcObject.setZenProperty(zprop, value)
 
+    def install(self, app):
+        # create device classes and set zProperties on them
+        self._apply_device_classes()
+
         # Load objects.xml now
         super(ZenPack, self).install(app)
         if self.NEW_COMPONENT_TYPES:
-            LOG.info('Adding %s relationships to existing devices' % self.id)
-            self._buildDeviceRelations()
-
-        # load monitoring templates
-        for dcname, dcspec in self.device_classes.iteritems():
-            for mtname, mtspec in dcspec.templates.iteritems():
-                mtspec.create(self.dmd)
+            relations = self._changed_relations()
+            if relations:
+                LOG.info('Adding %s relationships to existing devices' % self.id)
+                self._buildDeviceRelations(relations)
+            else:
+                LOG.info('%s relationships are unchanged' % self.id)
+
+        self._get_relations_fingerprints()[self.id] = self._relations_fingerprint()
+
+        # Create catalogs, and bring those created by a previous
+        # version up to date.
+        LOG.info('Creating and synchronizing %s catalogs' % self.id)
+        self._sync_catalogs()
+
+        # Load monitoring templates in the install transaction. The
+        # savepoint after each device class lets finished templates be
+        # removed from memory.
+        TEMPLATE_PROFILE.reset()
+        type_maps = TemplateTypeMaps()
+        created = {}
+        process_in_chunks(
+            [x for x in self.device_classes.values() if x.templates],
+            lambda x: x.create_templates(
+                self.dmd, type_maps=type_maps, created=created),
+            description='Loading {} monitoring templates'.format(self.id),
+            chunk_size=1)
+
+        if TEMPLATE_PROFILE.enabled:
+            LOG.info(
+                "%s monitoring template profile:\n%s",
+                self.id, TEMPLATE_PROFILE.report())
+
+            TEMPLATE_PROFILE.reset()
 
     def remove(self, app, leaveObjects=False):
         if self._v_specparams is None:
             return
 
-        from Products.Zuul.interfaces import ICatalogTool
         if leaveObjects:
             # Check whether the ZPL-managed monitoring templates have
             # been modified by the user.  If so, those changes will
@@ -256,15 +965,9 @@ class ZenPack(ZenPackBase):
                             dcname, orig_mtname, self.id)
                         continue
 
-                    installed = RRDTemplateSpecParams.fromObject(template)
-
-                    if installed != orig_mtspec:
-                        import time
-                        import difflib
-
-                        lines_installed = [x + '\n' for x in yaml.dump(installed, Dumper=Dumper).split('\n')]
-                        lines_orig_mtspec = [x + '\n' for x in yaml.dump(orig_mtspec, Dumper=Dumper).split('\n')]
-                        diff = ''.join(difflib.unified_diff(lines_orig_mtspec, lines_installed))
+                    if not template_matches(template, orig_mtspec):
+                        installed = RRDTemplateSpecParams.fromObject(template)
+                        diff = template_diff(orig_mtspec, installed)
 
                         # installed is not going to have cycletime in it, because it's the default.
 
@@ -286,14 +989,12 @@ class ZenPack(ZenPackBase):
                 catObj = getattr(dc, catalog, None)
                 if catObj:
                     LOG.info('Removing Catalog %s' % catalog)
+                    CATALOG_QUERY_CACHE.invalidate(catObj)
                     dc._delObject(catalog)
 
             if self.NEW_COMPONENT_TYPES:
                 LOG.info('Removing %s components' % self.id)
-                cat = ICatalogTool(app.zport.dmd)
-                for brain in cat.search(types=self.NEW_COMPONENT_TYPES):
-                    component = brain.getObject()
-                    component.getPrimaryParent()._delObject(component.id)
+                self._remove_components()
 
                 # Remove our Device relations additions.
                 from Products.ZenUtils.Utils import importClass
@@ -302,8 +1003,14 @@ class ZenPack(ZenPackBase):
                     Device._relations = tuple([x for x in Device._relations
                                                if x[0] not in self.NEW_RELATIONS[device_module_id]])
 
+                # Worker processes would import our classes with the
+                # relations we just removed, so rebuild in-process.
                 LOG.info('Removing %s relationships from existing devices.' % self.id)
-                self._buildDeviceRelations()
+                self._buildDeviceRelations(workers=1)
+
+            fingerprints = self._get_relations_fingerprints()
+            if self.id in fingerprints:
+                del fingerprints[self.id]
 
             for dcname, dcspec in self.device_classes.iteritems():
                 if dcspec.remove:
@@ -408,12 +1115,11 @@ class CatalogBase(object):
         if scope == 'device':
             raise ValueError("device scoped catalogs are only available from device or component objects, not classes")
         else:
-            try:
-                return getattr(dmd.Devices, cls.get_catalog_name(name, scope))
-            except AttributeError:
-                if create:
-                    return cls._class_create_catalog(dmd, name, 'global')
-        return
+            zcatalog = getattr(dmd.Devices, cls.get_catalog_name(name, scope), None)
+            if zcatalog is None and create:
+                return cls._class_create_catalog(dmd, name, 'global')
+
+        return zcatalog
 
     def get_catalog(self, name, scope, create=True):
         """Return catalog by name."""
@@ -423,18 +1129,14 @@ class CatalogBase(object):
             return
 
         if scope == 'device':
-            try:
-                return getattr(self.device(), self.get_catalog_name(name, scope))
-            except AttributeError:
-                if create:
-                    return self._create_catalog(name, 'device')
+            zcatalog = getattr(self.device(), self.get_catalog_name(name, scope), None)
         else:
-            try:
-                return getattr(self.dmd.Devices, self.get_catalog_name(name, scope))
-            except AttributeError:
-                if create:
-                    return self._create_catalog(name, 'global')
-        return
+            zcatalog = getattr(self.dmd.Devices, self.get_catalog_name(name, scope), None)
+
+        if zcatalog is None and create:
+            return self._create_catalog(name, scope)
+
+        return zcatalog
 
     @classmethod
     def get_catalog_scopes(cls, name):
@@ -468,13 +1170,13 @@ class CatalogBase(object):
                         catalogs.append(cls.class_get_catalog(dmd, name, scope, create=False))
         return catalogs
 
-    def get_catalogs(self, whiteList=None):
+    def get_catalogs(self, whiteList=None, create=True):
         """Return all catalogs for this class."""
         catalogs = []
         for name in self._catalogs:
             for scope in self.get_catalog_scopes(name):
                 if not whiteList:
-                    catalogs.append(self.get_catalog(name, scope))
+                    catalogs.append(self.get_catalog(name, scope, create=create))
                 else:
                     if scope in whiteList:
                         catalogs.append(self.get_catalog(name, scope, create=False))
@@ -502,109 +1204,340 @@ class CatalogBase(object):
         return spec
 
     @classmethod
-    def _class_create_catalog(cls, dmd, name, scope='device'):
-        """Create and return catalog defined by name."""
-        from Products.ZCatalog.ZCatalog import manage_addZCatalog
+    def _get_scoped_catalog_spec(cls, name, scope):
+        """Return spec of the catalog for name in scope, or None.
 
-        spec = cls._get_catalog_spec(name)
-        if not spec:
-            return
+        There's one global catalog per class, named after its module.
+        It's made of every catalog in _catalogs, including those
+        inherited from base classes, that has global indexes. So its
+        spec merges the indexes of all of those. None is returned if
+        there are none, or if name has no indexes in scope.
+
+        """
+        if scope != 'global':
+            if name not in getattr(cls, '_catalogs', {}):
+                return None
+
+            spec = cls._get_catalog_spec(name)
+            if spec and scope in cls.get_catalog_scopes(name):
+                return spec
+
+            return None
+
+        indexes = OrderedDict()
+        merged = None
+        for catalog_name in sorted(cls._catalogs):
+            spec = cls._get_catalog_spec(catalog_name)
+            if not spec or 'global' not in cls.get_catalog_scopes(catalog_name):
+                continue
+
+            if merged is None:
+                merged = {'indexes': indexes}
+
+            indexes.update(spec['indexes'])
+
+            # Only the class' own spec can change which objects are indexed.
+            if catalog_name == cls.__name__ and 'class' in spec:
+                merged['class'] = spec['class']
+
+        return merged
 
+    @classmethod
+    def _class_create_catalog(cls, dmd, name, scope='device'):
+        """Create and return catalog defined by name."""
         if scope == 'device':
             raise ValueError("device scoped catalogs may only be created from the device or component object, not classes")
         else:
-            catalog_name = cls.get_catalog_name(name, scope)
-            deviceClass = dmd.Devices
+            return cls._add_catalog(dmd.Devices, name, scope)
 
-            if not hasattr(deviceClass, catalog_name):
-                manage_addZCatalog(deviceClass, catalog_name, catalog_name)
+    def _create_catalog(self, name, scope='device'):
+        """Create and return catalog defined by name."""
+        if scope == 'device':
+            return self._add_catalog(self.device(), name, scope)
+        else:
+            return self._add_catalog(self.dmd.Devices, name, scope)
 
-            zcatalog = deviceClass._getOb(catalog_name)
+    @classmethod
+    def _add_catalog(cls, container, name, scope):
+        """Create and return catalog defined by name within container.
 
-        cls._create_indexes(zcatalog, spec)
-        return zcatalog
+        container is the device for device scoped catalogs, or
+        dmd.Devices for global scoped catalogs.
 
-    def _create_catalog(self, name, scope='device'):
-        """Create and return catalog defined by name."""
+        """
         from Products.ZCatalog.ZCatalog import manage_addZCatalog
 
-        spec = self._get_catalog_spec(name)
+        if scope == 'global':
+            spec = cls._get_scoped_catalog_spec(name, scope)
+        else:
+            spec = cls._get_catalog_spec(name)
+
         if not spec:
             return
 
-        if scope == 'device':
-            catalog_name = self.get_catalog_name(name, scope)
+        catalog_name = cls.get_catalog_name(name, scope)
+        if not hasattr(aq_base(container), catalog_name):
+            LOG.debug("Creating %s catalog on %s", catalog_name, container.id)
+            manage_addZCatalog(container, catalog_name, catalog_name)
 
-            device = self.device()
-            if not hasattr(device, catalog_name):
-                manage_addZCatalog(device, catalog_name, catalog_name)
+        zcatalog = container._getOb(catalog_name)
 
-            zcatalog = device._getOb(catalog_name)
+        # Global catalogs are per-class, so only this class' objects
+        # need to be indexed into a new one.
+        if scope == 'global':
+            classname = '.'.join((cls.__module__, cls.__name__))
         else:
-            catalog_name = self.get_catalog_name(name, scope)
-            deviceClass = self.dmd.Devices
+            classname = None
 
-            if not hasattr(deviceClass, catalog_name):
-                manage_addZCatalog(deviceClass, catalog_name, catalog_name)
-
-            zcatalog = deviceClass._getOb(catalog_name)
-
-        self._create_indexes(zcatalog, spec)
+        cls._create_indexes(zcatalog, spec, classname=classname)
         return zcatalog
 
     @classmethod
-    def _create_indexes(cls, zcatalog, spec):
-        from Products.ZCatalog.Catalog import CatalogError
-        from Products.Zuul.interfaces import ICatalogTool
-        catalog = zcatalog._catalog
+    def _get_index_factory(cls, index_type):
+        """Return index factory for index_type or None if it's invalid.
 
-        classname = spec.get(
-            'class', 'Products.ZenModel.DeviceComponent.DeviceComponent')
+        Factories are called with the index name and its spec.
 
-        for propname, propdata in spec['indexes'].items():
-            index_type = propdata.get('type')
-            if not index_type:
-                LOG.error("%s index has no type", propname)
-                return
+        """
+        return {
+            'field': lambda name, spec: makeFieldIndex(name),
+            'keyword': lambda name, spec: makeKeywordIndex(name),
+            'boolean': lambda name, spec: make_boolean_index(name),
+            'path': lambda name, spec: make_path_index(name),
+            'date': lambda name, spec: make_date_index(name),
+            'composite': lambda name, spec: make_composite_index(
+                name, spec.get('fields')),
+            }.get(index_type.lower())
 
-            index_factory = {
-                'field': makeFieldIndex,
-                'keyword': makeKeywordIndex,
-                }.get(index_type.lower())
+    @classmethod
+    def _create_indexes(cls, zcatalog, spec, classname=None):
+        """Create indexes in zcatalog and populate it.
 
-            if not index_factory:
-                LOG.error("%s is not a valid index type", index_type)
-                return
+        A newly-created (empty) catalog is populated by indexing every
+        object of the spec's class, or of classname if the spec has no
+        class. An existing catalog is only reindexed for the indexes
+        that _sync_indexes added or replaced.
 
-            try:
-                catalog.addIndex(propname, index_factory(propname))
-                catalog.addColumn(propname)
-            except CatalogError:
-                # Index already exists.
-                pass
-            else:
-                # the device if it's a device scoped catalog, or dmd.Devices
-                # if it's a global scoped catalog.
-                context = zcatalog.getParentNode()
+        """
+        from Products.Zuul.interfaces import ICatalogTool
+
+        was_empty = not len(zcatalog._catalog)
+
+        changed = cls._sync_indexes(zcatalog, spec)
+        if changed is None or not was_empty:
+            return
+
+        classname = spec.get(
+            'class',
+            classname or 'Products.ZenModel.DeviceComponent.DeviceComponent')
+
+        # the device if it's a device scoped catalog, or dmd.Devices
+        # if it's a global scoped catalog.
+        context = zcatalog.getParentNode()
+
+        # reindex all objects of this type so they are added to the
+        # catalog.
+        results = ICatalogTool(context).search(types=(classname,))
+        for result in results:
+            obj = result.getObject()
+            if hasattr(obj, 'index_object'):
+                obj.index_object()
+
+    @classmethod
+    def _diff_indexes(cls, zcatalog, spec):
+        """Return changes needed to make zcatalog's indexes match spec.
+
+        Return (wanted, removed_indexes, removed_columns, changed,
+        new_columns) where wanted is an OrderedDict of index names to
+        new index objects, and changed lists the names of indexes to be
+        added or replaced. Return None if spec is invalid. zcatalog
+        isn't modified.
+
+        """
+        catalog = zcatalog._catalog
+
+        wanted = OrderedDict()
+        for propname, propdata in spec['indexes'].items():
+            index_type = propdata.get('type')
+            if not index_type:
+                LOG.error("%s index has no type", propname)
+                return
+
+            index_factory = cls._get_index_factory(index_type)
+            if not index_factory:
+                LOG.error("%s is not a valid index type", index_type)
+                return
+
+            if index_type.lower() == 'composite' and not propdata.get('fields'):
+                LOG.error("%s composite index has no fields", propname)
+                return
+
+            wanted[propname] = index_factory(propname, propdata)
+
+        removed_indexes = sorted(set(catalog.indexes.keys()).difference(wanted))
+        removed_columns = sorted(set(catalog.schema.keys()).difference(wanted))
+
+        changed = []
+        for name, index in wanted.iteritems():
+            existing = catalog.indexes.get(name)
+            if existing is not None and \
+                    existing.meta_type == index.meta_type and \
+                    get_composite_fields(existing) == get_composite_fields(index):
+                continue
+
+            changed.append(name)
+
+        new_columns = [x for x in wanted if x not in catalog.schema]
+
+        return wanted, removed_indexes, removed_columns, changed, new_columns
+
+    @classmethod
+    def _sync_indexes(cls, zcatalog, spec):
+        """Make zcatalog's indexes and columns match spec.
+
+        Indexes and columns that are no longer in spec are dropped, new
+        indexes are added, and indexes whose type has changed are
+        replaced. Only objects already in the catalog are reindexed, and
+        only for the indexes that were added or replaced.
+
+        Return list of added or replaced index names, or None if spec is
+        invalid.
+
+        """
+        diff = cls._diff_indexes(zcatalog, spec)
+        if diff is None:
+            return
+
+        wanted, removed_indexes, removed_columns, changed, new_columns = diff
+        catalog = zcatalog._catalog
+
+        for name in removed_indexes:
+            LOG.info("Removing %s index from %s", name, zcatalog.id)
+            catalog.delIndex(name)
+
+        for name in removed_columns:
+            LOG.info("Removing %s column from %s", name, zcatalog.id)
+            catalog.delColumn(name)
+
+        for name in changed:
+            index = wanted[name]
+            existing = catalog.indexes.get(name)
+            if existing is not None:
+                LOG.info(
+                    "Replacing %s index on %s (%s -> %s)",
+                    name, zcatalog.id, existing.meta_type, index.meta_type)
+
+                catalog.delIndex(name)
+
+            catalog.addIndex(name, index)
+
+        for name in new_columns:
+            catalog.addColumn(name)
+
+        CATALOG_QUERY_CACHE.invalidate(zcatalog)
+
+        if changed or new_columns:
+            # Every column is also an index, so a new column always
+            # has an index to be reindexed for.
+            cls._reindex_catalog(
+                zcatalog,
+                idxs=changed or new_columns,
+                update_metadata=bool(new_columns))
+
+        return changed
+
+    @classmethod
+    def _reindex_catalog(cls, zcatalog, idxs, update_metadata=False):
+        """Reindex objects already in zcatalog.
+
+        Only idxs are updated. Metadata is only updated if
+        update_metadata is True. Entries for objects that no longer
+        exist are removed.
+
+        """
+        if not idxs:
+            return
+
+        catalog = zcatalog._catalog
+        for uid in list(catalog.uids.keys()):
+            obj = zcatalog.resolve_path(uid)
+            if obj is None:
+                zcatalog.uncatalog_object(uid)
+                continue
 
-                # reindex all objects of this type so they are added to the
-                # catalog.
-                results = ICatalogTool(context).search(types=(classname,))
-                for result in results:
-                    if hasattr(result.getObject(), 'index_object'):
-                        result.getObject().index_object()
+            zcatalog.catalog_object(
+                obj, uid,
+                idxs=list(idxs),
+                update_metadata=int(update_metadata))
+
+        CATALOG_QUERY_CACHE.invalidate(zcatalog)
+
+    def manage_afterAdd(self, item, container):
+        """Create missing catalogs before this object is first indexed.
+
+        Catalogs are created by ZenPack.install for existing objects,
+        and here for objects added afterwards. index_object only has to
+        create catalogs that are still missing, such as those of a device
+        whose components were all removed.
+
+        """
+        self.get_catalogs()
+
+        original = getattr(super(CatalogBase, self), 'manage_afterAdd', None)
+        if original:
+            original(item, container)
 
     def index_object(self, idxs=None):
-        """Index in all configured catalogs."""
-        for catalog in self.get_catalogs():
-            if catalog:
+        """Index in all configured catalogs.
+
+        Missing catalogs are created, which also indexes all other
+        objects that belong in them.
+
+        """
+        stats = CATALOG_STATS
+        for name in self._catalogs:
+            for scope in self.get_catalog_scopes(name):
+                catalog = self.get_catalog(name, scope, create=False)
+                creatable = scope != 'device' or self.device() is not None
+                if catalog is None and creatable and self._get_catalog_spec(name):
+                    LOG.info(
+                        "Creating missing %s catalog while indexing %s",
+                        self.get_catalog_name(name, scope),
+                        self.getPrimaryId())
+
+                    catalog = self._create_catalog(name, scope)
+
+                if not catalog:
+                    continue
+
+                if stats.enabled:
+                    start = time.time()
+
                 catalog.catalog_object(self, self.getPrimaryId())
+                CATALOG_QUERY_CACHE.invalidate(catalog)
+
+                if stats.enabled:
+                    stats.record(
+                        catalog, 'index', time.time() - start,
+                        query=self.getPrimaryId(),
+                        caller=sys._getframe(1))
 
     def unindex_object(self):
         """Unindex from all configured catalogs."""
-        for catalog in self.get_catalogs():
+        stats = CATALOG_STATS
+        for catalog in self.get_catalogs(create=False):
             if catalog:
+                if stats.enabled:
+                    start = time.time()
+
                 catalog.uncatalog_object(self.getPrimaryId())
+                CATALOG_QUERY_CACHE.invalidate(catalog)
+
+                if stats.enabled:
+                    stats.record(
+                        catalog, 'unindex', time.time() - start,
+                        query=self.getPrimaryId(),
+                        caller=sys._getframe(1))
 
 
 class ModelBase(CatalogBase):
@@ -917,26 +1850,7 @@ class ComponentBase(ModelBase):
         can replace or augment the standard templates respectively.
 
         """
-        templates = []
-
-        for template_name in self._templates:
-            replacement = self.getRRDTemplateByName(
-                '{}-replacement'.format(template_name))
-
-            if replacement:
-                templates.append(replacement)
-            else:
-                template = self.getRRDTemplateByName(template_name)
-                if template:
-                    templates.append(template)
-
-            addition = self.getRRDTemplateByName(
-                '{}-addition'.format(template_name))
-
-            if addition:
-                templates.append(addition)
-
-        return templates
+        return resolve_templates(self, self._templates)
 
 
 class DeviceIndexableWrapper(BaseDeviceWrapper):
@@ -1208,6 +2122,11 @@ class Spec(object):
     source_location = None
     speclog = None
 
+    # Incremented whenever a spec is changed. Cached content hashes are
+    # only used while it's unchanged, because a change to a spec also
+    # changes the hash of every spec containing it.
+    _hash_generation = 0
+
     def __init__(self, _source_location=None):
 
         class LogAdapter(logging.LoggerAdapter):
@@ -1232,6 +2151,20 @@ class Spec(object):
 
         return "%s(%s)" % (self.__class__.__name__, ' - '.join(parts))
 
+    def __setattr__(self, name, value):
+        Spec.invalidate_content_hashes()
+        super(Spec, self).__setattr__(name, value)
+
+    @staticmethod
+    def invalidate_content_hashes():
+        """Discard all cached content hashes.
+
+        Setting a spec's attribute does this. It must also be called
+        when a spec's dict or list parameter is changed in place.
+
+        """
+        Spec._hash_generation += 1
+
     def specs_from_param(self, spec_type, param_name, param_dict, apply_defaults=True, leave_defaults=False):
         """Return a normalized dictionary of spec_type instances."""
         if param_dict is None:
@@ -1299,10 +2232,49 @@ class Spec(object):
 
         return params
 
-    def __eq__(self, other, ignore_params=[]):
+    def ignored_params(self):
+        """Return list of parameters that don't affect equality."""
+        return []
+
+    @property
+    def content_hash(self):
+        """Return hash of this spec's type and parameters.
+
+        Specs with equal hashes are equal. Parameters are normalized as
+        they are by __eq__: unset parameters take the value of their
+        _<param>_defaultvalue attribute, dictionary order is ignored and
+        ignored_params() are left out.
+
+        The hash is cached until any spec is changed. See
+        invalidate_content_hashes.
+
+        """
+        generation, content_hash = self.__dict__.get('_content_hash', (None, None))
+        if generation != Spec._hash_generation:
+            ignored = self.ignored_params()
+            parts = [self.__class__.__name__]
+            for p in self.init_params():
+                if p in ignored:
+                    continue
+
+                value = getattr(self, p, None) or getattr(self, '_%s_defaultvalue' % p, None)
+                parts.append((p, content_key(value)))
+
+            content_hash = hashlib.md5(repr(tuple(parts))).hexdigest()
+            self.__dict__['_content_hash'] = (Spec._hash_generation, content_hash)
+
+        return content_hash
+
+    def __eq__(self, other, ignore_params=None):
         if type(self) != type(other):
             return False
 
+        if self.content_hash == other.content_hash:
+            return True
+
+        if ignore_params is None:
+            ignore_params = self.ignored_params()
+
         params = self.init_params()
         for p in params:
             if p in ignore_params:
@@ -1514,6 +2486,8 @@ class ZenPackSpec(Spec):
         self.device_classes = self.specs_from_param(
             DeviceClassSpec, 'device_classes', device_classes)
 
+        bind_shared_templates(self.device_classes)
+
     @property
     def ordered_classes(self):
         """Return ordered list of ClassSpec instances."""
@@ -1750,6 +2724,8 @@ class ZenPackSpec(Spec):
         attributes['NEW_COMPONENT_TYPES'] = self.NEW_COMPONENT_TYPES
         attributes['NEW_RELATIONS'] = self.NEW_RELATIONS
         attributes['GLOBAL_CATALOGS'] = []
+        attributes['CATALOG_CLASSES'] = [
+            get_symbol_name(self.name, x) for x in self.classes]
         global_catalog_classes = {}
         for (class_, class_spec) in self.classes.items():
             for (p, property_spec) in class_spec.properties.items():
@@ -1793,6 +2769,7 @@ class DeviceClassSpec(Spec):
             zProperties=None,
             remove=False,
             templates=None,
+            shared_templates=None,
             _source_location=None):
         """
             Create a DeviceClass Specification
@@ -1805,6 +2782,8 @@ class DeviceClassSpec(Spec):
             :type zProperties: dict(str)
             :param templates: TODO
             :type templates: SpecsParameter(RRDTemplateSpec)
+            :param shared_templates: Templates of other DeviceClasses to also add to this one, as /Device/Class/TemplateName
+            :type shared_templates: list(str)
         """
         super(DeviceClassSpec, self).__init__(_source_location=_source_location)
 
@@ -1821,6 +2800,51 @@ class DeviceClassSpec(Spec):
         self.templates = self.specs_from_param(
             RRDTemplateSpec, 'templates', templates)
 
+        # Shared templates are added to templates by
+        # bind_shared_templates once all device classes exist.
+        self.shared_templates = list(shared_templates or [])
+
+    def create_templates(self, dmd, type_maps=None, created=None):
+        """Create or update all of this device class' templates.
+
+        The device class is resolved once for all of them, and
+        datasource and threshold types are read once through type_maps,
+        which can be shared between device classes.
+
+        created maps template specs to the path of the template already
+        created from them. It's shared between device classes so a
+        shared template missing from this device class is copied from
+        the one already created rather than built from its spec again.
+
+        """
+        if type_maps is None:
+            type_maps = TemplateTypeMaps()
+
+        if created is None:
+            created = {}
+
+        device_class = dmd.Devices.createOrganizer(self.path)
+        for mtname, mtspec in self.templates.iteritems():
+            start = TEMPLATE_PROFILE.start()
+            source_path = created.get(id(mtspec))
+            if source_path and device_class.rrdTemplates._getOb(mtname, None) is None:
+                source = dmd.unrestrictedTraverse(source_path, None)
+                if source is not None:
+                    mtspec.speclog.info("copying template from {}".format(source_path))
+                    template_copy = source._getCopy(device_class.rrdTemplates)
+                    device_class.rrdTemplates._setObject(mtname, template_copy)
+                    TEMPLATE_BINDINGS.invalidate()
+                    TEMPLATE_PROFILE.record(
+                        'template', device_class.rrdTemplates._getOb(mtname), start)
+
+                    continue
+
+            template = mtspec.create(
+                dmd, device_class=device_class, type_maps=type_maps)
+
+            TEMPLATE_PROFILE.record('template', template, start)
+            created[id(mtspec)] = '/'.join(template.getPrimaryPath())
+
 
 class ZPropertySpec(Spec):
 
@@ -2351,6 +3375,11 @@ class ClassSpec(Spec):
                     }
                 catalogs[self.name]['indexes'].update(pindexes)
 
+                for index_name, index_spec in pindexes.iteritems():
+                    if index_spec['type'] == 'composite':
+                        attributes[index_name] = CompositeIndexProperty(
+                            index_spec['fields'])
+
         # Add local relations.
         for name, spec in self.relationships.iteritems():
             relations.append(spec.zenrelations_tuple)
@@ -2934,6 +3963,7 @@ class ClassPropertySpec(Spec):
             datapoint_default=None,
             datapoint_cached=True,
             index_scope='device',
+            index_fields=None,
             _source_location=None
             ):
         """
@@ -2949,7 +3979,8 @@ class ClassPropertySpec(Spec):
             :param short_label: If specified, this is a shorter version of the
                    label, used, for example, in grid table headings.
             :type short_label: str
-            :param index_type: TODO (enum)
+            :param index_type: Type of index: field, keyword, boolean,
+                   path, date or composite.
             :type index_type: str
             :param label_width: Optionally overrides ZPL's label width
                    calculation with a higher value.
@@ -2993,6 +4024,9 @@ class ClassPropertySpec(Spec):
             :type datapoint_cached: bool
             :param index_scope: TODO (enum)
             :type index_scope: str
+            :param index_fields: Other properties to combine with this one
+                   when index_type is composite.
+            :type index_fields: list(str)
 
         """
         super(ClassPropertySpec, self).__init__(_source_location=_source_location)
@@ -3005,6 +4039,7 @@ class ClassPropertySpec(Spec):
         self.short_label = short_label or self.label
         self.index_type = index_type
         self.index_scope = index_scope
+        self.index_fields = index_fields
         self.label_width = label_width
         self.content_width = content_width or label_width
         self.display = display
@@ -3042,6 +4077,17 @@ class ClassPropertySpec(Spec):
                 "Property '%s': index_scope must be 'device', 'global', or 'both', not '%s'"
                 % (name, self.index_scope))
 
+        if self.index_type:
+            if self.index_type.lower() not in INDEX_TYPES:
+                raise TypeError(
+                    "Property '%s': index_type must be one of %s, not '%s'"
+                    % (name, ', '.join(INDEX_TYPES), self.index_type))
+
+            if self.index_type.lower() == 'composite' and not self.index_fields:
+                raise TypeError(
+                    "Property '%s': index_fields is required for a composite index"
+                    % name)
+
         # Force properties into the 4.0 - 4.9 order range.
         if not order:
             self.order = 4.5
@@ -3066,6 +4112,14 @@ class ClassPropertySpec(Spec):
         if not self.index_type:
             return {}
 
+        if self.index_type.lower() == 'composite':
+            fields = [self.name] + list(self.index_fields)
+            return {
+                '_'.join(fields): {'type': 'composite',
+                                   'scope': self.index_scope,
+                                   'fields': fields},
+                }
+
         return {
             self.name: {'type': self.index_type,
                         'scope': self.index_scope},
@@ -3567,40 +4621,81 @@ class RRDTemplateSpec(Spec):
         self.graphs = self.specs_from_param(
             GraphDefinitionSpec, 'graphs', graphs)
 
-    def create(self, dmd):
-        device_class = dmd.Devices.createOrganizer(self.deviceclass_spec.path)
+    def create(self, dmd, device_class=None, type_maps=None):
+        """Create template, or update an existing template to match.
+
+        An existing template is updated in place. Only thresholds,
+        datasources, datapoints and graphs that differ from the spec are
+        changed, added or removed, so unchanged objects aren't written.
+        Set the ZPL_TEMPLATE_SYNC environment variable to "replace" to
+        delete and recreate existing templates instead.
+
+        device_class and type_maps may be given to avoid resolving them
+        again for each template.
+
+        """
+        if device_class is None:
+            device_class = dmd.Devices.createOrganizer(self.deviceclass_spec.path)
+
+        if type_maps is None:
+            type_maps = TemplateTypeMaps()
 
         existing_template = device_class.rrdTemplates._getOb(self.name, None)
-        if existing_template:
+        if existing_template and os.environ.get('ZPL_TEMPLATE_SYNC') == 'replace':
             self.speclog.info("replacing template")
             device_class.rrdTemplates._delObject(self.name)
+            existing_template = None
 
-        device_class.manage_addRRDTemplate(self.name)
-        template = device_class.rrdTemplates._getOb(self.name)
+        if existing_template:
+            self.speclog.info("updating template")
+            template = existing_template
+        else:
+            device_class.manage_addRRDTemplate(self.name)
+            template = device_class.rrdTemplates._getOb(self.name)
+            self.speclog.info("adding template")
 
         # Flag this as a ZPL managed object, that is, one that should not be
         # exported to objects.xml  (contained objects will also be excluded)
-        template.zpl_managed = True
+        if not getattr(aq_base(template), 'zpl_managed', False):
+            template.zpl_managed = True
 
-        if not existing_template:
-            self.speclog.info("adding template")
+        update_properties(template, {
+            'targetPythonClass': self.targetPythonClass,
+            'description': self.description,
+            }, reset_others=bool(existing_template), speclog=self.speclog)
 
-        if self.targetPythonClass is not None:
-            template.targetPythonClass = self.targetPythonClass
-        if self.description is not None:
-            template.description = self.description
+        remove_unspecified(template.thresholds, self.thresholds, self.speclog)
+        remove_unspecified(template.datasources, self.datasources, self.speclog)
+        remove_unspecified(template.graphDefs, self.graphs, self.speclog)
 
-        self.speclog.debug("adding {} thresholds".format(len(self.thresholds)))
+        self.speclog.debug("syncing {} thresholds".format(len(self.thresholds)))
         for threshold_id, threshold_spec in self.thresholds.items():
-            threshold_spec.create(self, template)
+            threshold_spec.create(self, template, type_maps=type_maps)
 
-        self.speclog.debug("adding {} datasources".format(len(self.datasources)))
+        self.speclog.debug("syncing {} datasources".format(len(self.datasources)))
         for datasource_id, datasource_spec in self.datasources.items():
-            datasource_spec.create(self, template)
+            start = TEMPLATE_PROFILE.start()
+            datasource_spec.create(self, template, type_maps=type_maps)
+            TEMPLATE_PROFILE.record(
+                'datasource', template.datasources._getOb(datasource_id), start)
 
-        self.speclog.debug("adding {} graphs".format(len(self.graphs)))
+        self.speclog.debug("syncing {} graphs".format(len(self.graphs)))
+        graph_maps = TemplateGraphMaps(template.thresholds())
         for graph_id, graph_spec in self.graphs.items():
-            graph_spec.create(self, template)
+            start = TEMPLATE_PROFILE.start()
+            graph_spec.create(self, template, graph_maps=graph_maps)
+            TEMPLATE_PROFILE.record(
+                'graph', template.graphDefs._getOb(graph_id), start)
+
+        # Graphs added to an existing template are added last.
+        for sequence, graph_id in enumerate(self.graphs):
+            graph = template.graphDefs._getOb(graph_id)
+            if graph.sequence != sequence:
+                graph.sequence = sequence
+
+        TEMPLATE_BINDINGS.invalidate()
+
+        return template
 
 
 class RRDThresholdSpec(Spec):
@@ -3651,39 +4746,56 @@ class RRDThresholdSpec(Spec):
         else:
             self.extra_params = extra_params
 
-    def create(self, templatespec, template):
+    def create(self, templatespec, template, type_maps=None):
         if not self.dsnames:
             raise ValueError("%s: threshold has no dsnames attribute", self)
 
-        # Shorthand for datapoints that have the same name as their datasource.
-        for i, dsname in enumerate(self.dsnames):
-            if '_' not in dsname:
-                self.dsnames[i] = '_'.join((dsname, dsname))
+        # Shorthand for datapoints that have the same name as their
+        # datasource. The spec itself isn't changed, so it still
+        # compares equal to the spec it was loaded from.
+        dsnames = [
+            x if '_' in x else '_'.join((x, x)) for x in self.dsnames]
+
+        if type_maps is None:
+            type_maps = TemplateTypeMaps()
 
-        threshold_types = dict((y, x) for x, y in template.getThresholdClasses())
+        threshold_types = type_maps.threshold_types(template)
         type_ = threshold_types.get(self.type_)
         if not type_:
             raise ValueError("'%s' is an invalid threshold type. Valid types: %s" %
                              (self.type_, ', '.join(threshold_types)))
 
-        threshold = template.manage_addRRDThreshold(self.name, self.type_)
-        self.speclog.debug("adding threshold")
-
-        if self.dsnames is not None:
-            threshold.dsnames = self.dsnames
-        if self.eventClass is not None:
-            threshold.eventClass = self.eventClass
-        if self.severity is not None:
-            threshold.severity = self.severity
-        if self.enabled is not None:
-            threshold.enabled = self.enabled
+        threshold = template.thresholds._getOb(self.name, None)
+        existing = threshold is not None
+        if existing and aq_base(threshold).__class__ is not type_:
+            self.speclog.debug("replacing threshold of a different type")
+            template.thresholds._delObject(self.name)
+            existing = False
+
+        if existing:
+            self.speclog.debug("updating threshold")
+        else:
+            threshold = template.manage_addRRDThreshold(self.name, self.type_)
+            self.speclog.debug("adding threshold")
+
+        values = {
+            'dsnames': dsnames,
+            'eventClass': self.eventClass,
+            'severity': self.severity,
+            'enabled': self.enabled,
+            }
+
         if self.extra_params:
+            property_ids = get_class_defaults(aq_base(threshold).__class__).property_types
             for param, value in self.extra_params.iteritems():
-                if param in [x['id'] for x in threshold._properties]:
-                    setattr(threshold, param, value)
+                if param in property_ids:
+                    values[param] = value
                 else:
                     raise ValueError("%s is not a valid property for threshold of type %s" % (param, type_))
 
+        update_properties(
+            threshold, values, reset_others=existing, speclog=self.speclog)
+
 
 class RRDDatasourceSpec(Spec):
 
@@ -3751,8 +4863,11 @@ class RRDDatasourceSpec(Spec):
         self.datapoints = self.specs_from_param(
             RRDDatapointSpec, 'datapoints', datapoints)
 
-    def create(self, templatespec, template):
-        datasource_types = dict(template.getDataSourceOptions())
+    def create(self, templatespec, template, type_maps=None):
+        if type_maps is None:
+            type_maps = TemplateTypeMaps()
+
+        datasource_types = type_maps.datasource_types(template)
 
         if not self.sourcetype:
             raise ValueError('No type for %s/%s. Valid types: %s' % (
@@ -3763,37 +4878,51 @@ class RRDDatasourceSpec(Spec):
             raise ValueError("%s is an invalid datasource type. Valid types: %s" % (
                              self.sourcetype, ', '.join(datasource_types)))
 
-        datasource = template.manage_addRRDDataSource(self.name, type_)
-        self.speclog.debug("adding datasource")
-
-        if self.enabled is not None:
-            datasource.enabled = self.enabled
-        if self.component is not None:
-            datasource.component = self.component
-        if self.eventClass is not None:
-            datasource.eventClass = self.eventClass
-        if self.eventKey is not None:
-            datasource.eventKey = self.eventKey
-        if self.severity is not None:
-            datasource.severity = self.severity
-        if self.commandTemplate is not None:
-            datasource.commandTemplate = self.commandTemplate
-        if self.cycletime is not None:
-            datasource.cycletime = self.cycletime
+        datasource = template.datasources._getOb(self.name, None)
+        existing = datasource is not None
+        if existing and (
+                datasource.sourcetype != self.sourcetype or
+                aq_base(datasource).__class__.__name__ != type_.split('.')[0]):
+            self.speclog.debug("replacing datasource of a different type")
+            template.datasources._delObject(self.name)
+            existing = False
+
+        if existing:
+            self.speclog.debug("updating datasource")
+        else:
+            datasource = template.manage_addRRDDataSource(self.name, type_)
+            self.speclog.debug("adding datasource")
+
+        values = {
+            'sourcetype': datasource.sourcetype,
+            'enabled': self.enabled,
+            'component': self.component,
+            'eventClass': self.eventClass,
+            'eventKey': self.eventKey,
+            'severity': self.severity,
+            'commandTemplate': self.commandTemplate,
+            'cycletime': self.cycletime,
+            }
 
         if self.extra_params:
+            property_ids = get_class_defaults(aq_base(datasource).__class__).property_types
             for param, value in self.extra_params.iteritems():
-                if param in [x['id'] for x in datasource._properties]:
+                if param in property_ids:
                     # handle an ui test error that expects the oid value to be a string
                     # this is to workaround a ui bug known in 4.5 and 5.0.3
                     if type_ == 'BasicDataSource.SNMP' and param == 'oid':
-                        setattr(datasource, param, str(value))
+                        values[param] = str(value)
                     else:
-                        setattr(datasource, param, value)
+                        values[param] = value
                 else:
                     raise ValueError("%s is not a valid property for datasource of type %s" % (param, type_))
 
-        self.speclog.debug("adding {} datapoints".format(len(self.datapoints)))
+        update_properties(
+            datasource, values, reset_others=existing, speclog=self.speclog)
+
+        remove_unspecified(datasource.datapoints, self.datapoints, self.speclog)
+
+        self.speclog.debug("syncing {} datapoints".format(len(self.datapoints)))
         for datapoint_id, datapoint_spec in self.datapoints.items():
             datapoint_spec.create(self, datasource)
 
@@ -3875,42 +5004,60 @@ class RRDDatapointSpec(Spec):
                 rrdmax = max_match.group(1)
                 self.rrdmax = rrdmax
 
-    def __eq__(self, other):
-        if self.shorthand:
+    def ignored_params(self):
+        if getattr(self, 'shorthand', None):
             # when shorthand syntax is in use, the other values are not relevant
-            return super(RRDDatapointSpec, self).__eq__(other, ignore_params=['rrdtype', 'rrdmin', 'rrdmax'])
+            return ['rrdtype', 'rrdmin', 'rrdmax']
         else:
-            return super(RRDDatapointSpec, self).__eq__(other)
+            return []
 
     def create(self, datasource_spec, datasource):
-        datapoint = datasource.manage_addRRDDataPoint(self.name)
-        type_ = datapoint.__class__.__name__
-        self.speclog.debug("adding datapoint of type %s" % type_)
-
-        if self.rrdtype is not None:
-            datapoint.rrdtype = self.rrdtype
-        if self.createCmd is not None:
-            datapoint.createCmd = self.createCmd
-        if self.isrow is not None:
-            datapoint.isrow = self.isrow
-        if self.rrdmin is not None:
-            datapoint.rrdmin = str(self.rrdmin)
-        if self.rrdmax is not None:
-            datapoint.rrdmax = str(self.rrdmax)
-        if self.description is not None:
-            datapoint.description = self.description
+        datapoint = datasource.datapoints._getOb(self.name, None)
+        existing = datapoint is not None
+        if existing:
+            type_ = datapoint.__class__.__name__
+            self.speclog.debug("updating datapoint of type %s" % type_)
+        else:
+            datapoint = datasource.manage_addRRDDataPoint(self.name)
+            type_ = datapoint.__class__.__name__
+            self.speclog.debug("adding datapoint of type %s" % type_)
+
+        values = {
+            'rrdtype': self.rrdtype,
+            'createCmd': self.createCmd,
+            'isrow': self.isrow,
+            'rrdmin': None if self.rrdmin is None else str(self.rrdmin),
+            'rrdmax': None if self.rrdmax is None else str(self.rrdmax),
+            'description': self.description,
+            }
+
         if self.extra_params:
+            property_ids = get_class_defaults(aq_base(datapoint).__class__).property_types
             for param, value in self.extra_params.iteritems():
-                if param in [x['id'] for x in datapoint._properties]:
-                    setattr(datapoint, param, value)
+                if param in property_ids:
+                    values[param] = value
                 else:
                     raise ValueError("%s is not a valid property for datapoint of type %s" % (param, type_))
 
-        self.speclog.debug("adding {} aliases".format(len(self.aliases)))
+        update_properties(
+            datapoint, values, reset_others=existing, speclog=self.speclog)
+
+        existing_aliases = {x.id: x for x in datapoint.aliases()}
+        for alias_id in set(existing_aliases).difference(self.aliases):
+            self.speclog.debug("removing alias {}".format(alias_id))
+            datapoint.removeAlias(alias_id)
+
+        self.speclog.debug("syncing {} aliases".format(len(self.aliases)))
         for alias_id, formula in self.aliases.items():
-            datapoint.addAlias(alias_id, formula)
-            self.speclog.debug("adding alias".format(alias_id))
-            self.speclog.debug("formula = {}".format(formula))
+            alias = existing_aliases.get(alias_id)
+            if alias is None:
+                datapoint.addAlias(alias_id, formula)
+                self.speclog.debug("adding alias {}".format(alias_id))
+                self.speclog.debug("formula = {}".format(formula))
+            elif alias.formula != formula:
+                alias.formula = formula
+                self.speclog.debug("updating alias {}".format(alias_id))
+                self.speclog.debug("formula = {}".format(formula))
 
 
 class GraphDefinitionSpec(Spec):
@@ -3979,28 +5126,60 @@ class GraphDefinitionSpec(Spec):
 
         # TODO fix comments parsing - must always be a list.
 
-    def create(self, templatespec, template):
-        graph = template.manage_addGraphDefinition(self.name)
-        self.speclog.debug("adding graph")
-
-        if self.height is not None:
-            graph.height = self.height
-        if self.width is not None:
-            graph.width = self.width
-        if self.units is not None:
-            graph.units = self.units
-        if self.log is not None:
-            graph.log = self.log
-        if self.base is not None:
-            graph.base = self.base
-        if self.miny is not None:
-            graph.miny = self.miny
-        if self.maxy is not None:
-            graph.maxy = self.maxy
-        if self.custom is not None:
-            graph.custom = self.custom
-        if self.hasSummary is not None:
-            graph.hasSummary = self.hasSummary
+    def create(self, templatespec, template, graph_maps=None):
+        """Create graph, or update an existing graph to match.
+
+        graph_maps may be given to share the template's threshold
+        lookups between all of its graphs.
+
+        """
+        if graph_maps is None:
+            graph_maps = TemplateGraphMaps(template.thresholds())
+
+        graph = template.graphDefs._getOb(self.name, None)
+        existing = graph is not None
+        if existing:
+            self.speclog.debug("updating graph")
+        else:
+            graph = template.manage_addGraphDefinition(self.name)
+            self.speclog.debug("adding graph")
+
+        update_properties(graph, {
+            'height': self.height,
+            'width': self.width,
+            'units': self.units,
+            'log': self.log,
+            'base': self.base,
+            'miny': self.miny,
+            'maxy': self.maxy,
+            'custom': self.custom,
+            'hasSummary': self.hasSummary,
+            }, reset_others=existing, speclog=self.speclog)
+
+        graphpoints = sorted(graph.graphPoints(), key=lambda x: x.sequence)
+        if self.graphpoints_match(graph, graphpoints, graph_maps):
+            self.speclog.debug("syncing {} graphpoints".format(len(self.graphpoints)))
+            comments = [
+                x for x in graphpoints if isinstance(x, CommentGraphPoint)]
+
+            for comment, comment_text in zip(comments, self.comments or []):
+                if comment.text != comment_text:
+                    comment.text = comment_text
+
+            graphed_thresholds = set(
+                x.threshId for x in graphpoints
+                if isinstance(x, ThresholdGraphPoint))
+
+            for graphpoint_id, graphpoint_spec in self.graphpoints.items():
+                graphpoint_spec.create(
+                    self, graph,
+                    graph_maps=graph_maps,
+                    graphed_thresholds=graphed_thresholds)
+
+            return
+
+        for graphpoint_id in graph.graphPoints.objectIds():
+            graph.graphPoints._delObject(graphpoint_id)
 
         if self.comments:
             self.speclog.debug("adding {} comments".format(len(self.comments)))
@@ -4012,8 +5191,47 @@ class GraphDefinitionSpec(Spec):
                 comment.text = comment_text
 
         self.speclog.debug("adding {} graphpoints".format(len(self.graphpoints)))
+        graphed_thresholds = set()
         for graphpoint_id, graphpoint_spec in self.graphpoints.items():
-            graphpoint_spec.create(self, graph)
+            graphpoint_spec.create(
+                self, graph,
+                graph_maps=graph_maps,
+                graphed_thresholds=graphed_thresholds)
+
+    def graphpoints_match(self, graph, graphpoints=None, graph_maps=None):
+        """Return True if graph's graphpoints can be updated in place.
+
+        That's the case when graph has the same comments and datapoint
+        graphpoints in the same order as this spec, and graphpoints for
+        the thresholds that would be included. Otherwise graphpoints are
+        recreated so their order matches a newly-created graph.
+
+        graphpoints, sorted by sequence, and graph_maps may be given if
+        they've already been read.
+
+        """
+        if graphpoints is None:
+            graphpoints = sorted(graph.graphPoints(), key=lambda x: x.sequence)
+
+        if graph_maps is None:
+            graph_maps = TemplateGraphMaps(graph.rrdTemplate().thresholds())
+
+        comments = [x for x in graphpoints if isinstance(x, CommentGraphPoint)]
+        if len(comments) != len(self.comments or []):
+            return False
+
+        datapoint_ids = [
+            x.id for x in graphpoints if isinstance(x, DataPointGraphPoint)]
+
+        if datapoint_ids != list(self.graphpoints):
+            return False
+
+        # Thresholds are graphed after the graphpoint that includes them.
+        dpnames = set(
+            x.dpName for x in self.graphpoints.values() if x.includeThresholds)
+
+        return graph_maps.threshold_ids(dpnames, graph) == set(
+            x.threshId for x in graphpoints if isinstance(x, ThresholdGraphPoint))
 
 
 class GraphPointSpec(Spec):
@@ -4109,33 +5327,48 @@ class GraphPointSpec(Spec):
                 raise ValueError("'%s' is not a valid graphpoint lineType. Valid lineTypes: %s" % (
                                  lineType, ', '.join(valid_linetypes)))
 
-    def create(self, graph_spec, graph):
-        graphpoint = graph.createGraphPoint(DataPointGraphPoint, self.name)
-        self.speclog.debug("adding graphpoint")
-
-        graphpoint.dpName = self.dpName
-
-        if self.lineType is not None:
-            graphpoint.lineType = self.lineType
-        if self.lineWidth is not None:
-            graphpoint.lineWidth = self.lineWidth
-        if self.stacked is not None:
-            graphpoint.stacked = self.stacked
-        if self.format is not None:
-            graphpoint.format = self.format
-        if self.legend is not None:
-            graphpoint.legend = self.legend
-        if self.limit is not None:
-            graphpoint.limit = self.limit
-        if self.rpn is not None:
-            graphpoint.rpn = self.rpn
-        if self.cFunc is not None:
-            graphpoint.cFunc = self.cFunc
-        if self.color is not None:
-            graphpoint.color = self.color
-
-        if self.includeThresholds:
-            graph.addThresholdsForDataPoint(self.dpName)
+    def create(self, graph_spec, graph, graph_maps=None, graphed_thresholds=None):
+        """Create graphpoint, or update an existing graphpoint to match.
+
+        graph_maps and graphed_thresholds (ids of thresholds already on
+        graph) may be given so each graphpoint doesn't have to scan the
+        template's thresholds and graph's graphpoints again. Thresholds
+        that get graphed are added to graphed_thresholds.
+
+        """
+        graphpoint = graph.graphPoints._getOb(self.name, None)
+        existing = graphpoint is not None
+        if not existing:
+            graphpoint = graph.createGraphPoint(DataPointGraphPoint, self.name)
+            self.speclog.debug("adding graphpoint")
+
+            if self.includeThresholds:
+                if graph_maps is None:
+                    graph_maps = TemplateGraphMaps(
+                        graph.rrdTemplate().thresholds())
+
+                if graphed_thresholds is None:
+                    graphed_thresholds = set(
+                        x.threshId for x in graph.graphPoints()
+                        if isinstance(x, ThresholdGraphPoint))
+
+                graph_maps.add_threshold_graphpoints(
+                    graph, self.dpName, graphed_thresholds)
+        else:
+            self.speclog.debug("updating graphpoint")
+
+        update_properties(graphpoint, {
+            'dpName': self.dpName,
+            'lineType': self.lineType,
+            'lineWidth': self.lineWidth,
+            'stacked': self.stacked,
+            'format': self.format,
+            'legend': self.legend,
+            'limit': self.limit,
+            'rpn': self.rpn,
+            'cFunc': self.cFunc,
+            'color': self.color,
+            }, reset_others=existing, speclog=self.speclog)
 
 
 # SpecParams ################################################################
@@ -4189,6 +5422,8 @@ class ZenPackSpecParams(SpecParams, ZenPackSpec):
         self.device_classes = self.specs_from_param(
             DeviceClassSpecParams, 'device_classes', device_classes, leave_defaults=True)
 
+        bind_shared_templates(self.device_classes)
+
 
 class DeviceClassSpecParams(SpecParams, DeviceClassSpec):
     def __init__(self, zenpack_spec, path, zProperties=None, templates=None, **kwargs):
@@ -4262,9 +5497,12 @@ class RRDTemplateSpecParams(SpecParams, RRDTemplateSpec):
         self.targetPythonClass = template.targetPythonClass
         self.description = template.description
 
-        self.thresholds = {x.id: RRDThresholdSpecParams.fromObject(x) for x in template.thresholds()}
+        thresholds = template.thresholds()
+        graph_maps = TemplateGraphMaps(thresholds)
+
+        self.thresholds = {x.id: RRDThresholdSpecParams.fromObject(x) for x in thresholds}
         self.datasources = {x.id: RRDDatasourceSpecParams.fromObject(x) for x in template.datasources()}
-        self.graphs = {x.id: GraphDefinitionSpecParams.fromObject(x) for x in template.graphDefs()}
+        self.graphs = {x.id: GraphDefinitionSpecParams.fromObject(x, graph_maps) for x in template.graphDefs()}
 
         return self
 
@@ -4283,24 +5521,14 @@ class RRDDatasourceSpecParams(SpecParams, RRDDatasourceSpec):
         SpecParams.__init__(self)
         datasource = aq_base(datasource)
 
-        # Weed out any values that are the same as they would by by default.
-        # We do this by instantiating a "blank" datapoint and comparing
-        # to it.
-        sample_ds = datasource.__class__(datasource.id)
-
+        # read_object_params leaves out values that are the same as the
+        # class' defaults.
         self.sourcetype = datasource.sourcetype
-        for propname in ('enabled', 'component', 'eventClass', 'eventKey',
-                         'severity', 'commandTemplate', 'cycletime',):
-            if hasattr(sample_ds, propname):
-                setattr(self, '_%s_defaultvalue' % propname, getattr(sample_ds, propname))
-            if getattr(datasource, propname, None) != getattr(sample_ds, propname, None):
-                setattr(self, propname, getattr(datasource, propname, None))
-
-        self.extra_params = collections.OrderedDict()
-        for propname in [x['id'] for x in datasource._properties]:
-            if propname not in self.init_params():
-                if getattr(datasource, propname, None) != getattr(sample_ds, propname, None):
-                    self.extra_params[propname] = getattr(datasource, propname, None)
+        read_object_params(self, datasource, (
+            'enabled', 'component', 'eventClass', 'eventKey',
+            'severity', 'commandTemplate', 'cycletime',))
+
+        read_extra_params(self, datasource)
 
         self.datapoints = {x.id: RRDDatapointSpecParams.fromObject(x) for x in datasource.datapoints()}
 
@@ -4317,19 +5545,11 @@ class RRDThresholdSpecParams(SpecParams, RRDThresholdSpec):
         self = object.__new__(cls)
         SpecParams.__init__(self)
         threshold = aq_base(threshold)
-        sample_th = threshold.__class__(threshold.id)
 
-        for propname in ('dsnames', 'eventClass', 'severity', 'type_'):
-            if hasattr(sample_th, propname):
-                setattr(self, '_%s_defaultvalue' % propname, getattr(sample_th, propname))
-            if getattr(threshold, propname, None) != getattr(sample_th, propname, None):
-                setattr(self, propname, getattr(threshold, propname, None))
+        read_object_params(
+            self, threshold, ('dsnames', 'eventClass', 'severity', 'type_'))
 
-        self.extra_params = collections.OrderedDict()
-        for propname in [x['id'] for x in threshold._properties]:
-            if propname not in self.init_params():
-                if getattr(threshold, propname, None) != getattr(sample_th, propname, None):
-                    self.extra_params[propname] = getattr(threshold, propname, None)
+        read_extra_params(self, threshold)
 
         return self
 
@@ -4345,14 +5565,10 @@ class RRDDatapointSpecParams(SpecParams, RRDDatapointSpec):
         self = object.__new__(cls)
         SpecParams.__init__(self)
         datapoint = aq_base(datapoint)
-        sample_dp = datapoint.__class__(datapoint.id)
 
-        for propname in ('name', 'rrdtype', 'createCmd', 'isrow', 'rrdmin',
-                         'rrdmax', 'description',):
-            if hasattr(sample_dp, propname):
-                setattr(self, '_%s_defaultvalue' % propname, getattr(sample_dp, propname))
-            if getattr(datapoint, propname, None) != getattr(sample_dp, propname, None):
-                setattr(self, propname, getattr(datapoint, propname, None))
+        read_object_params(self, datapoint, (
+            'name', 'rrdtype', 'createCmd', 'isrow', 'rrdmin', 'rrdmax',
+            'description',))
 
         if self.rrdmin is not None:
             self.rrdmin = int(self.rrdmin)
@@ -4361,11 +5577,7 @@ class RRDDatapointSpecParams(SpecParams, RRDDatapointSpec):
 
         self.aliases = {x.id: x.formula for x in datapoint.aliases()}
 
-        self.extra_params = collections.OrderedDict()
-        for propname in [x['id'] for x in datapoint._properties]:
-            if propname not in self.init_params():
-                if getattr(datapoint, propname, None) != getattr(sample_dp, propname, None):
-                    self.extra_params[propname] = getattr(datapoint, propname, None)
+        read_extra_params(self, datapoint)
 
         # Shorthand support.  The use of the shorthand field takes
         # over all other attributes.  So we can only use it when the rest of
@@ -4373,9 +5585,9 @@ class RRDDatapointSpecParams(SpecParams, RRDDatapointSpec):
         # RRDDatapoint has been subclassed, since we don't know what
         # the defaults are, necessarily.
         #
-        # To do this, we actually instantiate a sample datapoint
-        # using only the shorthand values, and see if the result
-        # ends up being effectively the same as what we have.
+        # To do this, we compare each of the datapoint's properties to
+        # the value it would have if the datapoint were created from
+        # only the shorthand values.
 
         shorthand_props = {}
         shorthand = []
@@ -4392,34 +5604,26 @@ class RRDDatapointSpecParams(SpecParams, RRDDatapointSpec):
                 shorthand.append('MAX_%d' % int(datapoint.rrdmax))
                 shorthand_props['rrdmax'] = datapoint.rrdmax
 
-            if shorthand:
-                for prop in shorthand_props:
-                    setattr(sample_dp, prop, shorthand_props[prop])
+            matches = not self.aliases and \
+                datapoint_matches_shorthand(datapoint, shorthand_props)
 
-                # Compare the current datapoint with the results
-                # of constructing one from the shorthand syntax.
-                #
-                # The comparison is based on the objects.xml-style
-                # xml representation, because it seems like that's really
-                # the bottom line.  If they end up the same in there, then
-                # I am certain that they are equivalent.
-
-                import StringIO
-                io = StringIO.StringIO()
-                datapoint.exportXml(io)
-                dp_xml = io.getvalue()
-                io.close()
-
-                io = StringIO.StringIO()
-                sample_dp.exportXml(io)
-                sample_dp_xml = io.getvalue()
-                io.close()
-
-                # Identical, so set the shorthand.  This will cause
-                # all other properties to be ignored during
-                # serialization to yaml.
-                if dp_xml == sample_dp_xml:
-                    self.shorthand = '_'.join(shorthand)
+            if os.environ.get('ZPL_SHORTHAND_XML_CHECK'):
+                xml_matches = datapoint_xml_matches_shorthand(
+                    datapoint, shorthand_props)
+
+                if xml_matches != matches:
+                    LOG.warning(
+                        "Shorthand check for datapoint %s differs from XML "
+                        "comparison (%s != %s)",
+                        datapoint.id, matches, xml_matches)
+
+                    matches = xml_matches
+
+            # Equivalent, so set the shorthand.  This will cause
+            # all other properties to be ignored during
+            # serialization to yaml.
+            if matches:
+                self.shorthand = '_'.join(shorthand)
 
         return self
 
@@ -4432,23 +5636,36 @@ class GraphDefinitionSpecParams(SpecParams, GraphDefinitionSpec):
             GraphPointSpecParams, 'graphpoints', graphpoints)
 
     @classmethod
-    def fromObject(cls, graphdefinition):
+    def fromObject(cls, graphdefinition, graph_maps=None):
         self = object.__new__(cls)
         SpecParams.__init__(self)
         graphdefinition = aq_base(graphdefinition)
-        sample_gd = graphdefinition.__class__(graphdefinition.id)
 
-        for propname in ('height', 'width', 'units', 'log', 'base', 'miny',
-                         'maxy', 'custom', 'hasSummary', 'comments'):
-            if hasattr(sample_gd, propname):
-                setattr(self, '_%s_defaultvalue' % propname, getattr(sample_gd, propname))
-            if getattr(graphdefinition, propname, None) != getattr(sample_gd, propname, None):
-                setattr(self, propname, getattr(graphdefinition, propname, None))
+        if graph_maps is None:
+            graph_maps = TemplateGraphMaps(
+                graphdefinition.rrdTemplate().thresholds())
+
+        read_object_params(self, graphdefinition, (
+            'height', 'width', 'units', 'log', 'base', 'miny', 'maxy',
+            'custom', 'hasSummary', 'comments'))
+
+        datapoint_graphpoints = []
+        comment_graphpoints = []
+        threshold_ids = set()
+        for graphpoint in graphdefinition.graphPoints():
+            if isinstance(graphpoint, DataPointGraphPoint):
+                datapoint_graphpoints.append(graphpoint)
+            elif isinstance(graphpoint, CommentGraphPoint):
+                comment_graphpoints.append(graphpoint)
+            elif isinstance(graphpoint, ThresholdGraphPoint):
+                threshold_ids.add(graphpoint.threshId)
+
+        threshold_dpnames = graph_maps.threshold_dpnames(threshold_ids)
+        self.graphpoints = {
+            x.id: GraphPointSpecParams.fromObject(
+                x, graphdefinition, threshold_dpnames)
+            for x in datapoint_graphpoints}
 
-        datapoint_graphpoints = [x for x in graphdefinition.graphPoints() if isinstance(x, DataPointGraphPoint)]
-        self.graphpoints = {x.id: GraphPointSpecParams.fromObject(x, graphdefinition) for x in datapoint_graphpoints}
-
-        comment_graphpoints = [x for x in graphdefinition.graphPoints() if isinstance(x, CommentGraphPoint)]
         if comment_graphpoints:
             self.comments = [y.text for y in sorted(comment_graphpoints, key=lambda x: x.id)]
 
@@ -4461,30 +5678,32 @@ class GraphPointSpecParams(SpecParams, GraphPointSpec):
         self.name = name
 
     @classmethod
-    def fromObject(cls, graphpoint, graphdefinition):
+    def fromObject(cls, graphpoint, graphdefinition, threshold_dpnames=None):
+        """Return GraphPointSpecParams for graphpoint.
+
+        threshold_dpnames is the set of datapoint names used by
+        thresholds graphed on graphdefinition. It's read from
+        graphdefinition if not given.
+
+        """
         self = object.__new__(cls)
         SpecParams.__init__(self)
         graphpoint = aq_base(graphpoint)
         graphdefinition = aq_base(graphdefinition)
-        sample_gp = graphpoint.__class__(graphpoint.id)
-
-        for propname in ('lineType', 'lineWidth', 'stacked', 'format',
-                         'legend', 'limit', 'rpn', 'cFunc', 'color', 'dpName'):
-            if hasattr(sample_gp, propname):
-                setattr(self, '_%s_defaultvalue' % propname, getattr(sample_gp, propname))
-            if getattr(graphpoint, propname, None) != getattr(sample_gp, propname, None):
-                setattr(self, propname, getattr(graphpoint, propname, None))
-
-        threshold_graphpoints = [x for x in graphdefinition.graphPoints() if isinstance(x, ThresholdGraphPoint)]
-
-        self.includeThresholds = False
-        if threshold_graphpoints:
-            thresholds = {x.id: x for x in graphpoint.graphDef().rrdTemplate().thresholds()}
-            for tgp in threshold_graphpoints:
-                threshold = thresholds.get(tgp.threshId, None)
-                if threshold:
-                    if graphpoint.dpName in threshold.dsnames:
-                        self.includeThresholds = True
+
+        read_object_params(self, graphpoint, (
+            'lineType', 'lineWidth', 'stacked', 'format', 'legend', 'limit',
+            'rpn', 'cFunc', 'color', 'dpName'))
+
+        if threshold_dpnames is None:
+            graph_maps = TemplateGraphMaps(
+                graphdefinition.rrdTemplate().thresholds())
+
+            threshold_dpnames = graph_maps.threshold_dpnames(
+                x.threshId for x in graphdefinition.graphPoints()
+                if isinstance(x, ThresholdGraphPoint))
+
+        self.includeThresholds = graphpoint.dpName in threshold_dpnames
 
         return self
 
@@ -4730,6 +5949,13 @@ if YAML_INSTALLED:
                     (cls.__name__, param))
                 continue
 
+            # Shared templates are only represented in the device class
+            # that defines them.
+            if param == 'templates' and getattr(obj, 'shared_templates', None):
+                shared = set(x.rpartition('/')[2] for x in obj.shared_templates)
+                value = OrderedDict(
+                    (k, v) for k, v in value.items() if k not in shared)
+
             # Figure out what the default value is.  First, consider the default
             # value for this parameter (globally):
             default_value = param_defs[param].get('default', None)
@@ -4834,6 +6060,8 @@ if YAML_INSTALLED:
                                 raise yaml.representer.RepresenterError(
                                     "Unable to serialize %s object (%s):  Expected an object of type %s" %
                                     (type(spec).__name__, key, spectype))
+                            elif isinstance(spec, getattr(dumper, 'deferred_types', ())):
+                                specmapping[dumper.represent_str(key)] = DeferredNode(spec, defaults)
                             else:
                                 specmapping[dumper.represent_str(key)] = represent_spec(dumper, spec, defaults=defaults)
 
@@ -5075,6 +6303,70 @@ if YAML_INSTALLED:
         warnings = True
         yaml_errored = False
 
+    class DeferredNode(object):
+        """Placeholder for a spec to be represented when serialized."""
+
+        def __init__(self, spec, defaults=None):
+            self.spec = spec
+            self.defaults = defaults
+
+    class StreamingDumper(Dumper):
+        """Dumper that writes monitoring templates one at a time.
+
+        Templates are only represented as they're serialized, and their
+        nodes are released once they've been written. So output starts
+        right away, and only one template's nodes are held in memory.
+        The output is the same as Dumper's, except that separate
+        templates never share anchors.
+
+        """
+
+        deferred_types = (RRDTemplateSpec,)
+
+        def anchor_node(self, node):
+            if not isinstance(node, DeferredNode):
+                Dumper.anchor_node(self, node)
+
+        def serialize_node(self, node, parent, index):
+            if not isinstance(node, DeferredNode):
+                return Dumper.serialize_node(self, node, parent, index)
+
+            node = represent_spec(self, node.spec, defaults=node.defaults)
+            self.anchor_node(node)
+            Dumper.serialize_node(self, node, parent, index)
+
+            for x in iter_nodes(node):
+                self.anchors.pop(x, None)
+                self.serialized_nodes.pop(x, None)
+
+            self.represented_objects = {}
+            self.object_keeper = []
+            self.flush_stream()
+
+    def iter_nodes(node):
+        """Generate node and all nodes within it."""
+        yield node
+        if isinstance(node, yaml.SequenceNode):
+            for item in node.value:
+                for x in iter_nodes(item):
+                    yield x
+        elif isinstance(node, yaml.MappingNode):
+            for key, value in node.value:
+                for x in iter_nodes(key):
+                    yield x
+                for x in iter_nodes(value):
+                    yield x
+
+    def stream_yaml(data, stream, **kwargs):
+        """Write data to stream as YAML, one template at a time.
+
+        The output is as yaml.dump(data, stream, Dumper=Dumper, **kwargs)
+        would write it, but it's written as it's produced rather than
+        after the whole document has been represented.
+
+        """
+        yaml.dump(data, stream, Dumper=StreamingDumper, **kwargs)
+
     Dumper.add_representer(ZenPackSpec, represent_zenpackspec)
     Dumper.add_representer(DeviceClassSpec, represent_spec)
     Dumper.add_representer(ZPropertySpec, represent_spec)
@@ -5102,62 +6394,296 @@ if YAML_INSTALLED:
 
 # Public Functions ##########################################################
 
-def load_yaml(yaml_filename=None):
-    """Load YAML from yaml_filename.
+def enable_catalog_query_cache(enabled=True):
+    """Enable or disable caching of catalog_search results.
 
-    Loads from zenpack.yaml in the current directory if
-    yaml_filename isn't specified.
+    Cached results last only until the end of the current transaction,
+    and are discarded earlier when zenpacklib writes to the searched
+    catalog. See invalidate_catalog_query_cache for other writes. Only
+    dictionary and keyword queries are cached.
 
     """
-    CFG = None
+    CATALOG_QUERY_CACHE.enabled = bool(enabled)
+    if not enabled:
+        CATALOG_QUERY_CACHE.clear()
 
-    if YAML_INSTALLED:
-        if yaml_filename is None:
-            yaml_filename = os.path.join(
-                os.path.dirname(__file__), 'zenpack.yaml')
 
-        try:
-            CFG = yaml.load(file(yaml_filename, 'r'), Loader=Loader)
-        except Exception as e:
-            LOG.error(e)
-    else:
-        zenpack_name = None
+def invalidate_catalog_query_cache(catalog=None):
+    """Discard cached catalog_search results for catalog, or for all.
 
-        # Guess ZenPack name from the path.
-        dirname = __file__
-        while dirname != '/':
-            dirname = os.path.dirname(dirname)
-            basename = os.path.basename(dirname)
-            if basename.startswith('ZenPacks.'):
-                zenpack_name = basename
-                break
+    zenpacklib does this whenever it writes to a catalog. It must be
+    called after writing to a catalog directly, for example with its
+    catalog_object or uncatalog_object methods, when the write should be
+    visible to catalog_search in the same transaction.
 
-        LOG.error(
-            '%s requires PyYAML. Run "easy_install PyYAML".',
-            zenpack_name or 'ZenPack')
+    """
+    CATALOG_QUERY_CACHE.invalidate(catalog)
 
-        # Create a simple ZenPackSpec that should be harmless.
-        CFG = ZenPackSpec(name=zenpack_name or 'NoYAML')
 
-    if CFG:
-        CFG.create()
-    else:
-        LOG.error("Unable to load %s", yaml_filename)
-    return CFG
+def catalog_query_cache_stats():
+    """Return dict of catalog_search cache hits, misses and invalidations."""
+    return CATALOG_QUERY_CACHE.stats()
 
 
-def enableTesting():
-    """Enable test mode. Only call from code under tests/.
+def enable_catalog_stats(enabled=True, slow_threshold=None):
+    """Enable or disable recording of catalog call stats.
 
-    If this is called from production code it will cause all Zope
-    clients to start in test mode. Which isn't useful for anything but
-    unit testing.
+    Calls taking at least slow_threshold milliseconds are logged. The
+    threshold is left unchanged if slow_threshold is None.
 
     """
-    global TestCase
+    CATALOG_STATS.recording = bool(enabled)
+    if slow_threshold is not None:
+        CATALOG_STATS.slow_threshold = float(slow_threshold)
 
-    if TestCase:
-        return
+
+def catalog_stats():
+    """Return dict of recorded stats by catalog id and operation.
+
+    Each operation (search, index or unindex) has a count of calls, their
+    total and maximum time in milliseconds, the total number of search
+    results, and a latency histogram with counts for each of
+    CatalogStats.buckets followed by a count of slower calls.
+
+    """
+    return CATALOG_STATS.stats()
+
+
+def reset_catalog_stats():
+    """Discard recorded catalog call stats."""
+    CATALOG_STATS.reset()
+
+
+def get_template_bindings(component):
+    """Return flattened monitoring template bindings for component.
+
+    Config services can use this instead of walking each component's
+    getRRDTemplates() and their datasources and datapoints. The result
+    is a tuple with a dict for each bound template:
+
+        {'template': path, 'id': id, 'targetPythonClass': name,
+         'datasources': ({'id': id, 'sourcetype': type,
+                          'cycletime': cycletime, 'component': expression,
+                          'eventClass': event class, 'severity': severity,
+                          'datapoints': ({'id': id, 'name': name}, ...)},
+                         ...)}
+
+    Only enabled datasources are included. cycletime and component are
+    returned as stored, so TALES expressions must still be evaluated
+    for each component.
+
+    The table is shared by all components of the same class in the
+    same device class, and must not be modified. It's rebuilt when any
+    of the templates, datasources or datapoints it was read from, or
+    the templates available to the device class, are changed.
+
+    """
+    return TEMPLATE_BINDINGS.get(component)
+
+
+def invalidate_template_bindings():
+    """Discard all cached template binding tables."""
+    TEMPLATE_BINDINGS.invalidate()
+
+
+def template_bindings_stats():
+    """Return dict of template binding cache hits, misses and invalidations."""
+    return TEMPLATE_BINDINGS.stats()
+
+
+def diff_zenpack_specs(old, new):
+    """Return changes between two ZenPackSpec or ZenPackSpecParams.
+
+    The result is an OrderedDict keyed by category: zProperties,
+    classes, properties, relationships, class_relationships,
+    catalog_indexes, device_classes and templates. Each category is an
+    OrderedDict of sorted added, removed and changed lists of names.
+
+    Properties and relationships are named Class.name and are only
+    compared for classes in both specs. Catalog indexes are named
+    Class.index. Templates are named device/class/path/template.
+
+    """
+    old = getattr(old, 'specparams', old)
+    new = getattr(new, 'specparams', new)
+
+    changes = OrderedDict()
+    changes['zProperties'] = diff_dicts(old.zProperties, new.zProperties)
+    changes['classes'] = diff_dicts(old.classes, new.classes)
+
+    def class_members(spec, param):
+        members = {}
+        for class_name in set(old.classes).intersection(new.classes):
+            if class_name == 'DEFAULTS':
+                continue
+
+            for name, member in getattr(spec.classes[class_name], param).items():
+                if name != 'DEFAULTS':
+                    members['{}.{}'.format(class_name, name)] = member
+
+        return members
+
+    changes['properties'] = diff_dicts(
+        class_members(old, 'properties'), class_members(new, 'properties'))
+
+    changes['relationships'] = diff_dicts(
+        class_members(old, 'relationships'), class_members(new, 'relationships'))
+
+    def class_relationships(spec):
+        return {
+            '{}({}) - ({}){}'.format(
+                x.left_class, x.left_relname, x.right_relname, x.right_class):
+            (x.left_type, x.right_type)
+            for x in spec.class_relationships}
+
+    changes['class_relationships'] = diff_dicts(
+        class_relationships(old), class_relationships(new))
+
+    def catalog_indexes(spec):
+        indexes = {}
+        for class_name, class_spec in spec.classes.items():
+            if class_name == 'DEFAULTS':
+                continue
+
+            for name, property_spec in class_spec.properties.items():
+                if name == 'DEFAULTS':
+                    continue
+
+                for index_name, index_spec in property_spec.catalog_indexes.items():
+                    indexes['{}.{}'.format(class_name, index_name)] = index_spec
+
+        return indexes
+
+    changes['catalog_indexes'] = diff_dicts(
+        catalog_indexes(old), catalog_indexes(new))
+
+    def device_classes(spec):
+        return {
+            name: (x.create, x.remove, x.zProperties)
+            for name, x in spec.device_classes.items()}
+
+    changes['device_classes'] = diff_dicts(
+        device_classes(old), device_classes(new))
+
+    def templates(spec):
+        return {
+            '{}/{}'.format(dc_name.rstrip('/'), name): x
+            for dc_name, dc_spec in spec.device_classes.items()
+            for name, x in dc_spec.templates.items()}
+
+    changes['templates'] = diff_dicts(templates(old), templates(new))
+
+    return changes
+
+
+def spec_diff_impact(dmd, zenpack_name, changes):
+    """Return (components, devices) in dmd affected by changes.
+
+    changes is the result of diff_zenpack_specs for zenpack_name.
+
+    Components are those of added, removed or changed classes,
+    or of classes with changed properties, relationships or
+    catalog indexes. Devices are those containing them, plus
+    those in device classes whose zProperties or templates
+    changed.
+
+    """
+    from Products.Zuul.interfaces import ICatalogTool
+
+    class_names = set()
+    for kind in ('added', 'removed', 'changed'):
+        class_names.update(changes['classes'][kind])
+        for category in ('properties', 'relationships', 'catalog_indexes'):
+            class_names.update(
+                x.split('.', 1)[0] for x in changes[category][kind])
+
+    types = [
+        get_symbol_name(zenpack_name, x, x) for x in class_names]
+
+    components = 0
+    device_paths = set()
+    if types:
+        for brain in ICatalogTool(dmd.Devices).search(types=types):
+            components += 1
+            device_path = get_device_path(brain.getPath())
+            if device_path:
+                device_paths.add(device_path)
+
+    dc_names = set()
+    for kind in ('added', 'removed', 'changed'):
+        dc_names.update(changes['device_classes'][kind])
+        dc_names.update(
+            x.rsplit('/', 1)[0] for x in changes['templates'][kind])
+
+    for dc_name in dc_names:
+        try:
+            organizer = dmd.Devices.getOrganizer(dc_name)
+        except KeyError:
+            continue
+
+        for brain in ICatalogTool(organizer).search(
+                types=('Products.ZenModel.Device.Device',)):
+            device_paths.add(brain.getPath())
+
+    return components, len(device_paths)
+
+
+def load_yaml(yaml_filename=None):
+    """Load YAML from yaml_filename.
+
+    Loads from zenpack.yaml in the current directory if
+    yaml_filename isn't specified.
+
+    """
+    CFG = None
+
+    if YAML_INSTALLED:
+        if yaml_filename is None:
+            yaml_filename = os.path.join(
+                os.path.dirname(__file__), 'zenpack.yaml')
+
+        try:
+            CFG = yaml.load(file(yaml_filename, 'r'), Loader=Loader)
+        except Exception as e:
+            LOG.error(e)
+    else:
+        zenpack_name = None
+
+        # Guess ZenPack name from the path.
+        dirname = __file__
+        while dirname != '/':
+            dirname = os.path.dirname(dirname)
+            basename = os.path.basename(dirname)
+            if basename.startswith('ZenPacks.'):
+                zenpack_name = basename
+                break
+
+        LOG.error(
+            '%s requires PyYAML. Run "easy_install PyYAML".',
+            zenpack_name or 'ZenPack')
+
+        # Create a simple ZenPackSpec that should be harmless.
+        CFG = ZenPackSpec(name=zenpack_name or 'NoYAML')
+
+    if CFG:
+        CFG.create()
+    else:
+        LOG.error("Unable to load %s", yaml_filename)
+    return CFG
+
+
+def enableTesting():
+    """Enable test mode. Only call from code under tests/.
+
+    If this is called from production code it will cause all Zope
+    clients to start in test mode. Which isn't useful for anything but
+    unit testing.
+
+    """
+    global TestCase
+
+    if TestCase:
+        return
 
     from Products.ZenTestCase.BaseTestCase import BaseTestCase
     from transaction._transaction import Transaction
@@ -5398,109 +6924,1400 @@ def EnumInfoProperty(data, enum):
         if not enum:
             return ProxyProperty(data)
         else:
-            data = getattr(self._object, data, None)
-            try:
-                data = int(data)
-                return Zuul.info(enum[data])
-            except Exception:
-                return Zuul.info(data)
+            data = getattr(self._object, data, None)
+            try:
+                data = int(data)
+                return Zuul.info(enum[data])
+            except Exception:
+                return Zuul.info(data)
+
+    return property(lambda x: getter(x, data, enum))
+
+
+def RelationshipInfoProperty(relationship_name):
+    """Return a property with the Infos for object(s) in the relationship.
+
+    A list of Info objects is returned for ToMany relationships, and a
+    single Info object is returned for ToOne relationships.
+
+    """
+    def getter(self):
+        return Zuul.info(getattr(self._object, relationship_name)())
+
+    return property(getter)
+
+
+def CompositeIndexProperty(fields):
+    """Return a property with a tuple of values for fields.
+
+    Used as the indexed value of a composite index.
+
+    """
+    def getter(self):
+        values = []
+        for field in fields:
+            value = getattr(self, field, None)
+            if callable(value):
+                value = value()
+
+            values.append(value)
+
+        return tuple(values)
+
+    return property(getter)
+
+
+def RelationshipLengthProperty(relationship_name):
+    """Return a property representing number of objects in relationship."""
+    def getter(self):
+        relationship = getattr(self._object, relationship_name)
+        try:
+            return relationship.countObjects()
+        except Exception:
+            return len(relationship())
+
+    return property(getter)
+
+
+def RelationshipGetter(relationship_name):
+    """Return getter for id or ids in relationship_name."""
+    def getter(self):
+        try:
+            relationship = getattr(self, relationship_name)
+            if isinstance(relationship, ToManyRelationship):
+                return self.getIdsInRelationship(getattr(self, relationship_name))
+            elif isinstance(relationship, ToOneRelationship):
+                return self.getIdForRelationship(relationship)
+        except Exception:
+            LOG.error(
+                "error getting %s ids for %s",
+                relationship_name, self.getPrimaryUrlPath())
+            raise
+
+    return getter
+
+
+def RelationshipSetter(relationship_name):
+    """Return setter for id or ides in relationship_name."""
+    def setter(self, id_or_ids):
+        try:
+            relationship = getattr(self, relationship_name)
+            if isinstance(relationship, ToManyRelationship):
+                self.setIdsInRelationship(relationship, id_or_ids)
+            elif isinstance(relationship, ToOneRelationship):
+                self.setIdForRelationship(relationship, id_or_ids)
+        except Exception:
+            LOG.error(
+                "error setting %s ids for %s",
+                relationship_name, self.getPrimaryUrlPath())
+            raise
+
+    return setter
+
+
+# Private Types #############################################################
+
+OrderAndValue = collections.namedtuple('OrderAndValue', ['order', 'value'])
+
+INDEX_TYPES = ('field', 'keyword', 'boolean', 'path', 'date', 'composite')
+
+# Number of objects changed per transaction by long-running operations.
+DEFAULT_CHUNK_SIZE = 500
+
+# ClassDefaults by class. See get_class_defaults.
+CLASS_DEFAULTS = {}
+
+# Sets of init_params() names by SpecParams class. See get_param_names.
+PARAM_NAMES = {}
+
+
+class ClassDefaults(object):
+    """Default property values and property ids of a class.
+
+    Defaults are read from a single instance of the class the first
+    time each is needed, and cached from then on.
+
+    """
+
+    def __init__(self, klass):
+        self.obj = klass(klass.__name__)
+        properties = getattr(klass, '_properties', ())
+        self.property_ids = tuple(x['id'] for x in properties)
+        self.property_types = {x['id']: x.get('type') for x in properties}
+
+        self.values = {}
+
+    def get(self, name):
+        """Return (present, value) of name on a default instance.
+
+        value is None if name isn't present.
+
+        """
+        result = self.values.get(name)
+        if result is None:
+            result = self.values[name] = (
+                hasattr(self.obj, name), getattr(self.obj, name, None))
+
+        return result
+
+
+class CatalogQueryCache(object):
+    """Cache of catalog_search results for the current transaction.
+
+    Results are cached per catalog and normalized query, and are
+    discarded when the transaction ends or when the catalog is written
+    to. Writes made by zenpacklib invalidate the catalog's results.
+    Code that writes to the catalog directly must call
+    invalidate_catalog_query_cache(). Caching is disabled unless the
+    ZPL_CATALOG_QUERY_CACHE environment variable is set, or until
+    enable_catalog_query_cache() is called.
+
+    """
+
+    # Limit memory held by a single long-running transaction.
+    max_entries = 10000
+
+    def __init__(self):
+        self.enabled = bool(os.environ.get('ZPL_CATALOG_QUERY_CACHE'))
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._local = threading.local()
+
+        # Statistics are shared by all threads.
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        """Increment the named statistic."""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _entries(self):
+        """Return {id(catalog): (catalog, {key: results})} for this transaction."""
+        local = self._local
+        txn = transaction.get()
+        if getattr(local, 'transaction', None) is not txn:
+            local.transaction = txn
+            local.entries = {}
+            local.count = 0
+
+        return local.entries
+
+    def key(self, query):
+        """Return hashable key for query dict, or None if not cacheable."""
+        try:
+            key = freeze(query)
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+    def get(self, catalog, key):
+        """Return cached results for key in catalog, or None."""
+        entry = self._entries().get(id(aq_base(catalog)))
+        if entry is not None and key in entry[1]:
+            self._count('hits')
+            return entry[1][key]
+
+        self._count('misses')
+        return None
+
+    def set(self, catalog, key, results):
+        """Cache results for key in catalog."""
+        entries = self._entries()
+        if self._local.count >= self.max_entries:
+            entries.clear()
+            self._local.count = 0
+
+        base = aq_base(catalog)
+
+        # The catalog itself is kept so its id can't be reused while
+        # it's a key.
+        entry = entries.setdefault(id(base), (base, {}))
+        entry[1][key] = results
+        self._local.count += 1
+
+    def invalidate(self, catalog=None):
+        """Discard cached results for catalog, or for all catalogs."""
+        entries = getattr(self._local, 'entries', None)
+        if not entries:
+            return
+
+        if catalog is None:
+            entries.clear()
+            self._local.count = 0
+            self._count('invalidations')
+        elif entries.pop(id(aq_base(catalog)), None) is not None:
+            self._count('invalidations')
+
+    def clear(self):
+        """Discard all cached results and reset statistics."""
+        self._local = threading.local()
+        with self._lock:
+            self.hits = self.misses = self.invalidations = 0
+
+    def stats(self):
+        """Return dict of cache statistics."""
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+CATALOG_QUERY_CACHE = CatalogQueryCache()
+
+
+class CatalogStats(object):
+    """Per-catalog call counts, latencies and result sizes.
+
+    Recording is disabled unless the ZPL_CATALOG_STATS environment
+    variable is set to a directory, or until enable_catalog_stats() is
+    called. When ZPL_CATALOG_STATS is set, each process writes its stats
+    to a JSON file in that directory when it exits. These files can be
+    summarized with the catalog_stats command.
+
+    Calls slower than ZPL_CATALOG_SLOW_QUERY milliseconds are logged
+    with their query and caller whether or not recording is enabled.
+
+    """
+
+    # Upper bounds of latency histogram buckets in milliseconds. The
+    # last histogram bucket counts anything slower.
+    buckets = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self):
+        self.directory = os.environ.get('ZPL_CATALOG_STATS') or None
+        self.recording = bool(self.directory)
+        self.slow_threshold = None
+        self.data = {}
+
+        threshold = os.environ.get('ZPL_CATALOG_SLOW_QUERY')
+        if threshold:
+            try:
+                self.slow_threshold = float(threshold)
+            except ValueError:
+                LOG.warning(
+                    "ZPL_CATALOG_SLOW_QUERY must be a number of milliseconds, not %r",
+                    threshold)
+
+        if self.directory:
+            atexit.register(self.save)
+
+    @property
+    def enabled(self):
+        """Return True if calls need to be timed."""
+        return self.recording or self.slow_threshold is not None
+
+    def record(self, catalog, operation, elapsed, results=None, query=None, caller=None):
+        """Record a call to operation on catalog taking elapsed seconds."""
+        ms = elapsed * 1000.0
+
+        if self.recording:
+            operations = self.data.setdefault(catalog.id, {})
+            stats = operations.get(operation)
+            if stats is None:
+                stats = operations[operation] = {
+                    'count': 0,
+                    'time': 0.0,
+                    'max_time': 0.0,
+                    'results': 0,
+                    'histogram': [0] * (len(self.buckets) + 1),
+                    }
+
+            stats['count'] += 1
+            stats['time'] += ms
+            stats['max_time'] = max(stats['max_time'], ms)
+            stats['histogram'][bisect.bisect_left(self.buckets, ms)] += 1
+            if results is not None:
+                stats['results'] += results
+
+        if self.slow_threshold is not None and ms >= self.slow_threshold:
+            if caller:
+                caller = "{}:{} in {}".format(
+                    caller.f_code.co_filename,
+                    caller.f_lineno,
+                    caller.f_code.co_name)
+
+            LOG.warning(
+                "Slow catalog %s on %s took %.1fms: %r (called from %s)",
+                operation, catalog.id, ms, query, caller)
+
+    def stats(self):
+        """Return copy of recorded stats."""
+        return copy.deepcopy(self.data)
+
+    def reset(self):
+        """Discard recorded stats."""
+        self.data = {}
+
+    def save(self, directory=None):
+        """Write recorded stats to a JSON file in directory."""
+        directory = directory or self.directory
+        if not directory or not self.data:
+            return
+
+        filename = os.path.join(directory, '{}-{}.json'.format(
+            os.path.basename(sys.argv[0]) or 'python', os.getpid()))
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with open(filename, 'w') as f:
+                json.dump({'buckets': self.buckets, 'catalogs': self.data}, f)
+        except (IOError, OSError) as e:
+            LOG.warning("Unable to write catalog stats to %s: %s", filename, e)
+
+
+CATALOG_STATS = CatalogStats()
+
+
+class TemplateProfile(object):
+    """Time, object counts and pickled sizes of created templates.
+
+    Recording is disabled unless the ZPL_TEMPLATE_PROFILE environment
+    variable is set, or until enable() is called. ZenPack install then
+    logs a report of the slowest templates, datasources and graphs it
+    created. ZPL_TEMPLATE_PROFILE may be set to the number of entries to
+    report. The default is 20.
+
+    Sizes are approximate. They're the pickled size of each object's
+    own state plus its relationships, as they'd be written to ZODB.
+
+    At most max_entries entries are kept between resets. When there are
+    more, only the slowest half are kept. Totals still count them all.
+
+    """
+
+    default_limit = 20
+    max_entries = 10000
+
+    def __init__(self):
+        self.enabled = False
+        self.limit = self.default_limit
+        self.entries = []
+        self.totals = {}
+
+        value = os.environ.get('ZPL_TEMPLATE_PROFILE')
+        if value:
+            self.enabled = True
+            if value.isdigit():
+                self.limit = int(value)
+
+    def enable(self, limit=None):
+        """Enable recording."""
+        self.enabled = True
+        if limit is not None:
+            self.limit = limit
+
+    def start(self):
+        """Return start time to pass to record, or None if disabled."""
+        return time.time() if self.enabled else None
+
+    def record(self, kind, obj, start):
+        """Record creation of obj of kind that started at start."""
+        if start is None:
+            return
+
+        elapsed = time.time() - start
+        objects, size = object_tree_size(obj)
+        self.entries.append({
+            'kind': kind,
+            'path': '/'.join(obj.getPrimaryPath()),
+            'time': elapsed,
+            'objects': objects,
+            'size': size,
+            })
+
+        totals = self.totals.setdefault(
+            kind, {'count': 0, 'time': 0.0, 'objects': 0, 'size': 0})
+
+        totals['count'] += 1
+        totals['time'] += elapsed
+        totals['objects'] += objects
+        totals['size'] += size
+
+        if len(self.entries) > self.max_entries:
+            self.entries.sort(key=lambda x: x['time'], reverse=True)
+            del self.entries[self.max_entries // 2:]
+
+    def reset(self):
+        """Discard recorded entries and totals."""
+        self.entries = []
+        self.totals = {}
+
+    def report(self, limit=None, key='time'):
+        """Return report of recorded entries sorted by key, largest first."""
+        limit = self.limit if limit is None else limit
+        entries = sorted(self.entries, key=lambda x: x[key], reverse=True)
+
+        lines = ['{:>9} {:>8} {:>10}  {:<10} {}'.format(
+            'seconds', 'objects', 'bytes', 'type', 'path')]
+
+        for entry in entries[:limit]:
+            lines.append('{time:>9.3f} {objects:>8} {size:>10}  {kind:<10} {path}'.format(**entry))
+
+        for kind in ('template', 'datasource', 'graph'):
+            totals = self.totals.get(kind)
+            if totals:
+                lines.append('total {} {}s: {:.3f} seconds, {} objects, {} bytes'.format(
+                    totals['count'],
+                    kind,
+                    totals['time'],
+                    totals['objects'],
+                    totals['size']))
+
+        return '\n'.join(lines)
+
+
+TEMPLATE_PROFILE = TemplateProfile()
+
+
+class TemplateBindings(object):
+    """Cache of flattened template binding tables.
+
+    Tables are kept per ZODB connection, and keyed by device class and
+    component class. A table is checked against the ZODB serials of the
+    objects it was read from. Those are the rrdTemplates relationships
+    of the device class and its parents, and each bound template,
+    datasource and datapoint with their relationships. The table is
+    rebuilt if any of them have been changed since, including changes
+    in the current transaction.
+
+    Components with local templates on themselves, their device or any
+    object between them, and classes that override how templates are
+    bound, aren't cached.
+
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        # {connection: {key: entry}}
+        self._tables = weakref.WeakKeyDictionary()
+
+    def cacheable(self, component):
+        """Return True if component's bindings can be shared by its class."""
+        klass = component.__class__
+        if getattr(klass, '_templates', None) is None:
+            return False
+
+        # Classes that choose templates themselves can't share a table.
+        get_templates = getattr(klass.getRRDTemplates, 'im_func', None)
+        if get_templates is not ComponentBase.__dict__['getRRDTemplates']:
+            return False
+
+        get_template = getattr(klass.getRRDTemplateByName, 'im_func', None)
+        if get_template is not BaseDeviceComponent.getRRDTemplateByName.im_func:
+            return False
+
+        if component._p_jar is None:
+            return False
+
+        device = component.device()
+        if device is None:
+            return False
+
+        # Templates are acquired, so a local template on any object
+        # between the component and its device is also bound.
+        device = aq_base(device)
+        objects = []
+        for obj in aq_chain(component):
+            objects.append(obj)
+            if aq_base(obj) is device:
+                break
+
+        return not has_local_templates(objects, klass._templates)
+
+    def get(self, component):
+        """Return binding table for component."""
+        if not self.cacheable(component):
+            self.misses += 1
+            return tuple(
+                flatten_template(x, [])
+                for x in component.getRRDTemplates())
+
+        jar = component._p_jar
+        device_class = component.device().deviceClass().primaryAq()
+        key = ('/'.join(device_class.getPrimaryPath()), component.__class__)
+        tables = self._tables.setdefault(jar, {})
+
+        entry = tables.get(key)
+        if entry is not None:
+            if serials_match(entry['serials']):
+                self.hits += 1
+                return entry['bindings']
+
+            del tables[key]
+            self.invalidations += 1
+
+        self.misses += 1
+
+        watched = [
+            aq_base(x).rrdTemplates for x in aq_chain(device_class)
+            if getattr(aq_base(x), 'rrdTemplates', None) is not None]
+
+        bindings = tuple(
+            flatten_template(x, watched)
+            for x in resolve_templates(device_class, component._templates))
+
+        serials = get_serials(watched)
+        if serials is not None:
+            tables[key] = {
+                'bindings': bindings,
+                'serials': serials,
+                }
+
+        return bindings
+
+    def invalidate(self):
+        """Discard all tables."""
+        for tables in self._tables.values():
+            self.invalidations += len(tables)
+            tables.clear()
+
+    def stats(self):
+        """Return dict of cache statistics."""
+        lookups = self.hits + self.misses
+        return {
+            'tables': sum(len(x) for x in self._tables.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+TEMPLATE_BINDINGS = TemplateBindings()
+
+
+class TemplateTypeMaps(object):
+    """Datasource and threshold types available to templates.
+
+    Each map is read from the first template it's needed for, and
+    reused for all other templates.
+
+    """
+
+    def __init__(self):
+        self._datasource_types = None
+        self._threshold_types = None
+
+    def datasource_types(self, template):
+        """Return {sourcetype: 'Class.sourcetype'} of datasource types."""
+        if self._datasource_types is None:
+            self._datasource_types = dict(template.getDataSourceOptions())
+
+        return self._datasource_types
+
+    def threshold_types(self, template):
+        """Return {type name: class} of threshold types."""
+        if self._threshold_types is None:
+            self._threshold_types = dict(
+                (y, x) for x, y in template.getThresholdClasses())
+
+        return self._threshold_types
+
+
+class TemplateGraphMaps(object):
+    """Threshold lookups shared by all graphs of a template.
+
+    Graphs and graphpoints use these instead of scanning the template's
+    thresholds for each graphpoint.
+
+    """
+
+    def __init__(self, thresholds):
+        # {threshold id: threshold}
+        self.thresholds = {}
+
+        # {threshold id: dsnames}
+        self.threshold_dsnames = {}
+
+        # {datapoint name: [threshold id, ...]} in thresholds order.
+        self.dpname_thresholds = {}
+
+        # {graph id: set of ids of thresholds that can be graphed on it}
+        self.graphable = {}
+
+        for threshold in thresholds:
+            self.thresholds[threshold.id] = threshold
+            dsnames = threshold.dsnames or ()
+            self.threshold_dsnames[threshold.id] = dsnames
+            for dsname in dsnames:
+                threshold_ids = self.dpname_thresholds.setdefault(dsname, [])
+                if threshold.id not in threshold_ids:
+                    threshold_ids.append(threshold.id)
+
+    def threshold_dpnames(self, threshold_ids):
+        """Return set of datapoint names used by threshold_ids."""
+        dpnames = set()
+        for threshold_id in threshold_ids:
+            dpnames.update(self.threshold_dsnames.get(threshold_id, ()))
+
+        return dpnames
+
+    def graphable_ids(self, graph):
+        """Return set of ids of thresholds that can be graphed on graph.
+
+        Each threshold's canGraph(graph) is only called once per graph.
+
+        """
+        graphable = self.graphable.get(graph.id)
+        if graphable is None:
+            graphable = self.graphable[graph.id] = set(
+                x.id for x in self.thresholds.itervalues()
+                if x.canGraph(graph))
+
+        return graphable
+
+    def threshold_ids(self, dpnames, graph):
+        """Return set of ids of thresholds graphed for dpnames on graph."""
+        graphable = self.graphable_ids(graph)
+        threshold_ids = set()
+        for dpname in dpnames:
+            threshold_ids.update(
+                x for x in self.dpname_thresholds.get(dpname, ())
+                if x in graphable)
+
+        return threshold_ids
+
+    def add_threshold_graphpoints(self, graph, dpname, graphed_thresholds):
+        """Graph thresholds that use dpname and aren't already graphed.
+
+        This does what graph.addThresholdsForDataPoint(dpname) does,
+        including skipping thresholds that can't be graphed on graph,
+        without scanning thresholds and graphpoints.
+
+        """
+        graphable = self.graphable_ids(graph)
+        for threshold_id in self.dpname_thresholds.get(dpname, ()):
+            if threshold_id in graphable and threshold_id not in graphed_thresholds:
+                graph.manage_addThresholdGraphPoints([threshold_id])
+                graphed_thresholds.add(threshold_id)
+
+
+class LineFilterStream(object):
+    """Output stream that passes each whole line through func.
+
+    Partial lines are held until they're completed, so func always sees
+    whole lines. Output should end with a newline.
+
+    """
+
+    def __init__(self, stream, func):
+        self.stream = stream
+        self.func = func
+        self.buffer = ''
+
+    def write(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.stream.write(self.func(line) + '\n')
+
+    def flush(self):
+        self.stream.flush()
+
+
+# Private Functions #########################################################
+
+def get_zenpack_path(zenpack_name):
+    """Return filesystem path for given ZenPack."""
+    zenpack_module = importlib.import_module(zenpack_name)
+    if hasattr(zenpack_module, '__file__'):
+        return os.path.dirname(zenpack_module.__file__)
+    else:
+        return None
+
+
+def get_device_path(path):
+    """Return path of device containing object at path, or None."""
+    prefix, sep, rest = path.partition('/devices/')
+    if not sep:
+        return None
+
+    return ''.join((prefix, sep, rest.split('/', 1)[0]))
+
+
+def get_device_class_path(path):
+    """Return path of device class containing object at path.
+
+    The path itself is returned if it isn't within a device class.
+
+    """
+    prefix, sep, rest = path.partition('/devices/')
+    return prefix if sep else path
+
+
+def relations_need_building(obj, relnames):
+    """Return True if obj's relnames relationships don't match its schema.
+
+    That's the case when obj is missing a relationship its class
+    defines, has one its class no longer defines, or has one of a
+    different type than its class defines. A relationship's remote
+    class and name aren't stored on it, but looked up from the schema
+    of its object's class, so they always match.
+
+    """
+    base = aq_base(obj)
+    schemas = dict(obj._relations)
+    for relname in relnames:
+        relationship = getattr(base, relname, None)
+        schema = schemas.get(relname)
+        if (schema is None) != (relationship is None):
+            return True
+
+        if schema is not None and \
+                not isinstance(relationship, schema._relationClass):
+            return True
+
+    return False
+
+
+def format_duration(seconds):
+    """Return seconds formatted as H:MM:SS."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def process_in_chunks(items, func, description, chunk_size=None, commit=False, retries=3):
+    """Call func for each of items in chunks.
+
+    By default a savepoint is made after each chunk. That lets changed
+    objects be removed from memory, but nothing is committed, so the
+    work stays part of the caller's transaction and is rolled back with
+    it.
+
+    If commit is True, each chunk is committed instead, and a chunk that
+    fails to commit due to a conflict is aborted and retried. This must
+    only be used in a transaction with no other pending changes, such as
+    that of the build_relations command, because they'd be committed
+    with the first chunk or lost when a chunk is aborted.
+
+    Progress and an estimated time remaining are logged after each
+    chunk. chunk_size defaults to the ZPL_CHUNK_SIZE environment
+    variable, or DEFAULT_CHUNK_SIZE if that isn't set.
+
+    """
+    from ZODB.POSException import ConflictError
+
+    if not items:
+        return
+
+    if not chunk_size:
+        chunk_size = int(os.environ.get('ZPL_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+
+    total = len(items)
+    start = time.time()
+    for offset in xrange(0, total, chunk_size):
+        chunk = items[offset:offset + chunk_size]
+        if commit:
+            for attempt in xrange(retries + 1):
+                try:
+                    for item in chunk:
+                        func(item)
+
+                    transaction.commit()
+                except ConflictError:
+                    transaction.abort()
+                    if attempt == retries:
+                        raise
+
+                    LOG.info(
+                        "%s: conflict committing chunk, retrying (%s/%s)",
+                        description, attempt + 1, retries)
+                else:
+                    break
+        else:
+            for item in chunk:
+                func(item)
+
+            transaction.savepoint(optimistic=True)
+
+        done = offset + len(chunk)
+        elapsed = time.time() - start
+        LOG.info(
+            "%s: %s/%s (%.0f%%, %s remaining)",
+            description, done, total, done * 100.0 / total,
+            format_duration(elapsed / done * (total - done)))
+
+
+def ordered_values(iterable):
+    """Return ordered list of values for iterable of OrderAndValue instances."""
+    return [
+        x.value for x in sorted(iterable, key=operator.attrgetter('order'))]
+
+
+def pluralize(text):
+    """Return pluralized version of text.
+
+    Totally naive implementation currently. Could use a third party
+    library if we knew it would be installed.
+    """
+    if text.endswith('s'):
+        return '{}es'.format(text)
+
+    return '{}s'.format(text)
+
+
+def plan_step(description, changes, loads):
+    """Return an install or remove plan step."""
+    return OrderedDict((
+        ('description', description),
+        ('changes', changes),
+        ('loads', loads),
+        ))
+
+
+def format_plan(plan):
+    """Return install or remove plan formatted for display."""
+    lines = []
+    for i, step in enumerate(plan, 1):
+        lines.append('{}. {} (loads ~{} objects)'.format(
+            i, step['description'], step['loads']))
+
+        for change in step['changes'] or ['no changes']:
+            lines.append('   - {}'.format(change))
+
+    return '\n'.join(lines)
+
+
+def count_template_objects(template_spec):
+    """Return number of objects in template described by template_spec."""
+    return 1 + len(template_spec.thresholds) + sum(
+        1 + len(x.datapoints) for x in template_spec.datasources.values()) + sum(
+        1 + len(x.graphpoints) for x in template_spec.graphs.values())
+
+
+def resolve_templates(context, template_names):
+    """Return templates named template_names as bound to context.
+
+    A "<name>-replacement" template is used in place of its named
+    template, and a "<name>-addition" template is added after it.
+
+    """
+    templates = []
+
+    for template_name in template_names:
+        replacement = context.getRRDTemplateByName(
+            '{}-replacement'.format(template_name))
+
+        if replacement:
+            templates.append(replacement)
+        else:
+            template = context.getRRDTemplateByName(template_name)
+            if template:
+                templates.append(template)
+
+        addition = context.getRRDTemplateByName(
+            '{}-addition'.format(template_name))
+
+        if addition:
+            templates.append(addition)
+
+    return templates
+
+
+def has_local_templates(objects, template_names):
+    """Return True if any of objects has a local template for template_names."""
+    names = []
+    for template_name in template_names:
+        names.extend((
+            template_name,
+            '{}-replacement'.format(template_name),
+            '{}-addition'.format(template_name)))
+
+    for obj in objects:
+        base = aq_base(obj)
+        for name in names:
+            local = getattr(base, name, None)
+            if getattr(local, 'meta_type', None) == 'RRDTemplate':
+                return True
+
+    return False
+
+
+def flatten_template(template, watched):
+    """Return binding dict for template. See get_template_bindings.
+
+    The persistent objects it's read from are appended to watched.
+
+    """
+    base = aq_base(template)
+    watched.extend((base, base.datasources))
+
+    datasources = []
+    for datasource in base.datasources():
+        datasource = aq_base(datasource)
+        watched.extend((datasource, datasource.datapoints))
+        if not datasource.enabled:
+            continue
+
+        datapoints = []
+        for datapoint in datasource.datapoints():
+            datapoint = aq_base(datapoint)
+            watched.append(datapoint)
+            datapoints.append({
+                'id': datapoint.id,
+                'name': datapoint.name(),
+                })
+
+        datasources.append({
+            'id': datasource.id,
+            'sourcetype': datasource.sourcetype,
+            'cycletime': getattr(datasource, 'cycletime', None),
+            'component': getattr(datasource, 'component', None),
+            'eventClass': getattr(datasource, 'eventClass', None),
+            'severity': getattr(datasource, 'severity', None),
+            'datapoints': tuple(datapoints),
+            })
+
+    return {
+        'template': '/'.join(template.getPrimaryPath()),
+        'id': template.id,
+        'targetPythonClass': template.targetPythonClass,
+        'datasources': tuple(datasources),
+        }
+
+
+def savepoint_oids(jar):
+    """Return container of oids of objects stored in jar's savepoints.
+
+    These objects have been changed in the current transaction, but
+    are no longer marked as changed.
+
+    """
+    storage = getattr(jar, '_savepoint_storage', None)
+    return getattr(storage, 'index', None) or ()
+
+
+def get_serials(objects):
+    """Return [(obj, serial), ...] for persistent objects.
+
+    Returns None if any of them are new or changed in the current
+    transaction, because their serials don't reflect their state.
+
+    """
+    serials = []
+    saved = None
+    for obj in objects:
+        if obj._p_oid is None or obj._p_changed:
+            return None
+
+        if saved is None:
+            saved = savepoint_oids(obj._p_jar)
+
+        if obj._p_oid in saved:
+            return None
+
+        serials.append((obj, obj._p_serial))
+
+    return serials
+
+
+def serials_match(serials):
+    """Return True if no object in serials has changed since it was read."""
+    saved = None
+    for obj, serial in serials:
+        try:
+            # Load invalidated objects to get their new serial.
+            obj._p_activate()
+        except Exception:
+            return False
+
+        if obj._p_changed or obj._p_serial != serial:
+            return False
+
+        if saved is None:
+            saved = savepoint_oids(obj._p_jar)
+
+        if obj._p_oid in saved:
+            return False
+
+    return True
+
+
+def pickled_size(obj):
+    """Return size of persistent obj's own state pickled as in ZODB.
+
+    References to other persistent objects are pickled as references,
+    so they aren't counted.
+
+    """
+    obj = aq_base(obj)
+    output = cStringIO.StringIO()
+    pickler = cPickle.Pickler(output, 1)
+
+    def persistent_id(x):
+        if x is not obj and isinstance(x, Persistent):
+            return id(x)
+
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj.__getstate__())
+    return output.tell()
+
+
+def object_tree_size(obj):
+    """Return (objects, bytes) for obj and all objects it contains.
+
+    Each object's relationships are included in its size. Only objects
+    in containing (ToManyCont) relationships are counted as contained.
+
+    """
+    objects = 0
+    size = 0
+    stack = [aq_base(obj)]
+    while stack:
+        current = stack.pop()
+        objects += 1
+        size += pickled_size(current)
+        for relname, _ in getattr(current, '_relations', ()):
+            relationship = getattr(current, relname, None)
+            if relationship is None:
+                continue
+
+            size += pickled_size(relationship)
+            if isinstance(relationship, ToManyContRelationship):
+                stack.extend(aq_base(x) for x in relationship())
+
+    return objects, size
+
+
+def zproperty_is_set(obj, zprop, value):
+    """Return True if obj has a local zprop equal to value."""
+    base = aq_base(obj)
+    if not base.hasProperty(zprop):
+        return False
+
+    current = getattr(base, zprop, None)
+    if isinstance(current, (list, tuple)) and isinstance(value, (list, tuple)):
+        return list(current) == list(value)
+
+    return current == value
+
+
+def update_properties(obj, values, reset_others=False, speclog=None):
+    """Set obj's attributes to values, leaving those already equal alone.
+
+    A value of None means the default value for obj's class. If
+    reset_others is True, properties in obj._properties that aren't in
+    values are also reset to their default values. Each property that's
+    reset is logged to speclog if it's given.
+
+    Return True if obj was changed.
+
+    """
+    base = aq_base(obj)
+    defaults = get_class_defaults(base.__class__)
+
+    names = list(values)
+    if reset_others:
+        names.extend(
+            x for x in defaults.property_ids
+            if x not in values and x != 'sequence')
+
+    changed = False
+    for name in names:
+        value = values.get(name)
+        if value is None:
+            # Copied so the shared default is never modified through obj.
+            value = copy.copy(defaults.get(name)[1])
+
+        if getattr(base, name, None) != value:
+            if speclog and name not in values:
+                speclog.info("resetting {} to its default".format(name))
+
+            setattr(obj, name, value)
+            changed = True
+
+    return changed
+
+
+def remove_unspecified(relationship, specs, speclog):
+    """Delete objects from relationship that aren't in specs."""
+    for object_id in relationship.objectIds():
+        if object_id not in specs:
+            speclog.debug("removing {}".format(object_id))
+            relationship._delObject(object_id)
+
+
+def diff_dicts(old, new):
+    """Return OrderedDict of sorted added, removed and changed keys.
+
+    DEFAULTS keys are ignored because their values are already applied
+    to the other keys.
+
+    """
+    old_keys = set(old or {}).difference(['DEFAULTS'])
+    new_keys = set(new or {}).difference(['DEFAULTS'])
+
+    changes = OrderedDict()
+    changes['added'] = sorted(new_keys.difference(old_keys))
+    changes['removed'] = sorted(old_keys.difference(new_keys))
+    changes['changed'] = sorted(
+        x for x in old_keys.intersection(new_keys) if old[x] != new[x])
+
+    return changes
+
+
+def content_key(value):
+    """Return hashable, order-independent representation of a spec value."""
+    if isinstance(value, Spec):
+        return value.content_hash
+    elif isinstance(value, collections.Mapping):
+        return ('dict', tuple(sorted(
+            (content_key(k), content_key(v)) for k, v in value.items())))
+    elif isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(content_key(x) for x in value))
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
+
+
+def bind_shared_templates(device_classes):
+    """Add shared templates to the device classes they're shared with.
+
+    Each of a device class' shared_templates names a template defined
+    in another of device_classes as /Device/Class/TemplateName. The
+    same template spec is added to the device class' templates, so a
+    shared template is only parsed and held in memory once.
+
+    """
+    by_path = {x.path.strip('/'): x for x in device_classes.values()}
+    defined = {
+        path: set(x.templates) for path, x in by_path.iteritems()}
+
+    for dcspec in device_classes.values():
+        for shared_template in getattr(dcspec, 'shared_templates', None) or []:
+            dc_path, _, mtname = shared_template.strip('/').rpartition('/')
+            if mtname not in defined.get(dc_path, ()):
+                raise ValueError(
+                    "Shared template {} of {} isn't defined".format(
+                        shared_template, dcspec.path))
+
+            if mtname in dcspec.templates:
+                raise ValueError(
+                    "Template {} of {} is both defined and shared".format(
+                        mtname, dcspec.path))
+
+            dcspec.templates[mtname] = by_path[dc_path].templates[mtname]
+
+    Spec.invalidate_content_hashes()
+
+
+def get_class_defaults(klass):
+    """Return shared ClassDefaults for klass."""
+    defaults = CLASS_DEFAULTS.get(klass)
+    if defaults is None:
+        defaults = CLASS_DEFAULTS[klass] = ClassDefaults(klass)
+
+    return defaults
+
+
+def get_param_names(spec_class):
+    """Return frozenset of spec_class.init_params() names."""
+    names = PARAM_NAMES.get(spec_class)
+    if names is None:
+        names = PARAM_NAMES[spec_class] = frozenset(spec_class.init_params())
+
+    return names
+
+
+def read_object_params(spec, obj, propnames):
+    """Set spec's parameters from obj's values for propnames.
+
+    Only values that differ from the default for obj's class are set.
+    The default is recorded as the parameter's _<param>_defaultvalue
+    so unset parameters still compare equal to it.
+
+    """
+    defaults = get_class_defaults(obj.__class__)
+    for propname in propnames:
+        present, default = defaults.get(propname)
+        if present:
+            setattr(spec, '_%s_defaultvalue' % propname, default)
+
+        value = getattr(obj, propname, None)
+        if value != default:
+            setattr(spec, propname, value)
+
+
+def read_extra_params(spec, obj):
+    """Set spec.extra_params from obj's other non-default properties.
+
+    Properties of obj that aren't parameters of spec are included if
+    their value differs from the default for obj's class.
+
+    """
+    defaults = get_class_defaults(obj.__class__)
+    param_names = get_param_names(spec.__class__)
+
+    spec.extra_params = collections.OrderedDict()
+    for propname in defaults.property_ids:
+        if propname in param_names:
+            continue
+
+        value = getattr(obj, propname, None)
+        if value != defaults.get(propname)[1]:
+            spec.extra_params[propname] = value
+
+
+def datapoint_matches_shorthand(datapoint, shorthand_props):
+    """Return True if datapoint is fully described by shorthand_props.
+
+    That's the case if each of the datapoint's properties has the value
+    in shorthand_props, or its class' default value otherwise. As in an
+    objects.xml export, empty values of non-numeric properties are
+    treated as equal. Aliases aren't checked.
+
+    """
+    defaults = get_class_defaults(datapoint.__class__)
+    for propname in defaults.property_ids:
+        value = getattr(datapoint, propname, None)
+        if propname in shorthand_props:
+            expected = shorthand_props[propname]
+        else:
+            expected = defaults.get(propname)[1]
 
-    return property(lambda x: getter(x, data, enum))
+        if value == expected:
+            continue
 
+        numeric = defaults.property_types[propname] in (
+            'int', 'float', 'long', 'boolean')
 
-def RelationshipInfoProperty(relationship_name):
-    """Return a property with the Infos for object(s) in the relationship.
+        if numeric or value or expected:
+            return False
 
-    A list of Info objects is returned for ToMany relationships, and a
-    single Info object is returned for ToOne relationships.
+    return True
+
+
+def datapoint_xml_matches_shorthand(datapoint, shorthand_props):
+    """Return True if datapoint exports the same XML as shorthand_props.
+
+    This is the slow equivalent of datapoint_matches_shorthand used to
+    check it when the ZPL_SHORTHAND_XML_CHECK environment variable is
+    set. A sample datapoint is created from shorthand_props, and both
+    are compared in their objects.xml representation.
 
     """
-    def getter(self):
-        return Zuul.info(getattr(self._object, relationship_name)())
+    import StringIO
 
-    return property(getter)
+    sample_dp = datapoint.__class__(datapoint.id)
+    for prop in shorthand_props:
+        setattr(sample_dp, prop, shorthand_props[prop])
 
+    xml = []
+    for dp in (datapoint, sample_dp):
+        io = StringIO.StringIO()
+        dp.exportXml(io)
+        xml.append(io.getvalue())
+        io.close()
 
-def RelationshipLengthProperty(relationship_name):
-    """Return a property representing number of objects in relationship."""
-    def getter(self):
-        relationship = getattr(self._object, relationship_name)
-        try:
-            return relationship.countObjects()
-        except Exception:
-            return len(relationship())
+    return xml[0] == xml[1]
 
-    return property(getter)
 
+def template_matches(template, spec):
+    """Return True if template matches RRDTemplateSpecParams spec.
 
-def RelationshipGetter(relationship_name):
-    """Return getter for id or ids in relationship_name."""
-    def getter(self):
-        try:
-            relationship = getattr(self, relationship_name)
-            if isinstance(relationship, ToManyRelationship):
-                return self.getIdsInRelationship(getattr(self, relationship_name))
-            elif isinstance(relationship, ToOneRelationship):
-                return self.getIdForRelationship(relationship)
-        except Exception:
-            LOG.error(
-                "error getting %s ids for %s",
-                relationship_name, self.getPrimaryUrlPath())
-            raise
+    The result is the same as comparing spec to
+    RRDTemplateSpecParams.fromObject(template), but the comparison
+    stops at the first difference. Which thresholds, datasources,
+    datapoints and graphs exist is checked first, then the template's
+    own properties, and then each threshold, graph and datasource in
+    turn.
 
-    return getter
+    """
+    template = aq_base(template)
+    relationships = (
+        ('thresholds', template.thresholds),
+        ('datasources', template.datasources),
+        ('graphs', template.graphDefs),
+        )
 
+    for param, relationship in relationships:
+        if set(relationship.objectIds()) != set(getattr(spec, param) or {}):
+            return False
 
-def RelationshipSetter(relationship_name):
-    """Return setter for id or ides in relationship_name."""
-    def setter(self, id_or_ids):
-        try:
-            relationship = getattr(self, relationship_name)
-            if isinstance(relationship, ToManyRelationship):
-                self.setIdsInRelationship(relationship, id_or_ids)
-            elif isinstance(relationship, ToOneRelationship):
-                self.setIdForRelationship(relationship, id_or_ids)
-        except Exception:
-            LOG.error(
-                "error setting %s ids for %s",
-                relationship_name, self.getPrimaryUrlPath())
-            raise
+    datasources = template.datasources()
+    for datasource in datasources:
+        datapoint_specs = spec.datasources[datasource.id].datapoints or {}
+        if set(datasource.datapoints.objectIds()) != set(datapoint_specs):
+            return False
 
-    return setter
+    # Compare the template's own properties, sharing the spec's
+    # thresholds, datasources and graphs so they compare as equal.
+    installed = object.__new__(RRDTemplateSpecParams)
+    SpecParams.__init__(installed)
+    installed.targetPythonClass = template.targetPythonClass
+    installed.description = template.description
+    for param, _ in relationships:
+        setattr(installed, param, getattr(spec, param))
 
+    if installed != spec:
+        return False
 
-# Private Types #############################################################
+    for threshold in template.thresholds():
+        if RRDThresholdSpecParams.fromObject(threshold) != spec.thresholds[threshold.id]:
+            return False
 
-OrderAndValue = collections.namedtuple('OrderAndValue', ['order', 'value'])
+    graph_maps = TemplateGraphMaps(template.thresholds())
+    for graph in template.graphDefs():
+        if GraphDefinitionSpecParams.fromObject(graph, graph_maps) != spec.graphs[graph.id]:
+            return False
 
+    for datasource in datasources:
+        if RRDDatasourceSpecParams.fromObject(datasource) != spec.datasources[datasource.id]:
+            return False
 
-# Private Functions #########################################################
+    return True
 
-def get_zenpack_path(zenpack_name):
-    """Return filesystem path for given ZenPack."""
-    zenpack_module = importlib.import_module(zenpack_name)
-    if hasattr(zenpack_module, '__file__'):
-        return os.path.dirname(zenpack_module.__file__)
-    else:
-        return None
 
+def templates_to_spec(zenpack_name, templates):
+    """Return ZenPackSpecParams for templates ({dc_name: {id: spec}})."""
+    zpsp = ZenPackSpecParams(zenpack_name, device_classes={x: {} for x in templates})
+    for dc_name in templates:
+        zpsp.device_classes[dc_name].templates = templates[dc_name]
 
-def ordered_values(iterable):
-    """Return ordered list of values for iterable of OrderAndValue instances."""
-    return [
-        x.value for x in sorted(iterable, key=operator.attrgetter('order'))]
+    return zpsp
 
 
-def pluralize(text):
-    """Return pluralized version of text.
+def template_diff(old, new):
+    """Return unified diff of YAML for templates old and new.
+
+    Only thresholds, datasources and graphs whose content differs are
+    included, so unchanged parts of large templates aren't serialized.
 
-    Totally naive implementation currently. Could use a third party
-    library if we knew it would be installed.
     """
-    if text.endswith('s'):
-        return '{}es'.format(text)
+    import difflib
 
-    return '{}s'.format(text)
+    old_trimmed = copy.copy(old)
+    new_trimmed = copy.copy(new)
+    for param in ('thresholds', 'datasources', 'graphs'):
+        old_specs = getattr(old, param) or {}
+        new_specs = getattr(new, param) or {}
+        differ = set(
+            x for x in set(old_specs).union(new_specs)
+            if x not in old_specs or x not in new_specs or
+            old_specs[x] != new_specs[x])
+
+        setattr(old_trimmed, param, OrderedDict(
+            (k, v) for k, v in old_specs.items() if k in differ))
+        setattr(new_trimmed, param, OrderedDict(
+            (k, v) for k, v in new_specs.items() if k in differ))
+
+    lines_old = [x + '\n' for x in yaml.dump(old_trimmed, Dumper=Dumper).split('\n')]
+    lines_new = [x + '\n' for x in yaml.dump(new_trimmed, Dumper=Dumper).split('\n')]
+    return ''.join(difflib.unified_diff(lines_old, lines_new))
 
 
 def fix_kwargs(kwargs):
@@ -5526,26 +8343,171 @@ def update(d, u):
     return d
 
 
+def freeze(value):
+    """Return hashable equivalent of value made of dicts, lists and sets."""
+    if isinstance(value, collections.Mapping):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(freeze(x) for x in value)
+
+    return value
+
+
+def merge_catalog_stats(stats_list):
+    """Return stats combined from a list of catalog_stats() dicts."""
+    merged = {}
+    for stats in stats_list:
+        for catalog_id, operations in stats.items():
+            for operation, data in operations.items():
+                existing = merged.setdefault(catalog_id, {}).get(operation)
+                if existing is None:
+                    merged[catalog_id][operation] = copy.deepcopy(data)
+                    continue
+
+                for key in ('count', 'time', 'results'):
+                    existing[key] += data[key]
+
+                existing['max_time'] = max(existing['max_time'], data['max_time'])
+                existing['histogram'] = [
+                    a + b for a, b in zip(existing['histogram'], data['histogram'])]
+
+    return merged
+
+
+def make_boolean_index(name):
+    """Return boolean index named name.
+
+    BooleanIndex is only available in Zope 2.13 and newer. A field index
+    is used instead for older versions.
+
+    """
+    try:
+        from Products.PluginIndexes.BooleanIndex.BooleanIndex import BooleanIndex
+    except ImportError:
+        return makeFieldIndex(name)
+
+    return BooleanIndex(name)
+
+
+def make_path_index(name):
+    """Return path index named name."""
+    from Products.PluginIndexes.PathIndex.PathIndex import PathIndex
+    return PathIndex(name)
+
+
+def make_date_index(name):
+    """Return date index named name."""
+    from Products.PluginIndexes.DateIndex.DateIndex import DateIndex
+    return DateIndex(name)
+
+
+def make_composite_index(name, fields):
+    """Return field index of tuples of values for fields."""
+    index = makeFieldIndex(name)
+    index.composite_fields = tuple(fields)
+    return index
+
+
+def get_composite_fields(index):
+    """Return tuple of fields if index is a composite index, else None."""
+    return getattr(aq_base(index), 'composite_fields', None)
+
+
+def normalize_catalog_query(catalog, query):
+    """Return query with values for composite and date indexes expanded.
+
+    Composite indexes can be queried with a tuple of values, a list of
+    such tuples, or a dict of field values. Date indexes can be queried
+    with a dict containing min and/or max.
+
+    """
+    indexes = catalog._catalog.indexes
+    normalized = {}
+    for name, value in query.items():
+        index = indexes.get(name)
+        if index is None or (isinstance(value, dict) and 'query' in value):
+            normalized[name] = value
+            continue
+
+        fields = get_composite_fields(index)
+        if fields:
+            if isinstance(value, dict):
+                value = tuple(value.get(x) for x in fields)
+
+            if isinstance(value, tuple):
+                value = {'query': [value]}
+            elif isinstance(value, list):
+                value = {'query': [tuple(x) for x in value]}
+
+        elif index.meta_type == 'DateIndex' and isinstance(value, dict):
+            if 'min' in value and 'max' in value:
+                value = {
+                    'query': (value['min'], value['max']),
+                    'range': 'min:max'}
+            elif 'min' in value:
+                value = {'query': value['min'], 'range': 'min'}
+            elif 'max' in value:
+                value = {'query': value['max'], 'range': 'max'}
+
+        normalized[name] = value
+
+    return normalized
+
+
 def catalog_search(scope, name, *args, **kwargs):
     """Return iterable of matching brains in named catalog."""
 
     catalog = getattr(scope, '{}Search'.format(name), None)
     if not catalog:
-        LOG.debug("Catalog %sSearch not found at %s.  It should be created when the first included component is indexed" % (name, scope))
+        LOG.debug("Catalog %sSearch not found at %s.  It should be created when the ZenPack is installed or the first included component is added" % (name, scope))
         return []
 
+    if not CATALOG_STATS.enabled:
+        return search_catalog(catalog, *args, **kwargs)
+
+    start = time.time()
+    results = search_catalog(catalog, *args, **kwargs)
+    CATALOG_STATS.record(
+        catalog, 'search', time.time() - start,
+        results=len(results),
+        query=args[0] if args else kwargs,
+        caller=sys._getframe(1))
+
+    return results
+
+
+def search_catalog(catalog, *args, **kwargs):
+    """Return iterable of matching brains in catalog."""
     if args:
         if isinstance(args[0], BaseQuery):
+            # AdvancedQuery objects have no reliable structural
+            # equality, so they're never cached.
             return catalog.evalAdvancedQuery(args[0])
         elif isinstance(args[0], dict):
-            return catalog(args[0])
+            query = args[0]
         else:
             raise TypeError(
                 "search() argument must be a BaseQuery or a dict, "
                 "not {0!r}"
                 .format(type(args[0]).__name__))
+    else:
+        query = kwargs
+
+    query = normalize_catalog_query(catalog, query)
 
-    return catalog(**kwargs)
+    cache = CATALOG_QUERY_CACHE
+    key = cache.key(query) if cache.enabled else None
+    if key is None:
+        return catalog(query)
+
+    results = cache.get(catalog, key)
+    if results is None:
+        results = catalog(query)
+        cache.set(catalog, key, results)
+
+    return results
 
 
 def apply_defaults(dictionary, default_defaults=None, leave_defaults=False):
@@ -6091,6 +9053,10 @@ Available commands and example options:
   # Export existing monitoring templates to yaml.
   dump_templates ZenPacks.example.AlreadyInstalled
 
+  # Export monitoring templates of several or all ZenPacks in parallel,
+  # optionally writing a file per device class.
+  dump_templates --workers=4 --output-dir=templates --all
+
   # Convert a pre-release zenpacklib.ZenPackSpec to yaml.
   py_to_yaml ZenPacks.example.AlreadyInstalled
 
@@ -6098,6 +9064,23 @@ Available commands and example options:
   # are currently filtered.
   list_paths [device name]
 
+  # Summarize catalog stats written by processes run with
+  # ZPL_CATALOG_STATS set to a directory.
+  catalog_stats /path/to/stats/directory
+
+  # Build ZenPack relations on objects at the paths read from stdin, one
+  # per line. Used by ZenPack install when ZPL_RELATIONS_WORKERS is
+  # greater than 1.
+  build_relations ZenPacks.example.AlreadyInstalled '{"Products.ZenModel.Device": ["relname"]}' < paths.txt
+
+  # Print what installing, removing or upgrading a ZenPack would change
+  # without changing anything.
+  plan install ZenPacks.example.AlreadyInstalled
+
+  # Print changes between two versions of zenpack.yaml, and estimate
+  # how many components and devices they affect.
+  diff old/zenpack.yaml new/zenpack.yaml
+
   # Print zenpacklib version.
   version
 """.lstrip()
@@ -6177,8 +9160,22 @@ if __name__ == '__main__':
     from Products.ZenUtils.ZenScriptBase import ZenScriptBase
 
     class ZPLCommand(ZenScriptBase):
+        def buildOptions(self):
+            ZenScriptBase.buildOptions(self)
+            self.parser.add_option(
+                '--all', dest='all', action='store_true', default=False,
+                help="dump_templates: Dump templates of all ZenPacks")
+            self.parser.add_option(
+                '--workers', dest='workers', type='int', default=1,
+                help="dump_templates: Number of worker processes")
+            self.parser.add_option(
+                '--output-dir', dest='output_dir', default=None,
+                help="dump_templates: Write a file per device class to this directory")
+
         def run(self):
-            args = sys.argv[1:]
+            # Positional arguments, so options can come before or after
+            # the command.
+            args = self.args
 
             if len(args) == 2 and args[0] == 'lint':
                 filename = args[1]
@@ -6258,24 +9255,15 @@ if __name__ == '__main__':
                     # And merge in the templates we found in ZODB.
                     specparams.device_classes[dc_name].templates.update(templates[dc_name])
 
-                outputfile = yaml.dump(specparams, Dumper=Dumper)
-
-                # tweak the yaml slightly.
-                outputfile = outputfile.replace("__builtin__.object", "object")
-                outputfile = re.sub(r"!!float '(\d+)'", r"\1", outputfile)
-
-                print outputfile
-
-            elif len(args) == 2 and args[0] == 'dump_templates':
-                zenpack_name = args[1]
-                self.connect()
+                def tweak(line):
+                    # tweak the yaml slightly.
+                    line = line.replace("__builtin__.object", "object")
+                    return re.sub(r"!!float '(\d+)'", r"\1", line)
 
-                templates = self.zenpack_templatespecs(zenpack_name)
-                zpsp = ZenPackSpecParams(zenpack_name, device_classes={x: {} for x in templates})
-                for dc_name in templates:
-                    zpsp.device_classes[dc_name].templates = templates[dc_name]
+                stream_yaml(specparams, LineFilterStream(sys.stdout, tweak))
 
-                print yaml.dump(zpsp, Dumper=Dumper)
+            elif len(args) >= 1 and args[0] == 'dump_templates':
+                self.dump_templates(args[1:])
 
             elif len(args) == 3 and args[0] == "class_diagram":
                 diagram_type = args[1]
@@ -6372,6 +9360,151 @@ if __name__ == '__main__':
                 for source_class in sorted(class_summary.keys()):
                     print "%s is reachable from %s" % (source_class, ", ".join(sorted(class_summary[source_class])))
 
+            elif len(args) >= 2 and args[0] == "catalog_stats":
+                filenames = []
+                for path in args[1:]:
+                    if os.path.isdir(path):
+                        filenames.extend(
+                            os.path.join(path, x)
+                            for x in sorted(os.listdir(path))
+                            if x.endswith('.json'))
+                    else:
+                        filenames.append(path)
+
+                buckets = CatalogStats.buckets
+                stats_list = []
+                for filename in filenames:
+                    try:
+                        with open(filename, 'r') as f:
+                            data = json.load(f)
+                    except (IOError, ValueError) as e:
+                        LOG.error("Unable to read %s: %s", filename, e)
+                        continue
+
+                    buckets = data.get('buckets', buckets)
+                    stats_list.append(data.get('catalogs', {}))
+
+                stats = merge_catalog_stats(stats_list)
+                if not stats:
+                    print "No catalog stats found."
+                    return
+
+                rows = []
+                for catalog_id, operations in stats.items():
+                    for operation, data in operations.items():
+                        rows.append((catalog_id, operation, data))
+
+                rows.sort(key=lambda x: x[2]['time'], reverse=True)
+
+                print "{:<50} {:<8} {:>9} {:>11} {:>9} {:>9} {:>9}".format(
+                    "Catalog", "Call", "Count", "Total ms", "Avg ms", "Max ms", "Avg size")
+
+                for catalog_id, operation, data in rows:
+                    count = data['count'] or 1
+                    print "{:<50} {:<8} {:>9} {:>11.1f} {:>9.2f} {:>9.1f} {:>9}".format(
+                        catalog_id, operation, data['count'], data['time'],
+                        data['time'] / count, data['max_time'],
+                        data['results'] / count if operation == 'search' else '-')
+
+                labels = ["<={}".format(x) for x in buckets] + [">{}".format(buckets[-1])]
+
+                print "\nLatency Histogram (ms)\n"
+                print "{:<50} {:<8} ".format("Catalog", "Call") + " ".join(
+                    "{:>7}".format(x) for x in labels)
+
+                for catalog_id, operation, data in rows:
+                    print "{:<50} {:<8} ".format(catalog_id, operation) + " ".join(
+                        "{:>7}".format(x) for x in data['histogram'])
+
+            elif len(args) == 3 and args[0] == "build_relations":
+                paths = [x.strip() for x in sys.stdin if x.strip()]
+                self.connect()
+                zenpack = self.dmd.ZenPackManager.packs._getOb(args[1], None)
+                if zenpack is None:
+                    LOG.error("ZenPack '%s' not found." % args[1])
+                    sys.exit(1)
+
+                zenpack._buildDeviceRelations(
+                    relations=json.loads(args[2]), paths=paths, commit=True)
+
+            elif len(args) == 3 and args[0] == "plan" and \
+                    args[1] in ('install', 'remove', 'upgrade'):
+                action, zenpack_name = args[1:]
+                self.connect()
+
+                packs = self.dmd.ZenPackManager.packs
+                zenpack = packs._getOb(zenpack_name, None)
+                if zenpack is None and action == 'install':
+                    # Plan the installation of a ZenPack that isn't
+                    # installed yet, but can be imported.
+                    try:
+                        zenpack_module = importlib.import_module(zenpack_name)
+                    except ImportError:
+                        zenpack_module = None
+
+                    if hasattr(zenpack_module, 'ZenPack'):
+                        zenpack = zenpack_module.ZenPack(zenpack_name).__of__(packs)
+
+                if zenpack is None:
+                    LOG.error("ZenPack '%s' not found." % zenpack_name)
+                    sys.exit(1)
+
+                if not hasattr(zenpack, 'install_plan'):
+                    LOG.error(
+                        "ZenPack '%s' doesn't use a zenpacklib that supports plans.",
+                        zenpack_name)
+                    sys.exit(1)
+
+                plan = []
+                if action == 'remove':
+                    plan.extend(zenpack.remove_plan())
+                elif action == 'upgrade':
+                    plan.extend(zenpack.remove_plan(leaveObjects=True))
+
+                if action != 'remove':
+                    plan.extend(zenpack.install_plan())
+
+                print "Plan for {} of {}".format(action, zenpack_name)
+                print format_plan(plan)
+
+                transaction.abort()
+
+            elif len(args) == 3 and args[0] == "diff":
+                with open(args[1], 'r') as stream:
+                    old_spec = yaml.load(stream, Loader=Loader)
+
+                with open(args[2], 'r') as stream:
+                    new_spec = yaml.load(stream, Loader=Loader)
+
+                changes = diff_zenpack_specs(old_spec, new_spec)
+                if not any(any(x.values()) for x in changes.values()):
+                    print "No changes."
+                    return
+
+                symbols = (('added', '+'), ('removed', '-'), ('changed', '~'))
+                for category, change in changes.items():
+                    if not any(change.values()):
+                        continue
+
+                    print category
+                    for kind, symbol in symbols:
+                        for name in change[kind]:
+                            print "  {} {}".format(symbol, name)
+
+                    print
+
+                try:
+                    self.connect()
+                except Exception as e:
+                    LOG.warning("Unable to estimate impact without a connection to Zenoss: %s", e)
+                    return
+
+                components, devices = spec_diff_impact(
+                    self.dmd, new_spec.name, changes)
+                print "Estimated impact"
+                print "  {} components of changed classes".format(components)
+                print "  {} devices".format(devices)
+
             elif len(args) == 2 and args[0] == "create":
                 create_zenpack_srcdir(args[1])
 
@@ -6381,6 +9514,188 @@ if __name__ == '__main__':
             else:
                 print USAGE.format(sys.argv[0])
 
+        def dump_templates(self, names):
+            """Print or write YAML for the monitoring templates of ZenPacks.
+
+            names are ZenPack names, or ZenPack:/Device/Class to only
+            dump templates of one of a ZenPack's device classes. A
+            single ZenPack is printed as one YAML document. Otherwise a
+            document is printed for each of the ZenPacks' device classes
+            as soon as it's ready, or written to a file per device class
+            if --output-dir is given. Device classes are distributed
+            between --workers worker processes, each with its own ZODB
+            connection.
+
+            """
+            self.connect()
+
+            if self.options.all:
+                names = sorted(self.dmd.ZenPackManager.packs.objectIds())
+
+            if not names:
+                LOG.error("No ZenPacks given.")
+                sys.exit(1)
+
+            if len(names) == 1 and ':' not in names[0] and \
+                    self.options.workers <= 1 and not self.options.output_dir:
+                templates = self.zenpack_templatespecs(names[0])
+                if templates is None:
+                    sys.exit(1)
+
+                stream_yaml(templates_to_spec(names[0], templates), sys.stdout)
+                return
+
+            items = []
+            for name in names:
+                zenpack_name, _, dc_name = name.partition(':')
+                if dc_name:
+                    items.append((zenpack_name, dc_name))
+                    continue
+
+                dc_names = self.zenpack_device_classes(zenpack_name)
+                if dc_names is not None:
+                    items.extend((zenpack_name, x) for x in dc_names)
+
+            workers = min(self.options.workers, len(items))
+            if workers > 1:
+                self.dump_templates_in_workers(items, workers)
+                return
+
+            for zenpack_name, dc_name in items:
+                try:
+                    deviceclass = self.dmd.Devices.getOrganizer(dc_name)
+                except KeyError:
+                    LOG.error("Device class '%s' not found." % dc_name)
+                    continue
+
+                self.write_templates(
+                    zenpack_name, self.device_class_templatespecs(deviceclass))
+
+                # Don't keep every template's objects in memory.
+                self.dmd._p_jar.cacheGC()
+
+        def dump_templates_in_workers(self, items, workers):
+            """Dump templates for (zenpack_name, dc_name) items in workers.
+
+            Each worker is a dump_templates command for a share of the
+            items. Their documents are printed whole as each is
+            completed, or they write their own files with --output-dir.
+
+            """
+            import subprocess
+
+            script = '{}.py'.format(os.path.splitext(os.path.abspath(__file__))[0])
+            options = []
+            if self.options.output_dir:
+                options = ['--output-dir', self.options.output_dir]
+
+            processes = [
+                subprocess.Popen(
+                    [sys.executable, script, 'dump_templates'] + options + [
+                        '{}:{}'.format(*x) for x in items[i::workers]],
+                    stdout=subprocess.PIPE)
+                for i in xrange(workers)]
+
+            lock = threading.Lock()
+
+            def relay(stream):
+                document = []
+                for line in iter(stream.readline, ''):
+                    document.append(line)
+                    if line.rstrip() == '...':
+                        with lock:
+                            sys.stdout.write(''.join(document))
+                            sys.stdout.flush()
+
+                        document = []
+
+            threads = [
+                threading.Thread(target=relay, args=(x.stdout,))
+                for x in processes]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            failures = [x for x in processes if x.wait() != 0]
+            if failures:
+                LOG.error(
+                    "%s of %s workers failed to dump templates",
+                    len(failures), len(processes))
+
+                sys.exit(1)
+
+        def write_templates(self, zenpack_name, templates):
+            """Print or write templates ({dc_name: {id: spec}}) as YAML.
+
+            A document is printed for all of templates, unless
+            --output-dir is set. Then a file is written for each device
+            class, at <output dir>/<ZenPack>/<device class path>.yaml.
+
+            """
+            if not self.options.output_dir:
+                stream_yaml(
+                    templates_to_spec(zenpack_name, templates), sys.stdout,
+                    explicit_start=True, explicit_end=True)
+
+                sys.stdout.flush()
+                return
+
+            for dc_name, dc_templates in templates.iteritems():
+                filename = os.path.join(
+                    self.options.output_dir, zenpack_name,
+                    *dc_name.strip('/').split('/')) + '.yaml'
+
+                dirname = os.path.dirname(filename)
+                if not os.path.isdir(dirname):
+                    try:
+                        os.makedirs(dirname)
+                    except OSError:
+                        # Another worker may have just created it.
+                        if not os.path.isdir(dirname):
+                            raise
+
+                with open(filename, 'w') as f:
+                    stream_yaml(
+                        templates_to_spec(zenpack_name, {dc_name: dc_templates}), f)
+
+                LOG.info("Wrote %s", filename)
+
+        def zenpack_device_classes(self, zenpack_name):
+            """Return names of device classes packed by a ZenPack.
+
+            Device classes within another of the returned device classes
+            are left out because their templates are dumped with it.
+
+            """
+            zenpack = self.dmd.ZenPackManager.packs._getOb(zenpack_name, None)
+            if zenpack is None:
+                LOG.error("ZenPack '%s' not found." % zenpack_name)
+                return
+
+            dc_names = set(
+                x.getOrganizerName() for x in zenpack.packables()
+                if x.meta_type == 'DeviceClass')
+
+            return sorted(
+                x for x in dc_names
+                if not any(x.startswith(y.rstrip('/') + '/') for y in dc_names))
+
+        def device_class_templatespecs(self, deviceclass):
+            """Return {dc_name: {id: spec}} of templates in deviceclass.
+
+            Templates of deviceclass' subclasses are included.
+
+            """
+            templates = collections.defaultdict(dict)
+            for template in deviceclass.getAllRRDTemplates():
+                dc_name = template.deviceClass().getOrganizerName()
+                templates[dc_name][template.id] = RRDTemplateSpecParams.fromObject(template)
+
+            return templates
+
         def zenpack_templatespecs(self, zenpack_name):
             zenpack = self.dmd.ZenPackManager.packs._getOb(zenpack_name, None)
             if zenpack is None:
@@ -6389,9 +9704,9 @@ if __name__ == '__main__':
 
             templates = collections.defaultdict(dict)
             for deviceclass in [x for x in zenpack.packables() if x.meta_type == 'DeviceClass']:
-                for template in deviceclass.getAllRRDTemplates():
-                    dc_name = template.deviceClass().getOrganizerName()
-                    templates[dc_name][template.id] = RRDTemplateSpecParams.fromObject(template)
+                for dc_name, dc_templates in self.device_class_templatespecs(deviceclass).iteritems():
+                    templates[dc_name].update(dc_templates)
+
             return templates
 
     script = ZPLCommand()